@@ -69,6 +69,9 @@ class ConnectSerialAction(MachineAction):
         global_container_stack = Application.getInstance().getGlobalContainerStack()
         if global_container_stack:
             global_container_stack.setMetaDataEntry("serial_rate", serial_rate)
+            serial_port = global_container_stack.getMetaDataEntry("serial_port")
+            if serial_port and self._output_device_plugin:
+                self._output_device_plugin.setPortBaudRate(serial_port, serial_rate)
         self.baudRateChanged.emit()
 
     baudRateChanged = pyqtSignal()
@@ -103,9 +106,13 @@ class ConnectSerialAction(MachineAction):
             return False
 
     serialPortsChanged = pyqtSignal()
+    ##  Get the serial ports found on the system
+    #   \return List of the ports, with their port, device, description, hwid, by_id and baud_rate
     @pyqtProperty("QVariantList", notify = serialPortsChanged)
     def portList(self):
-        return self._output_device_plugin.getSerialPortList()
+        if not self._output_device_plugin:
+            return []
+        return self._output_device_plugin.getSerialPortSnapshot().entries
 
     @pyqtProperty("QList<int>", constant = True)
     def allBaudRates(self):
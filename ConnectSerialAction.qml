@@ -75,14 +75,20 @@ Cura.MachineAction
                         var current_index = 0;
 
                         var port_list = manager.portList;
-                        for(var index in port_list)
+                        for(var index = 0; index < port_list.length; index++)
                         {
+                            var port = port_list[index];
+                            var text = port.device;
+                            if(port.description && port.description != "n/a" && port.description != port.device)
+                            {
+                                text = catalog.i18nc("@label serial port description and device", "%1 (%2)").arg(port.description).arg(port.device);
+                            }
                             append({
-                                key: port_list[index],
-                                text: port_list[index],
+                                key: port.port,
+                                text: text,
                                 available: true
                             });
-                            if(port_list[index] == manager.serialPort)
+                            if(port.port == manager.serialPort)
                             {
                                 current_index = index + 1;
                             }
@@ -20,8 +20,171 @@ Component
 
         property var connectedDevice: Cura.MachineManager.printerOutputDevices.length >= 1 ? Cura.MachineManager.printerOutputDevices[0] : null
 
+        Item // Plot of the temperatures reported by the printer
+        {
+            id: temperatureHistory
+            visible: connectedDevice != null && connectedDevice.temperatureHistory !== undefined
+
+            anchors.left: parent.left
+            anchors.right: monitorPanel.left
+            anchors.bottom: parent.bottom
+            anchors.margins: UM.Theme.getSize("default_margin").width
+            height: parent.height * 0.4
+
+            // Seconds shown; longer spans are plotted from the averaged history
+            property int span: spanSelection.model.get(spanSelection.currentIndex).seconds
+            property var history: null
+            property var colors: ["#e03c31", "#2b7de9", "#3da33d", "#e9a22b", "#9a4fd1", "#616161"]
+
+            function refresh()
+            {
+                history = visible ? connectedDevice.temperatureHistory(span) : null
+                plot.requestPaint()
+            }
+
+            onSpanChanged: refresh()
+            onVisibleChanged: refresh()
+
+            Connections
+            {
+                target: connectedDevice
+                ignoreUnknownSignals: true
+                onTemperatureHistoryChanged: temperatureHistory.refresh()
+            }
+
+            Label
+            {
+                id: historyTitle
+                anchors.left: parent.left
+                anchors.verticalCenter: spanSelection.verticalCenter
+                text: catalog.i18nc("@label", "Temperatures")
+                font: UM.Theme.getFont("default_bold")
+                color: UM.Theme.getColor("text")
+            }
+
+            ComboBox
+            {
+                id: spanSelection
+                anchors.right: parent.right
+                anchors.top: parent.top
+                model: ListModel
+                {
+                    ListElement { text: "10 min"; seconds: 600 }
+                    ListElement { text: "1 h"; seconds: 3600 }
+                    ListElement { text: "12 h"; seconds: 43200 }
+                    ListElement { text: "7 days"; seconds: 604800 }
+                }
+                currentIndex: 1
+            }
+
+            Row // Legend
+            {
+                anchors.left: historyTitle.right
+                anchors.leftMargin: UM.Theme.getSize("default_margin").width
+                anchors.verticalCenter: spanSelection.verticalCenter
+                spacing: UM.Theme.getSize("default_margin").width
+                Repeater
+                {
+                    model: temperatureHistory.history != null ? temperatureHistory.history.series : []
+                    Label
+                    {
+                        text: modelData.name
+                        color: temperatureHistory.colors[index % temperatureHistory.colors.length]
+                        font: UM.Theme.getFont("default")
+                    }
+                }
+            }
+
+            Canvas
+            {
+                id: plot
+                anchors.left: parent.left
+                anchors.right: parent.right
+                anchors.top: spanSelection.bottom
+                anchors.bottom: parent.bottom
+                anchors.topMargin: UM.Theme.getSize("default_margin").height
+
+                onPaint:
+                {
+                    var context = getContext("2d");
+                    context.clearRect(0, 0, width, height);
+                    var history = temperatureHistory.history;
+                    if (history == null || history.times.length == 0)
+                    {
+                        return;
+                    }
+                    var start = history.now - temperatureHistory.span;
+                    var times = history.times;
+
+                    // Whole multiples of 50 degrees around the temperatures shown
+                    var highest = 50;
+                    for (var i = 0; i < history.series.length; i++)
+                    {
+                        var series = history.series[i];
+                        for (var j = 0; j < times.length; j++)
+                        {
+                            highest = Math.max(highest, isNaN(series.actual[j]) ? 0 : series.actual[j], isNaN(series.target[j]) ? 0 : series.target[j]);
+                        }
+                    }
+                    highest = Math.ceil(highest / 50) * 50;
+
+                    context.font = "10px sans-serif";
+                    context.lineWidth = 1;
+                    context.strokeStyle = "" + UM.Theme.getColor("lining");
+                    context.fillStyle = "" + UM.Theme.getColor("text_inactive");
+                    for (var degrees = 0; degrees <= highest; degrees += 50)
+                    {
+                        var y = height - degrees / highest * height;
+                        context.beginPath();
+                        context.moveTo(0, y);
+                        context.lineTo(width, y);
+                        context.stroke();
+                        context.fillText(degrees + "\u00B0C", 2, Math.max(y - 2, 10));
+                    }
+
+                    function trace(values, color, lineWidth, alpha)
+                    {
+                        context.globalAlpha = alpha;
+                        context.strokeStyle = color;
+                        context.lineWidth = lineWidth;
+                        context.beginPath();
+                        var drawing = false;
+                        for (var k = 0; k < times.length; k++)
+                        {
+                            if (isNaN(values[k]))
+                            {
+                                drawing = false;
+                                continue;
+                            }
+                            var x = (times[k] - start) / temperatureHistory.span * width;
+                            var y = height - values[k] / highest * height;
+                            if (drawing)
+                            {
+                                context.lineTo(x, y);
+                            }
+                            else
+                            {
+                                context.moveTo(x, y);
+                                drawing = true;
+                            }
+                        }
+                        context.stroke();
+                        context.globalAlpha = 1;
+                    }
+
+                    for (var i = 0; i < history.series.length; i++)
+                    {
+                        var color = temperatureHistory.colors[i % temperatureHistory.colors.length];
+                        trace(history.series[i].target, color, 1, 0.5);
+                        trace(history.series[i].actual, color, 2, 1);
+                    }
+                }
+            }
+        }
+
         Rectangle
         {
+            id: monitorPanel
             color: UM.Theme.getColor("main_background")
 
             anchors.right: parent.right
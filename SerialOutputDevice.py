@@ -6,6 +6,7 @@ from UM.Logger import Logger
 from UM.Mesh.MeshWriter import MeshWriter #To get the g-code output.
 from UM.Message import Message #Show an error when already printing.
 from UM.PluginRegistry import PluginRegistry #To get the g-code output.
+from UM.Resources import Resources
 from UM.Qt.Duration import DurationFormat
 
 from cura.CuraApplication import CuraApplication
@@ -24,29 +25,54 @@ except ImportError:
 
 #from .AvrFirmwareUpdater import AvrFirmwareUpdater
 
-from PyQt5.QtCore import QTimer, pyqtSlot
+from PyQt5.QtCore import QTimer, pyqtSignal, pyqtSlot
 
 import os
 import sys
-import re
-from io import StringIO #To write the g-code output.
+import hashlib
+import threading
 from time import time
-from typing import Union, Optional, List, cast, TYPE_CHECKING
+from typing import Any, Dict, Union, Optional, List, Tuple, cast, TYPE_CHECKING
 
 # fix nested importing for printrun files
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from .printrun.printcore import printcore
+from .printrun.asyncprintcore import asyncprintcore
+from .printrun.eventdispatch import EventDispatcher
 from .printrun import gcoder
+from .printrun.arcfit import buffer_lines, check_fit, fit_arcs
+from .printrun import responses
+from .printrun.gcodefile import GCodeSpool, MappedGCode, map_file #To write the g-code output.
+from .printrun.jobcache import JobCache
+from .printrun.motionplanner import MachineLimits
+from .printrun.printmetrics import MetricsLog
+from .printrun.telemetry import TimeSeries
 del sys.path[-1]
 
 if TYPE_CHECKING:
+    import mmap
     from UM.FileHandler.FileHandler import FileHandler
     from UM.Scene.SceneNode import SceneNode
 
 catalog = i18nCatalog("cura")
 
+##  Smallest change of a measured temperature which is published to the printer model, in degrees.
+TEMPERATURE_RESOLUTION = 0.5
+##  Interval at which the temperature history is published to the monitor, in seconds.
+TEMPERATURE_HISTORY_INTERVAL = 10
+
+##  Interval at which the health of a running print is written to the metrics log, in seconds.
+METRICS_LOG_INTERVAL = 10
+
+NAN = float("nan")
+
+##  Event dispatcher shared by the printers which are served by the shared event loop, see _createPrintcore().
+_shared_dispatcher = None  # type: Optional[EventDispatcher]
+
 
 class SerialOutputDevice(PrinterOutputDevice):
+    temperatureHistoryChanged = pyqtSignal()
+
     def __init__(self, serial_port: str) -> None:
         super().__init__(serial_port, connection_type = ConnectionType.UsbConnection)
         self.setName(catalog.i18nc("@item:inmenu", "Serial printing"))
@@ -60,20 +86,36 @@ class SerialOutputDevice(PrinterOutputDevice):
         self._baud_rate = 0
         self._auto_connect = False
 
-        self._serial = printcore() # because no port and baudrate is specified, the port is not opened at this point
-        self._serial.port = serial_port
-        self._serial.addEventHandler(_PrintCoreEventHandler(self))
+        # By default the serial ports of all printers are served by one shared event loop, rather than by threads
+        # of their own; that needs the file descriptors of the ports, which only POSIX systems have
+        self._threaded_io = os.name != "posix"
+        self._serial = self._createPrintcore()
 
         self._firmware_name = ""
         self._firmware_capabilities = {}  # type: Dict[str, bool]
+        # Motion limits reported by the printer, to estimate print times with
+        self._motion_limits = None  # type: Optional[MachineLimits]
 
         self._is_printing = False  # A print is being sent.
 
         ## Set when print is started in order to check running time.
         self._print_start_time = None  # type: Optional[float]
         self._print_estimated_time = None  # type: Optional[int]
+        self._print_job_name = ""
+        self._gcode_lines = None  # type: Optional[gcoder.GCode]
         self._line_count = 0
 
+        # Runs of G1 moves are merged into G2/G3 arcs within this tolerance in mm when the firmware supports arcs, if set
+        self._arc_tolerance = None  # type: Optional[float]
+        # The job which is being prepared in a thread, until its print starts
+        self._preparing_job = None  # type: Optional[object]
+
+        # Prepared jobs by g-code hash, so printing the same g-code again skips the analysis
+        self._job_cache = JobCache(os.path.join(Resources.getCacheStoragePath(), "serial_connection_jobs"))
+
+        # Writes the metrics of printcore to a file while printing, one file per port
+        self._metrics_log = None  # type: Optional[MetricsLog]
+
         self._accepts_commands = False
 
         self.setConnectionText(catalog.i18nc("@info:status", "Connected via Serial Port"))
@@ -87,11 +129,50 @@ class SerialOutputDevice(PrinterOutputDevice):
         self._awaiting_M105_response = False
         self._last_temperature_line_received = 0
 
+        # Temperatures reported by the printer, as actual and target per extruder followed by the bed
+        self._temperature_history = None  # type: Optional[TimeSeries]
+        # Temperatures are reported from the event thread, but only published to the printer model from the Qt thread
+        # when they have changed noticeably
+        self._pending_temperatures = []  # type: List[float]
+        self._published_temperatures = []  # type: List[float]
+        self._temperature_update_scheduled = False
+        self._temperature_history_published = 0.0
+
         self._poll_temperature_timer = QTimer()
         self._poll_temperature_timer.setInterval(2000)
         self._poll_temperature_timer.setSingleShot(False)
         self._poll_temperature_timer.timeout.connect(self._onPollTemperatureTimer)
 
+        # The print thread only counts the lines it sends; the progress is published to the print job from the Qt
+        # thread at this interval
+        self._progress_timer = QTimer()
+        self._progress_timer.setInterval(500)
+        self._progress_timer.setSingleShot(False)
+        self._progress_timer.timeout.connect(self._onProgressTimer)
+
+    ##  Create the printcore instance which talks to the printer.
+    #
+    #   No port and baudrate are passed, so the port is not opened at this point.
+    def _createPrintcore(self) -> printcore:
+        serial = printcore() if self._threaded_io else asyncprintcore()
+        serial.port = self._address
+        if self._baud_rate:
+            serial.baud = self._baud_rate
+        # Prepared jobs carry checkpoints of the machine state, which pausing the print works its position out from,
+        # so the lines of the print do not have to be analysed again while they are sent
+        serial.analyze_print = False
+        # The event handler is called from a thread of its own, so handling the events does not hold up the serial
+        # connection. Printers on the shared event loop also share that thread.
+        if self._threaded_io:
+            serial.dispatcher = EventDispatcher()
+        else:
+            global _shared_dispatcher
+            if _shared_dispatcher is None:
+                _shared_dispatcher = EventDispatcher()
+            serial.dispatcher = _shared_dispatcher
+        serial.addEventHandler(_PrintCoreEventHandler(self))
+        return serial
+
     def _onGlobalContainerStackChanged(self) -> None:
         container_stack = CuraApplication.getInstance().getGlobalContainerStack()
         num_extruders = container_stack.getProperty("machine_extruder_count", "value")
@@ -101,6 +182,33 @@ class SerialOutputDevice(PrinterOutputDevice):
         self._printers = [PrinterOutputModel(output_controller = controller, number_of_extruders = num_extruders)]
         self._printers[0].updateName(container_stack.getName())
 
+        self._published_temperatures = []
+        columns = []  # type: List[str]
+        for heater in ["T%d" % extruder_nr for extruder_nr in range(num_extruders)] + ["bed"]:
+            columns.extend((heater, heater + " target"))
+        if self._temperature_history is None or self._temperature_history.columns != tuple(columns):
+            self._temperature_history = TimeSeries(columns)
+
+        # The motion limits are stored per printer, so the print time can be estimated before the printer reports them
+        if container_stack.getMetaDataEntry("serial_port") == self._address:
+            self._motion_limits = None
+            motion_limits = container_stack.getMetaDataEntry("serial_motion_limits")
+            if motion_limits:
+                try:
+                    self._motion_limits = MachineLimits.from_json(motion_limits)
+                except (ValueError, TypeError, AttributeError) as e:
+                    Logger.log("w", "Ignoring invalid motion limits of %s: %s", container_stack.getName(), str(e))
+            progress_interval = container_stack.getMetaDataEntry("serial_progress_interval")
+            if progress_interval:
+                self.setProgressInterval(int(progress_interval))
+            self._arc_tolerance = None
+            arc_tolerance = container_stack.getMetaDataEntry("serial_arc_tolerance")
+            if arc_tolerance:
+                try:
+                    self._arc_tolerance = float(arc_tolerance) if float(arc_tolerance) > 0 else None
+                except ValueError:
+                    Logger.log("w", "Ignoring invalid arc tolerance of %s: %s", container_stack.getName(), arc_tolerance)
+
     # This is a callback function that checks if there is any printing in progress via USB when the application tries
     # to exit. If so, it will show a confirmation before
     def _checkActivePrintingUponAppExit(self) -> None:
@@ -128,8 +236,7 @@ class SerialOutputDevice(PrinterOutputDevice):
     def requestWrite(self, nodes: List["SceneNode"], file_name: Optional[str] = None, limit_mimetypes: bool = False,
                      file_handler: Optional["FileHandler"] = None, filter_by_machine: bool = False, **kwargs) -> None:
         if self._is_printing:
-            message = Message(text = catalog.i18nc("@message", "A print is still in progress. Cura cannot start another print via USB until the previous print has completed."), title = catalog.i18nc("@message", "Print in Progress"))
-            message.show()
+            self._showPrintInProgressMessage()
             return  # Already printing
 
         self.writeStarted.emit(self)
@@ -140,24 +247,162 @@ class SerialOutputDevice(PrinterOutputDevice):
         CuraApplication.getInstance().getController().setActiveStage("MonitorStage")
 
         #Find the g-code to print.
-        gcode_textio = StringIO()
+        # The g-code is spooled to a temporary file and read back line by line, so the job is never held as one string
+        gcode_spool = GCodeSpool()
         gcode_writer = cast(MeshWriter, PluginRegistry.getInstance().getPluginObject("GCodeWriter"))
-        success = gcode_writer.write(gcode_textio, None)
+        success = gcode_writer.write(gcode_spool, None)
         if not success:
+            gcode_spool.close()
             return
 
-        gcode = gcode_textio.getvalue()
+        # The lines are read from the spooled file when they are sent instead of being kept in memory.
+        gcode_data = gcode_spool.map()
+        gcode_hash = gcode_spool.hexdigest()
+        gcode_spool.close()
+
+        print_information = CuraApplication.getInstance().getPrintInformation()
+        estimated_time = int(print_information.currentPrintTime.getDisplayString(DurationFormat.Format.Seconds))
+        self._printGCode(gcode_data, gcode_hash, print_information.jobName, estimated_time)
+
+        self.writeFinished.emit(self)
+
+    ##  Print a g-code file from disk, without going through the scene and the g-code writer.
+    #
+    #   The file is memory-mapped, so it is never read into memory as a whole.
+    #   \param file_path The path of the g-code file to print.
+    @pyqtSlot(str)
+    def printFile(self, file_path: str) -> None:
+        if self._is_printing:
+            self._showPrintInProgressMessage()
+            return  # Already printing
 
-        gcode_lines = gcode.split("\n")
-        gcode_lines = gcoder.LightGCode(gcode_lines)
-        self._line_count = len(gcode_lines)
+        controller = cast(GenericOutputController, self._printers[0].getController())
+        controller.stopPreheatTimers()
+
+        try:
+            gcode_data = map_file(file_path)
+        except EnvironmentError as e:
+            Logger.log("e", "Could not read g-code file %s: %s", file_path, str(e))
+            return
+
+        # The estimated time is taken from the g-code once it has been analysed
+        job_name = os.path.splitext(os.path.basename(file_path))[0]
+        self._printGCode(gcode_data, None, job_name, None)
+
+    ##  Prepare g-code for printing in a thread of its own, after which the print is started from the Qt thread.
+    #
+    #   Hashing the g-code, fitting arcs to it and loading it from the job cache all read the whole job, so none of
+    #   them run on the Qt thread.
+    #   \param gcode_hash The SHA-256 hash of the g-code, or None to compute it while preparing.
+    def _printGCode(self, gcode_data: Union[bytes, "mmap.mmap"], gcode_hash: Optional[str], job_name: str, estimated_time: Optional[int]) -> None:
+        arc_tolerance = self._arc_tolerance if self._firmware_capabilities.get("ARCS", False) else None
+
+        job = object()
+        self._preparing_job = job
+        self._is_printing = True  # No other print can be started meanwhile
+        thread = threading.Thread(target = self._prepareJob,
+                                  args = (job, gcode_data, gcode_hash, job_name, estimated_time, arc_tolerance, self._motion_limits),
+                                  name = "print preparation")
+        thread.daemon = True
+        thread.start()
+
+    def _prepareJob(self, job: object, gcode_data: Union[bytes, "mmap.mmap"], gcode_hash: Optional[str], job_name: str,
+                    estimated_time: Optional[int], arc_tolerance: Optional[float], motion_limits: Optional[MachineLimits]) -> None:
+        try:
+            if gcode_hash is None:
+                gcode_hash = hashlib.sha256(gcode_data).hexdigest()
+            if arc_tolerance is not None:
+                gcode_data, gcode_hash = self._fitArcs(gcode_data, gcode_hash, job_name, arc_tolerance)
+            gcode_lines = self._prepareGCode(gcode_data, gcode_hash, motion_limits)
+        except Exception as e:
+            Logger.log("e", "Could not prepare %s for printing: %s", job_name, str(e))
+            CuraApplication.getInstance().callLater(self._onPrepareFailed, job)
+            return
+        CuraApplication.getInstance().callLater(self._startPreparedPrint, job, gcode_lines, job_name, estimated_time)
+
+    ##  Give up on a job which could not be prepared, so another print can be started.
+    def _onPrepareFailed(self, job: object) -> None:
+        if job is not self._preparing_job:
+            return  # The print was cancelled while it was prepared
+        self._preparing_job = None
+        self._is_printing = False
+        self.writeError.emit(self)
+
+    ##  Merge the runs of G1 moves of the g-code into arcs and check the result against the original toolpath.
+    #
+    #   \return The fitted g-code and its hash, or the original g-code and hash if the check fails.
+    def _fitArcs(self, gcode_data: Union[bytes, "mmap.mmap"], gcode_hash: str, job_name: str, tolerance: float) -> Tuple[Union[bytes, "mmap.mmap"], str]:
+        fitted_spool = GCodeSpool()
+        try:
+            stats = fit_arcs(buffer_lines(gcode_data), fitted_spool, tolerance)
+            fitted_data = fitted_spool.map()
+            deviation = check_fit(buffer_lines(gcode_data), buffer_lines(fitted_data), tolerance)
+            Logger.log("i", "Fitted arcs to %s: %s, off by at most %.4f mm", job_name, str(stats), deviation)
+            return fitted_data, fitted_spool.hexdigest()
+        except Exception as e:
+            Logger.log("w", "Printing %s without fitting arcs, fitting them failed: %s", job_name, str(e))
+            return gcode_data, gcode_hash
+        finally:
+            fitted_spool.close()
+
+    ##  Get the prepared job for the g-code from the cache, or start analysing it in the background.
+    #
+    #   When the g-code is analysed the print can start as soon as its first layer is ready; the result is added to the
+    #   cache when the analysis is complete.
+    #   \param gcode_data The g-code as a buffer.
+    #   \param gcode_hash The SHA-256 hash of the g-code.
+    #   \param motion_limits The motion limits of the printer the durations are planned with, if known.
+    #   \return The g-code, which may still be analysed.
+    def _prepareGCode(self, gcode_data: Union[bytes, "mmap.mmap"], gcode_hash: str, motion_limits: Optional[MachineLimits]) -> MappedGCode:
+        # The planned durations depend on the motion limits
+        cache_key = gcode_hash if motion_limits is None else "%s-%s" % (gcode_hash, motion_limits.fingerprint())
+        gcode_lines = self._job_cache.load_gcode(cache_key, gcode_data)
+        if gcode_lines is None:
+            gcode_lines = MappedGCode(gcode_data, background = True, motion_limits = motion_limits)
+            self._job_cache.store_gcode(cache_key, gcode_lines)
+        Logger.log("d", "Job cache: %d hits, %d misses", self._job_cache.hits, self._job_cache.misses)
+        return gcode_lines
+
+    def _startPreparedPrint(self, job: object, gcode_lines: MappedGCode, job_name: str, estimated_time: Optional[int]) -> None:
+        if job is not self._preparing_job:
+            return  # The print was cancelled while it was prepared
+        self._preparing_job = None
+        self._startPrint(gcode_lines, job_name, estimated_time)
+
+    def _startPrint(self, gcode_lines: gcoder.GCode, job_name: str, estimated_time: Optional[int]) -> None:
+        self._gcode_lines = gcode_lines
+        self._line_count = 0  # Known when the analysis of the g-code is complete
+        self._print_job_name = job_name
         self._serial.startprint(gcode_lines) # this will start a print
 
         self._print_start_time = time()
-        self._print_estimated_time = int(CuraApplication.getInstance().getPrintInformation().currentPrintTime.getDisplayString(DurationFormat.Format.Seconds))
+        self._print_estimated_time = estimated_time
 
         self._is_printing = True
-        self.writeFinished.emit(self)
+        self._progress_timer.start()
+        self._startMetricsLog()
+
+    ##  Start writing the metrics of the print to the log file of the port, in the data storage of Cura.
+    def _startMetricsLog(self) -> None:
+        self._stopMetricsLog()
+        log_dir = os.path.join(Resources.getDataStoragePath(), "serial_connection_metrics")
+        try:
+            os.makedirs(log_dir, exist_ok = True)
+        except OSError as e:
+            Logger.log("w", "Could not create the print metrics directory %s: %s", log_dir, str(e))
+            return
+        file_name = "".join(c if c.isalnum() else "_" for c in self._address) + ".jsonl"
+        self._metrics_log = MetricsLog(self._serial.metrics, os.path.join(log_dir, file_name), METRICS_LOG_INTERVAL)
+        self._metrics_log.start()
+
+    def _stopMetricsLog(self) -> None:
+        if self._metrics_log is not None:
+            self._metrics_log.stop()
+            self._metrics_log = None
+
+    def _showPrintInProgressMessage(self) -> None:
+        message = Message(text = catalog.i18nc("@message", "A print is still in progress. Cura cannot start another print via USB until the previous print has completed."), title = catalog.i18nc("@message", "Print in Progress"))
+        message.show()
 
     def connect(self) -> None:
         self._firmware_name = ""  # after each connection ensure that the firmware name is removed
@@ -178,6 +423,8 @@ class SerialOutputDevice(PrinterOutputDevice):
     def close(self) -> None:
         super().close()
         self._poll_temperature_timer.stop()
+        self._progress_timer.stop()
+        self._stopMetricsLog()
 
     def setBaudRate(self, baud_rate: int) -> None:
         if not self.isOnline():
@@ -187,6 +434,28 @@ class SerialOutputDevice(PrinterOutputDevice):
     def baudRate(self) -> int:
         return self._baud_rate
 
+    ##  Set whether the port is served by threads of its own instead of by the event loop shared by all printers.
+    #
+    #   It can only be changed while the port is closed.
+    def setThreadedIO(self, threaded: bool) -> None:
+        threaded = threaded or os.name != "posix"
+        if threaded == self._threaded_io or self.isOnline() or self._serial.printer:
+            return
+        if self._threaded_io:
+            self._serial.dispatcher.stop()
+        self._threaded_io = threaded
+        self._serial = self._createPrintcore()
+
+    def threadedIO(self) -> bool:
+        return self._threaded_io
+
+    ##  Set how often the progress of a print is published, in milliseconds.
+    def setProgressInterval(self, interval: int) -> None:
+        self._progress_timer.setInterval(interval)
+
+    def progressInterval(self) -> int:
+        return self._progress_timer.interval()
+
     def setAutoConnect(self, auto_connect: bool) -> None:
         self._auto_connect = auto_connect
         if self._auto_connect:
@@ -220,26 +489,44 @@ class SerialOutputDevice(PrinterOutputDevice):
         self._serial.send_now(new_command)
         Logger.log("d", "Send gcode command to serial port: %s", new_command)
 
-    def _setFirmwareName(self, line) -> None:
-        name = re.findall(r"FIRMWARE_NAME:(.*);", line)
-        if  name:
-            self._firmware_name = name[0]
+    def _setFirmwareName(self, response: responses.Response) -> None:
+        if response.firmware_name:
+            self._firmware_name = response.firmware_name
             Logger.log("i", "USB output device Firmware name: %s", self._firmware_name)
         else:
             self._firmware_name = "Unknown"
-            Logger.log("i", "Unknown USB output device firmware name: %s", line)
+            Logger.log("i", "Unknown USB output device firmware name: %s", str(response).strip())
 
     def getFirmwareName(self) -> str:
         return self._firmware_name
 
-    def _registerFirmwareCapability(self, line: str) -> None:
-        capabilities = re.findall(r"Cap:(.*\:[01])", line)
-        if capabilities:
-            for capability in capabilities:
-                bits = capability.split(":")
-                self._firmware_capabilities[bits[0]] = True if bits[1] == "1" else False
+    def _registerFirmwareCapability(self, response: responses.Response) -> None:
+        if response.capability is not None:
+            self._firmware_capabilities[response.capability] = response.enabled
         else:
-            Logger.log("i", "Unparseable firmware capability: %s", line)
+            Logger.log("i", "Unparseable firmware capability: %s", str(response).strip())
+
+    ##  Update the motion limits from a line of the settings report of the printer.
+    #
+    #   \return Whether the line reported motion limits.
+    def _parseMotionLimits(self, line: str) -> bool:
+        motion_limits = self._motion_limits.copy() if self._motion_limits is not None else MachineLimits()
+        if not motion_limits.parse(line):
+            return False
+        if motion_limits != self._motion_limits:
+            # Jobs which are being analysed keep the limits they were started with
+            self._motion_limits = motion_limits
+            CuraApplication.getInstance().callLater(self._storeMotionLimits)
+        return True
+
+    def _storeMotionLimits(self) -> None:
+        container_stack = CuraApplication.getInstance().getGlobalContainerStack()
+        if container_stack is None or self._motion_limits is None:
+            return
+        if container_stack.getMetaDataEntry("serial_port") != self._address:
+            return
+        container_stack.setMetaDataEntry("serial_motion_limits", self._motion_limits.to_json())
+        Logger.log("d", "Stored motion limits of %s: %s", container_stack.getName(), self._motion_limits.to_json())
 
     def pausePrint(self) -> None:
         self._serial.pause()
@@ -248,6 +535,10 @@ class SerialOutputDevice(PrinterOutputDevice):
         self._serial.resume()
 
     def cancelPrint(self) -> None:
+        if self._preparing_job is not None:
+            self._preparing_job = None
+            self._is_printing = False
+            return
         self._serial.cancelprint() # this also calls the ended callback
 
     ## Check if temperature info is stale
@@ -277,75 +568,162 @@ class SerialOutputDevice(PrinterOutputDevice):
     def onPrinterOnline(self) -> None:
         self.setConnectionState(ConnectionState.Connected)
         self.sendCommand("M115") # request firmware name and capabilities
+        self.sendCommand("M503") # request settings, including the motion limits
         self._setAcceptsCommands(True)
 
     def onPrinterOffline(self) -> None:
         self._setAcceptsCommands(False)
 
+    ##  Act on a line received from the printer.
+    #
+    #   printcore hands out the lines as responses.Response, which already know what kind of line they are.
     def onLineReceived(self, line: str) -> None:
-        if line.startswith('!!'):
+        # The printrun modules imported by printcore may be other copies than the ones imported here
+        response = line if hasattr(line, "kind") else responses.classify(line)  # type: responses.Response
+        kind = response.kind
+
+        if response.fatal:
             Logger.log('e', "Printer signals fatal error. Cancelling print. Printer response: {}".format(line))
+            print_job = self._printers[0].activePrintJob
             self.cancelPrint()
-            print_job.updateState("error")
-            return
-
-        if "FIRMWARE_NAME:" in line:
-            self._setFirmwareName(line)
-            return
-
-        if "Cap:" in line:
-            self._registerFirmwareCapability(line)
+            if print_job is not None:
+                print_job.updateState("error")
             return
 
-        if " T:" in line or " B:" in line:
-            self._parseTemperatures(line)
-
-        if line.startswith("ok"):
-            pass
+        if kind == responses.FIRMWARE_INFO:
+            self._setFirmwareName(response)
+        elif kind == responses.CAPABILITY:
+            self._registerFirmwareCapability(response)
+        elif kind == responses.OK_TEMPS or kind == responses.TEMPERATURE:
+            self._parseTemperatures(response)
+        elif (kind == responses.ECHO or kind == responses.OTHER) and "M20" in line:
+            self._parseMotionLimits(line)
 
-    def _parseTemperatures(self, line: str) -> None:
-        self._last_temperature_line_received = time()
-        if line.startswith("ok"):
+    ##  Record the temperatures reported by the printer, and have them published if they changed.
+    #
+    #   This is called from the event thread of printcore.
+    def _parseTemperatures(self, response: responses.Response) -> None:
+        now = time()
+        self._last_temperature_line_received = now
+        if response.kind == responses.OK_TEMPS:
             self._awaiting_M105_response = False  # this must be in response to an M105 command
 
-        extruder_temperature_matches = re.findall("T(\d*): ?(\d+\.?\d*)\s*\/?(\d+\.?\d*)?", line)
-        # Update all temperature values
-        matched_extruder_nrs = []
-        for match in extruder_temperature_matches:
-            extruder_nr = 0
-            if match[0] != "":
-                extruder_nr = int(match[0])
-
-            if extruder_nr in matched_extruder_nrs:
-                continue
-            matched_extruder_nrs.append(extruder_nr)
-
-            if extruder_nr >= len(self._printers[0].extruders):
-                Logger.log("w", "Printer reports more temperatures than the number of configured extruders")
+        extruder_count = len(self._printers[0].extruders)
+        if any(extruder_nr >= extruder_count for extruder_nr in response.hotends):
+            Logger.log("w", "Printer reports more temperatures than the number of configured extruders")
+        heaters = [response.hotends.get(extruder_nr, (NAN, None)) for extruder_nr in range(extruder_count)]
+        heaters.append(response.bed or (NAN, None))
+        temperatures = []  # type: List[float]
+        for current, target in heaters:
+            temperatures.extend((current, target if target is not None else NAN))
+
+        history = self._temperature_history
+        if history is not None and len(history.columns) == len(temperatures):
+            history.add(now, temperatures)
+
+        self._pending_temperatures = temperatures
+        if self._temperature_update_scheduled:
+            return
+        if self._temperaturesChanged(temperatures, self._published_temperatures) or now - self._temperature_history_published >= TEMPERATURE_HISTORY_INTERVAL:
+            self._temperature_update_scheduled = True
+            CuraApplication.getInstance().callLater(self._updateTemperatures)
+
+    ##  Whether reported temperatures differ noticeably from the ones which were published.
+    @staticmethod
+    def _temperaturesChanged(temperatures: List[float], published: List[float]) -> bool:
+        if len(temperatures) != len(published):
+            return True
+        for index, (value, published_value) in enumerate(zip(temperatures, published)):
+            if value != value:  # not reported
                 continue
+            if published_value != published_value:
+                return True
+            if index % 2:  # targets are set, so every change is published
+                if value != published_value:
+                    return True
+            elif abs(value - published_value) >= TEMPERATURE_RESOLUTION:
+                return True
+        return False
+
+    ##  Publish the last reported temperatures to the printer model, and the history to the monitor.
+    def _updateTemperatures(self) -> None:
+        self._temperature_update_scheduled = False
+        temperatures = self._pending_temperatures
+        published = self._published_temperatures
+        if len(published) != len(temperatures):
+            published = [NAN] * len(temperatures)
+        else:
+            published = list(published)
+
+        printer = self._printers[0]
+        heaters = [(extruder.updateHotendTemperature, extruder.updateTargetHotendTemperature) for extruder in printer.extruders]
+        heaters.append((printer.updateBedTemperature, printer.updateTargetBedTemperature))
+        if len(temperatures) != 2 * len(heaters):
+            return  # reported for another printer model
+        for index, (update_current, update_target) in enumerate(heaters):
+            current = temperatures[2 * index]
+            target = temperatures[2 * index + 1]
+            if current == current and not (abs(current - published[2 * index]) < TEMPERATURE_RESOLUTION):
+                update_current(current)
+                published[2 * index] = current
+            if target == target and target != published[2 * index + 1]:
+                update_target(target)
+                published[2 * index + 1] = target
+        self._published_temperatures = published
+
+        now = time()
+        if now - self._temperature_history_published >= TEMPERATURE_HISTORY_INTERVAL:
+            self._temperature_history_published = now
+            self.temperatureHistoryChanged.emit()
+
+    ##  Get the temperatures reported in the last seconds, for the monitor to plot.
+    #
+    #   \return A map with the time of the request ("now"), the times of the samples ("times") and per heater its name,
+    #   actual and target temperatures ("series"). Temperatures which were not reported are NaN.
+    @pyqtSlot(int, result = "QVariantMap")
+    def temperatureHistory(self, seconds: int) -> Dict[str, Any]:
+        now = time()
+        history = self._temperature_history
+        if history is None:
+            return {"now": now, "times": [], "series": []}
+        times, columns = history.samples(since = now - seconds)
+        series = []
+        for index in range(0, len(columns), 2):
+            series.append({"name": history.columns[index], "actual": columns[index], "target": columns[index + 1]})
+        return {"now": now, "times": times, "series": series}
+
+    ##  Get the health of the running print, or of the last one: ok round trips, send rate, time spent waiting for the
+    #   printer, resends, write failures and planner starvation. See printmetrics.PrintMetrics.snapshot().
+    @pyqtSlot(result = "QVariantMap")
+    def printMetrics(self) -> Dict[str, Any]:
+        return self._serial.metrics.snapshot()
+
+    ##  Publish the progress of the print to the print job, coalescing the lines sent since the last time.
+    def _onProgressTimer(self) -> None:
+        if not self._is_printing or not self._serial.printing:
+            # Nothing is sent while the print is paused or ending
+            return
 
-            extruder = self._printers[0].extruders[extruder_nr]
-            if match[1]:
-                extruder.updateHotendTemperature(float(match[1]))
-            if match[2]:
-                extruder.updateTargetHotendTemperature(float(match[2]))
-
-        bed_temperature_matches = re.findall("B: ?(\d+\.?\d*)\s*\/?(\d+\.?\d*)?", line)
-        if bed_temperature_matches:
-            match = bed_temperature_matches[0]
-            if match[0]:
-                self._printers[0].updateBedTemperature(float(match[0]))
-            if match[1]:
-                self._printers[0].updateTargetBedTemperature(float(match[1]))
-
-    def onPrintProgress(self, gline) -> None:
         print_job = self._printers[0].activePrintJob
         if print_job is None:
             controller = cast(GenericOutputController, self._printers[0].getController())
-            print_job = PrintJobOutputModel(output_controller=controller, name=CuraApplication.getInstance().getPrintInformation().jobName)
+            print_job = PrintJobOutputModel(output_controller=controller, name=self._print_job_name)
             print_job.updateState("printing")
             self._printers[0].updateActivePrintJob(print_job)
 
+        elapsed_time = int(time() - self._print_start_time)
+        print_job.updateTimeElapsed(elapsed_time)
+
+        gcode_lines = self._gcode_lines
+        if gcode_lines is None or not gcode_lines.prepared:
+            # The g-code is still being analysed, so the progress is not known yet
+            return
+        if not self._line_count:
+            self._line_count = len(gcode_lines)
+            # Planned with the limits of the printer, the duration of the g-code is more accurate than the slicer estimate
+            if gcode_lines.duration is not None and (self._print_estimated_time is None or gcode_lines.motion_limits is not None):
+                self._print_estimated_time = int(gcode_lines.duration.total_seconds())
+
         line_number = self._serial.lineno
         try:
             progress = line_number / self._line_count
@@ -355,17 +733,21 @@ class SerialOutputDevice(PrinterOutputDevice):
                 print_job.updateState("error")
             return
 
-        elapsed_time = int(time() - self._print_start_time)
-
-        print_job.updateTimeElapsed(elapsed_time)
         estimated_time = self._print_estimated_time
+        if estimated_time is None:
+            return
         if progress > .1:
             estimated_time = self._print_estimated_time * (1 - progress) + elapsed_time
         print_job.updateTimeTotal(estimated_time)
 
     def onPrintEnded(self) -> None:
+        self._progress_timer.stop()
+        Logger.log("d", "Print events: %s", self._serial.dispatcher.stats())
+        self._stopMetricsLog()
+        Logger.log("d", "Print metrics: %s", self._serial.metrics.snapshot())
         self._printers[0].updateActivePrintJob(None)
         self._is_printing = False
+        self._gcode_lines = None
 
         # Turn off temperatures, fan and steppers
         self._sendCommand("M140 S0")
@@ -410,7 +792,8 @@ class _PrintCoreEventHandler():
         pass
 
     def on_end(self) -> None:
-        self._device.onPrintEnded()
+        # Called from the print thread, while the models have to be updated from the Qt thread
+        CuraApplication.getInstance().callLater(self._device.onPrintEnded)
 
     def on_layerchange(self, layer) -> None:
         pass
@@ -419,7 +802,8 @@ class _PrintCoreEventHandler():
         pass
 
     def on_printsend(self, gline) -> None:
-        self._device.onPrintProgress(gline)
+        # printcore counts the lines sent, which the progress timer of the device reads
+        pass
 
     def on_send(self, command, gline) -> None:
         pass
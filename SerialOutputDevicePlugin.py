@@ -10,15 +10,43 @@ from UM.PluginError import PluginNotFoundError
 from UM.Util import parseBool
 
 from . import SerialOutputDevice
+from .SerialPortWatcher import SerialPortWatcher, stablePaths
 
+import os
 import time
 import threading
-import serial
+import serial.tools.list_ports
+from collections import namedtuple
 
-from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+from typing import Any, Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
 if TYPE_CHECKING:
     from cura.PrinterOutput.PrinterOutputModel import PrinterOutputModel
 
+##  Interval at which the serial ports are listed when they cannot be watched, in seconds.
+POLL_INTERVAL = 5
+##  Interval at which the serial ports are listed while they are watched, in case a change was missed, in seconds.
+WATCHED_POLL_INTERVAL = 60
+
+##  A serial port found on the system.
+#
+#   port is the name the port is known by: its link in /dev/serial/by-id where it has one (by_id), its device name
+#   otherwise. baud_rate is the last rate a printer was connected to the port with, 0 if it is not known.
+SerialPort = namedtuple("SerialPort", ["port", "device", "description", "hwid", "by_id", "baud_rate"])
+
+
+##  The serial ports found on the system at one time.
+#
+#   Snapshots are not changed once they are made, so they can be handed out to any thread; a new snapshot with the
+#   next version replaces it when the ports change.
+class SerialPortSnapshot:
+    def __init__(self, version: int = 0, ports: Tuple[SerialPort, ...] = ()) -> None:
+        self.version = version
+        self.ports = ports
+        self.names = tuple(port.port for port in ports)
+        # The ports as QVariantMaps, for QML
+        self.entries = [dict(port._asdict()) for port in ports]  # type: List[Dict[str, Any]]
+
+
 ##      This plugin handles the connection detection & creation of output device objects for Serial-connected printers.
 #       If we see a port that should be connected to the active machine instance a connection is made.
 @signalemitter
@@ -40,6 +68,11 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
         self._instances = {} # type: Dict[str, SerialOutputDevice.SerialOutputDevice]
         self._serial_port_list = [] # type: List[str]
 
+        # Ports found by the discovery thread; replaced as a whole, so it can be read from any thread without a lock
+        self._port_snapshot = SerialPortSnapshot()
+        self._port_snapshot_lock = threading.Lock()
+        self._baud_rates = {}  # type: Dict[str, int]
+
         # Because the model needs to be created in the same thread as the QMLEngine, we use a signal.
         self.addInstanceSignal.connect(self._onAddInstance)
         self.removeInstanceSignal.connect(self._onRemoveInstance)
@@ -48,6 +81,7 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
         self._discovery_thread = threading.Thread(target = self._discoveryThread)
         self._discovery_thread.setDaemon(True)
         self._perform_discovery = True
+        self._port_watcher = None  # type: Optional[SerialPortWatcher]
 
         application.pluginsLoaded.connect(self._onPluginsLoaded)
         application.applicationShuttingDown.connect(self._onApplicationShuttingDown)
@@ -60,17 +94,66 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
     ##  Called by OutputDeviceManager to indicate the plugin should stop its device detection.
     def stop(self) -> None:
         self._perform_discovery = False
+        if self._port_watcher:
+            self._port_watcher.interrupt()
 
-    ##  Get the list of serial ports on the system.
+    ##  Get the list of serial ports on the system, as last found by the discovery thread.
     def getSerialPortList(self) -> List[str]:
+        return list(self._port_snapshot.names)
+
+    ##  Get the serial ports on the system, as last found by the discovery thread.
+    def getSerialPortSnapshot(self) -> SerialPortSnapshot:
+        return self._port_snapshot
+
+    ##  List the serial ports on the system.
+    #
+    #   Ports are listed by their link in /dev/serial/by-id where there is one, so a printer keeps its port when it is
+    #   plugged in again and gets another device name.
+    def _listSerialPorts(self) -> Tuple[SerialPort, ...]:
+        stable_paths = stablePaths()
         result = []
         for port in serial.tools.list_ports.comports():
             if not isinstance(port, tuple):
                 port = (port.device, port.description, port.hwid)
 
-            result.append(port[0])
-
-        return result
+            by_id = stable_paths.get(os.path.realpath(port[0]), "")
+            result.append(SerialPort(by_id or port[0], port[0], port[1], port[2], by_id, 0))
+
+        return tuple(result)
+
+    ##  Replace the snapshot of the serial ports if they changed.
+    #
+    #   \param ports The ports found, or None to only update the baud rates of the ports in the snapshot.
+    def _updatePortSnapshot(self, ports: Optional[Tuple[SerialPort, ...]] = None) -> None:
+        with self._port_snapshot_lock:
+            snapshot = self._port_snapshot
+            if ports is None:
+                ports = snapshot.ports
+            ports = tuple(port._replace(baud_rate = self._baud_rates.get(port.port, 0)) for port in ports)
+            if ports == snapshot.ports:
+                return
+            self._port_snapshot = SerialPortSnapshot(snapshot.version + 1, ports)
+        self.serialPortsChanged.emit()
+
+    ##  Remember the baud rate a printer is connected to a port with, for the snapshot of the serial ports.
+    def setPortBaudRate(self, port: str, baud_rate: Any) -> None:
+        try:
+            baud_rate = int(baud_rate)
+        except (TypeError, ValueError):
+            return
+        if self._baud_rates.get(port) != baud_rate:
+            self._baud_rates[port] = baud_rate
+            self._updatePortSnapshot()
+
+    ##  Check whether the port of an instance is the port stored for a printer.
+    #
+    #   Ports stored by their device name before they were listed by a stable path still match the stable path of
+    #   that device, as long as it has the same device name.
+    @staticmethod
+    def _isSamePort(key: str, stored_port: Optional[str]) -> bool:
+        if not stored_port:
+            return False
+        return key == stored_port or os.path.realpath(key) == stored_port
 
     def _onApplicationShuttingDown(self) -> None:
         ## TODO: investigate why this is necessary
@@ -95,9 +178,18 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
         # This thread exits immediately because we don't want the USBPrinting plugin to find any ports
 
     ## Thread-function to detect serial ports
+    #
+    #   Ports are listed again as soon as devices are added or removed where that can be watched, and polled for
+    #   otherwise.
     def _discoveryThread(self) -> None:
+        try:
+            self._port_watcher = SerialPortWatcher()
+        except OSError as e:
+            Logger.log("d", "Serial ports cannot be watched, polling for them instead: %s", str(e))
+
         while self._perform_discovery:
-            port_list = self.getSerialPortList()
+            self._updatePortSnapshot(self._listSerialPorts())
+            port_list = list(self._port_snapshot.names)
 
             # First, find and add all new or changed keys
             for serial_port in port_list:
@@ -107,11 +199,16 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
                 if serial_port not in port_list:
                     self.removeInstanceSignal.emit(serial_port)  # Hack to ensure its created in main thread
 
-            if port_list != self._serial_port_list:
-                self._serial_port_list = port_list
-                self.serialPortsChanged.emit()
+            self._serial_port_list = port_list
 
-            time.sleep(5)
+            if self._port_watcher:
+                self._port_watcher.wait(WATCHED_POLL_INTERVAL)
+            else:
+                time.sleep(POLL_INTERVAL)
+
+        if self._port_watcher:
+            self._port_watcher.close()
+            self._port_watcher = None
 
     ## See if there's an instance that should be connected to the new global stack
     def _onGlobalContainerStackChanged(self) -> None:
@@ -120,10 +217,13 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
             return
 
         for key in self._instances:
-            if key == global_container_stack.getMetaDataEntry("serial_port"):
+            if self._isSamePort(key, global_container_stack.getMetaDataEntry("serial_port")):
+                self._storeStablePort(global_container_stack, key)
                 self._instances[key].connectionStateChanged.connect(self._onInstanceConnectionStateChanged)
+                self.setPortBaudRate(key, global_container_stack.getMetaDataEntry("serial_rate"))
                 if not self._instances[key].isOnline():
                     self._instances[key].setBaudRate(global_container_stack.getMetaDataEntry("serial_rate"))
+                    self._instances[key].setThreadedIO(parseBool(global_container_stack.getMetaDataEntry("serial_threaded_io", False)))
                     self._instances[key].connect()
             else:
                 self._instances[key].connectionStateChanged.disconnect(self._onInstanceConnectionStateChanged)
@@ -133,12 +233,21 @@ class SerialOutputDevicePlugin(OutputDevicePlugin):
         instance = SerialOutputDevice.SerialOutputDevice(serial_port)
         self._instances[instance.getId()] = instance
         global_container_stack = self._application.getGlobalContainerStack()
-        if global_container_stack and instance.getId() == global_container_stack.getMetaDataEntry("serial_port"):
+        if global_container_stack and self._isSamePort(instance.getId(), global_container_stack.getMetaDataEntry("serial_port")):
+            self._storeStablePort(global_container_stack, instance.getId())
+            self.setPortBaudRate(instance.getId(), global_container_stack.getMetaDataEntry("serial_rate"))
             instance.setBaudRate(global_container_stack.getMetaDataEntry("serial_rate"))
+            instance.setThreadedIO(parseBool(global_container_stack.getMetaDataEntry("serial_threaded_io", False)))
             instance.setAutoConnect(parseBool(global_container_stack.getMetaDataEntry("serial_auto_connect")))
             instance.connectionStateChanged.connect(self._onInstanceConnectionStateChanged)
             instance.connect()
 
+    ##  Store the stable path of the port of a printer which was stored by its device name.
+    def _storeStablePort(self, container_stack, key: str) -> None:
+        if container_stack.getMetaDataEntry("serial_port") != key:
+            Logger.log("i", "Storing serial port %s of %s as %s", container_stack.getMetaDataEntry("serial_port"), container_stack.getName(), key)
+            container_stack.setMetaDataEntry("serial_port", key)
+
     def _onRemoveInstance(self, name: str) -> None:
         instance = self._instances.pop(name, None)
         if instance:
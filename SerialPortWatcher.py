@@ -0,0 +1,188 @@
+# Copyright (c) 2019 Aldo Hoeben / fieldOfView
+# SerialConnection is released under the terms of the GPLv3 or higher.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from typing import Dict, Optional
+
+##  Directory with the device nodes
+DEV_PATH = "/dev"
+##  Directory with links to the serial devices, named after the device rather than the order they were plugged in
+BY_ID_PATH = "/dev/serial/by-id"
+
+##  Time without further changes before a change is reported, in seconds.
+#
+#   Plugging in a device creates its node and then, a little later, its links in BY_ID_PATH.
+DEBOUNCE_DELAY = 0.25
+##  Longest time a change is held back while more changes keep coming in, in seconds.
+DEBOUNCE_LIMIT = 2.0
+
+##  Names of the nodes in DEV_PATH which are looked at.
+#
+#   "serial" is the parent directory of BY_ID_PATH, which is only created once a serial device is plugged in.
+_NODE_PREFIXES = ("tty", "rfcomm", "serial")
+
+# Flags of inotify(7)
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_IGNORED = 0x00008000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE_SELF
+
+_event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+##  Get the stable paths of the serial devices.
+#
+#   \param by_id_path Directory with the links to the devices.
+#   \return The path of the link to every device, by the real path of the device.
+def stablePaths(by_id_path: str = BY_ID_PATH) -> Dict[str, str]:
+    result = {}  # type: Dict[str, str]
+    try:
+        names = sorted(os.listdir(by_id_path))
+    except OSError:
+        return result
+    for name in names:
+        path = os.path.join(by_id_path, name)
+        device = os.path.realpath(path)
+        # A device can have more than one link; the first one is used consistently
+        if device != path and device not in result:
+            result[device] = path
+    return result
+
+
+##  Wait for serial devices to be plugged in or removed on Linux, through inotify.
+#
+#   The directory with the device nodes and the directory with links to the serial devices (and its parent, which
+#   may not exist yet) are watched. Changes are reported once no further changes came in for a moment, so the nodes
+#   and links of a device that is plugged in are reported at once.
+class SerialPortWatcher:
+    ##  Start watching.
+    #
+    #   \param dev_path Directory with the device nodes.
+    #   \param by_id_path Directory with the links to the serial devices.
+    #   \exception OSError Watching is not possible on this system.
+    def __init__(self, dev_path: str = DEV_PATH, by_id_path: str = BY_ID_PATH) -> None:
+        self._dev_path = dev_path
+        self._optional_paths = [os.path.dirname(by_id_path), by_id_path]
+        self._watches = {}  # type: Dict[int, str]
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            self._inotify_add_watch = libc.inotify_add_watch
+            inotify_init1 = libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self._fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # Written to by interrupt() to wake up wait()
+        self._wake_read, self._wake_write = os.pipe()
+        try:
+            self._addWatch(dev_path)
+        except OSError:
+            self.close()
+            raise
+        self._addOptionalWatches()
+
+    def _addWatch(self, path: str) -> None:
+        wd = self._inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self._watches[wd] = path
+
+    ##  Watch the directories of links which have been created since they were last looked for.
+    def _addOptionalWatches(self) -> None:
+        watched = set(self._watches.values())
+        for path in self._optional_paths:
+            if path not in watched and os.path.isdir(path):
+                try:
+                    self._addWatch(path)
+                except OSError:
+                    pass
+
+    ##  Read the pending events.
+    #
+    #   \return Whether any of them could be about a serial device.
+    def _readEvents(self) -> bool:
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+                name = data[offset + _event_header.size:offset + _event_header.size + length].rstrip(b"\0")
+                offset += _event_header.size + length
+                path = self._watches.get(wd)
+                if mask & _IN_IGNORED:
+                    # The directory was removed; it is watched again when it is created again
+                    self._watches.pop(wd, None)
+                    changed = changed or path != self._dev_path
+                    continue
+                if path == self._dev_path and not name.decode(errors = "replace").startswith(_NODE_PREFIXES):
+                    continue
+                changed = True
+        if changed:
+            self._addOptionalWatches()
+        return changed
+
+    ##  Wait for serial devices to be added or removed.
+    #
+    #   \param timeout Longest time to wait, in seconds.
+    #   \return Whether the devices may have changed. False if the wait timed out or was interrupted.
+    def wait(self, timeout: float) -> bool:
+        now = time.monotonic()
+        deadline = now + timeout
+        changed_at = None  # type: Optional[float]
+        report_at = deadline
+        while True:
+            remaining = report_at - time.monotonic()
+            if remaining <= 0:
+                return changed_at is not None
+            try:
+                readable = select.select([self._fd, self._wake_read], [], [], remaining)[0]
+            except InterruptedError:
+                continue
+            if self._wake_read in readable:
+                os.read(self._wake_read, 512)
+                return False
+            if self._fd in readable and self._readEvents():
+                now = time.monotonic()
+                if changed_at is None:
+                    changed_at = now
+                report_at = min(now + DEBOUNCE_DELAY, changed_at + DEBOUNCE_LIMIT)
+
+    ##  Make a wait() in another thread return.
+    def interrupt(self) -> None:
+        if self._wake_write < 0:
+            return
+        try:
+            os.write(self._wake_write, b"\0")
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        for fd in (self._fd, self._wake_read, self._wake_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fd = self._wake_read = self._wake_write = -1
+        self._watches = {}
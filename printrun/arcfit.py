@@ -0,0 +1,507 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import re
+
+from printrun import gcoder
+
+# Largest distance of the original toolpath from the fitted one, in mm
+DEFAULT_TOLERANCE = 0.01
+# Fewest G1 moves replaced by an arc; two moves fit any circle
+MIN_ARC_MOVES = 3
+# Most G1 moves replaced by one; fitting a run costs the square of its length
+MAX_RUN_MOVES = 32
+# Arcs of a larger radius are left to the straight line fit
+MAX_RADIUS = 1000.0
+# Largest relative difference of the extrusion per mm of the moves of a run
+EXTRUSION_TOLERANCE = 0.05
+# Slack for the coordinates being written with a limited number of decimals
+ROUNDING = 0.001
+
+# A G1 move as written by slicers: nothing but X, Y, E and F, no comment
+move_exp = re.compile(r"G1((?: +[XYEF][-+]?[0-9]*\.?[0-9]*)+) *$")
+arc_exp = re.compile(r"G[123]((?: +[XYIJEF][-+]?[0-9]*\.?[0-9]*)+) *$")
+word_exp = re.compile(r"([A-Z])([-+]?[0-9]*\.?[0-9]*)")
+
+def _number(value, digits = 5):
+    text = ("%.*f" % (digits, value)).rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+def _words(text):
+    """Returns the words of a line as a dict of letter to value string"""
+    return dict(word_exp.findall(text))
+
+def buffer_lines(data):
+    """Iterates over the lines of a buffer of G-code, bytes or a memory map,
+    as strings without their line endings"""
+    find = data.find
+    size = len(data)
+    pos = 0
+    while pos < size:
+        end = find(b"\n", pos)
+        if end < 0:
+            end = size
+        yield data[pos:end].rstrip(b"\r").decode('utf-8', 'replace')
+        pos = end + 1
+
+class _Position:
+    """Follows the position of the toolhead in the coordinates of the G-code
+    itself, which is all that arcs are fitted in. Unknown coordinates are
+    None: nothing is fitted until a move sets them."""
+
+    def __init__(self):
+        self.x = None
+        self.y = None
+        self.e = 0.0
+        self.f = None
+        self.relative = False
+        self.relative_e = False
+        self.imperial = False
+
+    def parse_move(self, raw):
+        """Returns the end point, extrusion and F value string of a plain G1
+        move in the XY plane, or None if raw is anything else or can not be
+        fitted from the current state"""
+        if self.x is None or self.y is None or self.relative or self.imperial:
+            return None
+        match = move_exp.match(raw)
+        if match is None:
+            return None
+        words = _words(match.group(1))
+        if "X" not in words and "Y" not in words:
+            return None
+        try:
+            x = float(words["X"]) if "X" in words else self.x
+            y = float(words["Y"]) if "Y" in words else self.y
+            e = float(words["E"]) if "E" in words else None
+            f = float(words["F"]) if "F" in words else None
+        except ValueError:
+            return None
+        if e is None:
+            de = 0.0
+        elif self.relative_e:
+            de = e
+        elif self.e is None:
+            return None
+        else:
+            de = e - self.e
+        if de < 0 or math.hypot(x - self.x, y - self.y) < 1e-6:
+            # Retracting moves and moves in place are left alone
+            return None
+        return x, y, de, f, words.get("F")
+
+    def move(self, x, y, de, f):
+        """Follows a move returned by parse_move()"""
+        self.x = x
+        self.y = y
+        if self.e is not None:
+            self.e += de
+        if f is not None:
+            self.f = f
+
+    def update(self, raw):
+        """Follows any other line"""
+        raw = raw.strip()
+        if not raw or raw[0] == ";":
+            return
+        line = gcoder.Line(raw)
+        split_raw = gcoder.split(line)
+        command = line.command
+        if not command:
+            return
+        if command in gcoder.move_gcodes:
+            gcoder.parse_coordinates(line, split_raw, self.imperial)
+            if self.relative:
+                if self.x is not None: self.x += line.x or 0
+                if self.y is not None: self.y += line.y or 0
+            else:
+                if line.x is not None: self.x = line.x
+                if line.y is not None: self.y = line.y
+            if line.e is not None and self.e is not None:
+                self.e = self.e + line.e if self.relative_e else line.e
+            if line.f is not None:
+                self.f = line.f
+        elif command == "G20":
+            self.imperial = True
+        elif command == "G21":
+            self.imperial = False
+        elif command == "G90":
+            self.relative = False
+            self.relative_e = False
+        elif command == "G91":
+            self.relative = True
+            self.relative_e = True
+        elif command == "M82":
+            self.relative_e = False
+        elif command == "M83":
+            self.relative_e = True
+        elif command == "G28":
+            self.x = self.y = None
+        elif command == "G92":
+            gcoder.parse_coordinates(line, split_raw, self.imperial)
+            if line.x is None and line.y is None and line.e is None:
+                self.x = self.y = self.e = None
+            if line.x is not None: self.x = line.x
+            if line.y is not None: self.y = line.y
+            if line.e is not None: self.e = line.e
+        elif command[0] == "T":
+            # Every extruder has a position of its own
+            self.e = None
+
+def _fit_line(points, tolerance):
+    """Returns True if the points lie on the line from the first to the last
+    one within tolerance, in order"""
+    x0, y0 = points[0]
+    dx = points[-1][0] - x0
+    dy = points[-1][1] - y0
+    length = math.hypot(dx, dy)
+    if length < 1e-6:
+        return False
+    dx /= length
+    dy /= length
+    along = 0.0
+    for x, y in points[1:]:
+        if abs((x - x0) * dy - (y - y0) * dx) > tolerance:
+            return False
+        position = (x - x0) * dx + (y - y0) * dy
+        if position <= along:
+            return False
+        along = position
+    return True
+
+def _circle(points):
+    """Returns the center of the circle through the first, middle and last
+    of the points, or None if they are about collinear"""
+    x0, y0 = points[0]
+    bx = points[len(points) // 2][0] - x0
+    by = points[len(points) // 2][1] - y0
+    cx = points[-1][0] - x0
+    cy = points[-1][1] - y0
+    d = 2 * (bx * cy - by * cx)
+    if abs(d) < 1e-9:
+        return None
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    return x0 + (cy * b2 - by * c2) / d, y0 + (bx * c2 - cx * b2) / d
+
+def _arc_deviation(points, cx, cy, ccw, r = None):
+    """Returns the largest distance of the polyline through the points from
+    the arc of radius r around cx, cy, going counterclockwise if ccw is set,
+    and the angle it sweeps. r is the distance of the first point if not
+    given. Returns None if the points do not go around the arc in order or
+    go around it more than once."""
+    x0, y0 = points[0]
+    if r is None:
+        r = math.hypot(x0 - cx, y0 - cy)
+    deviation = 0.0
+    sweep = 0.0
+    ax, ay = x0 - cx, y0 - cy
+    for x, y in points[1:]:
+        bx, by = x - cx, y - cy
+        angle = math.atan2(ax * by - ay * bx, ax * bx + ay * by)
+        if (angle <= 0) if ccw else (angle >= 0):
+            return None
+        sweep += abs(angle)
+        radius = math.hypot(bx, by)
+        # The chord bulges inwards by its sagitta
+        half_chord = math.hypot(bx - ax, by - ay) / 2
+        sagitta = radius - math.sqrt(max(0.0, radius * radius - half_chord * half_chord))
+        deviation = max(deviation, abs(radius - r), sagitta + max(0.0, r - radius))
+        ax, ay = bx, by
+    if sweep >= 2 * math.pi - 1e-3:
+        return None
+    return deviation, sweep
+
+def _fit_arc(points, tolerance):
+    """Returns the center of the arc through the points, whether it goes
+    counterclockwise and the angle it sweeps, or None if they do not lie on
+    one within tolerance"""
+    center = _circle(points)
+    if center is None:
+        return None
+    cx, cy = center
+    x0, y0 = points[0]
+    if math.hypot(x0 - cx, y0 - cy) > MAX_RADIUS:
+        return None
+    xm, ym = points[len(points) // 2]
+    xk, yk = points[-1]
+    ccw = (xm - x0) * (yk - ym) - (ym - y0) * (xk - xm) > 0
+    fit = _arc_deviation(points, cx, cy, ccw)
+    if fit is None or fit[0] > tolerance:
+        return None
+    return cx, cy, ccw, fit[1]
+
+class ArcFitStats:
+    """Counts of the lines and bytes going into and coming out of fit_arcs()"""
+
+    def __init__(self):
+        self.lines_in = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
+        self.moves_replaced = 0  # G1 moves merged into longer ones
+        self.lines = 0  # merged straight G1 moves written
+        self.arcs = 0  # G2 and G3 moves written
+
+    def line_reduction(self):
+        return 1 - self.lines_out / self.lines_in if self.lines_in else 0.0
+
+    def byte_reduction(self):
+        return 1 - self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+
+    def __str__(self):
+        return ("%d lines to %d (%.1f%% fewer), %d bytes to %d (%.1f%% fewer): "
+                "%d moves replaced by %d arcs and %d lines"
+                % (self.lines_in, self.lines_out, 100 * self.line_reduction(),
+                   self.bytes_in, self.bytes_out, 100 * self.byte_reduction(),
+                   self.moves_replaced, self.arcs, self.lines))
+
+class ArcFitter:
+    """Replaces runs of G1 moves which lie on a straight line or on an arc
+    of a circle, within tolerance, by a single G1 move or a G2/G3 arc.
+
+    Only plain G1 moves in the XY plane, in absolute coordinates, are
+    merged: a move with any other word than X, Y, E and F, a comment or a
+    change of feed rate ends the run. So does a change of the extrusion per
+    mm of more than EXTRUSION_TOLERANCE, or going from extruding to
+    travelling; the merged move extrudes all that the moves of the run did,
+    over about the same length. Every other line is written unchanged.
+    """
+
+    def __init__(self, out, tolerance = DEFAULT_TOLERANCE, arcs = True):
+        self.out = out  # file-like object the lines are written to
+        self.tolerance = tolerance
+        self.arcs = arcs  # fit G2/G3 arcs as well as straight lines
+        self.stats = ArcFitStats()
+        self.position = _Position()
+        self._clear_run()
+
+    def _clear_run(self):
+        self.points = []  # the start of the run and the end of every move
+        self.raws = []
+        self.extrusion = 0.0
+        self.extrusion_rate = None  # E per mm of the first move
+        self.feedrate = None  # the F value string of the first move
+        self.arc = None  # center, direction and sweep of the arc the run fits
+        self.straight = True
+
+    def feed(self, raw):
+        """Fits a line of G-code, given without its line ending"""
+        self.stats.lines_in += 1
+        self.stats.bytes_in += len(raw) + 1
+        position = self.position
+        move = position.parse_move(raw)
+        if move is None:
+            self._flush()
+            self._write(raw)
+            position.update(raw)
+            return
+        x, y, de, f, feedrate = move
+        if not self._extend(x, y, de, f, feedrate, raw):
+            self._flush()
+            self._start(x, y, de, feedrate, raw)
+        position.move(x, y, de, f)
+
+    def finish(self):
+        """Writes out the last run, returns the ArcFitStats"""
+        self._flush()
+        return self.stats
+
+    def _start(self, x, y, de, feedrate, raw):
+        position = self.position
+        length = math.hypot(x - position.x, y - position.y)
+        self.points = [(position.x, position.y), (x, y)]
+        self.raws = [raw]
+        self.extrusion = de
+        self.extrusion_rate = de / length
+        self.feedrate = feedrate
+
+    def _extend(self, x, y, de, f, feedrate, raw):
+        """Adds a move to the run if it still fits a line or an arc"""
+        points = self.points
+        if not points or len(self.raws) >= MAX_RUN_MOVES:
+            return False
+        if f is not None and f != self.position.f:
+            return False
+        length = math.hypot(x - points[-1][0], y - points[-1][1])
+        rate = de / length
+        if (rate > 0) != (self.extrusion_rate > 0) or \
+           abs(rate - self.extrusion_rate) > EXTRUSION_TOLERANCE * self.extrusion_rate:
+            return False
+        candidate = points + [(x, y)]
+        straight = self.straight and _fit_line(candidate, self.tolerance)
+        arc = None
+        if not straight:
+            if not self.arcs:
+                return False
+            arc = self._extend_arc(x, y)
+            if arc is None:
+                arc = _fit_arc(candidate, self.tolerance)
+            if arc is None:
+                return False
+        self.points = candidate
+        self.raws.append(raw)
+        self.extrusion += de
+        self.straight = straight
+        self.arc = arc
+        return True
+
+    def _extend_arc(self, x, y):
+        """Returns the arc the run fits extended to x, y if the point lies on
+        it, which saves checking the whole run against a new one"""
+        if self.arc is None:
+            return None
+        cx, cy, ccw, sweep = self.arc
+        x0, y0 = self.points[0]
+        fit = _arc_deviation([self.points[-1], (x, y)], cx, cy, ccw,
+                             math.hypot(x0 - cx, y0 - cy))
+        if fit is None or fit[0] > self.tolerance \
+           or sweep + fit[1] >= 2 * math.pi - 1e-3:
+            return None
+        return cx, cy, ccw, sweep + fit[1]
+
+    def _flush(self):
+        """Writes out the run, merged if it is long enough"""
+        raws = self.raws
+        if not raws:
+            return
+        if len(raws) >= 2 and self.straight:
+            self._write(self._merged("G1"))
+            self.stats.lines += 1
+        elif len(raws) >= MIN_ARC_MOVES and self.arc is not None:
+            cx, cy, ccw, sweep = self.arc
+            self._write(self._merged("G3" if ccw else "G2", cx, cy))
+            self.stats.arcs += 1
+        else:
+            for raw in raws:
+                self._write(raw)
+            raws = ()
+        self.stats.moves_replaced += len(raws)
+        self._clear_run()
+
+    def _merged(self, command, cx = None, cy = None):
+        x0, y0 = self.points[0]
+        x, y = self.points[-1]
+        words = [command]
+        if self.feedrate is not None:
+            words.append("F" + self.feedrate)
+        words.append("X" + _number(x))
+        words.append("Y" + _number(y))
+        if cx is not None:
+            words.append("I" + _number(cx - x0, 4))
+            words.append("J" + _number(cy - y0, 4))
+        if self.extrusion > 0:
+            position = self.position
+            if position.relative_e:
+                words.append("E" + _number(self.extrusion))
+            else:
+                words.append("E" + _number(position.e))
+        return " ".join(words)
+
+    def _write(self, raw):
+        self.out.write(raw + "\n")
+        self.stats.lines_out += 1
+        self.stats.bytes_out += len(raw) + 1
+
+def fit_arcs(lines, out, tolerance = DEFAULT_TOLERANCE, arcs = True):
+    """Writes the lines of G-code to out with the runs of G1 moves on a line
+    or an arc merged, see ArcFitter. Returns the ArcFitStats."""
+    fitter = ArcFitter(out, tolerance, arcs)
+    for raw in lines:
+        fitter.feed(raw)
+    return fitter.finish()
+
+def check_fit(original, fitted, tolerance = DEFAULT_TOLERANCE):
+    """Follows the toolpaths of the original and the fitted G-code, both
+    iterables of lines, side by side and checks that every line which was
+    not passed through unchanged replaced G1 moves which lie within
+    tolerance of it and extrude the same amount at about the same rate.
+    Returns the largest distance found, raises ValueError on a mismatch."""
+    original = iter(original)
+    position = _Position()
+    largest = 0.0
+    for number, raw in enumerate(fitted, 1):
+        raw_original = next(original, None)
+        if raw_original is None:
+            raise ValueError("the fitted G-code is longer than the original")
+        if raw == raw_original:
+            move = position.parse_move(raw)
+            if move is None:
+                position.update(raw)
+            else:
+                position.move(move[0], move[1], move[2], move[3])
+            continue
+        match = arc_exp.match(raw)
+        if match is None or position.x is None or position.y is None:
+            raise ValueError("line %d of the fitted G-code replaces %r but is "
+                             "no move: %r" % (number, raw_original, raw))
+        words = _words(match.group(1))
+        x0, y0 = position.x, position.y
+        x = float(words.get("X", x0))
+        y = float(words.get("Y", y0))
+        # The moves replaced by the line, up to the one ending where it ends
+        points = [(x0, y0)]
+        extrusion = 0.0
+        length = 0.0
+        while True:
+            move = position.parse_move(raw_original)
+            if move is None:
+                raise ValueError("line %d of the fitted G-code replaces %r, "
+                                 "which can not be merged" % (number, raw_original))
+            position.move(move[0], move[1], move[2], move[3])
+            length += math.hypot(move[0] - points[-1][0], move[1] - points[-1][1])
+            points.append((move[0], move[1]))
+            extrusion += move[2]
+            if len(points) > 2 and abs(move[0] - x) <= ROUNDING and abs(move[1] - y) <= ROUNDING:
+                break
+            if len(points) > MAX_RUN_MOVES:
+                raise ValueError("line %d of the fitted G-code does not end "
+                                 "where any of the moves it replaces do" % number)
+            raw_original = next(original, None)
+        if raw.startswith("G1"):
+            fit = (0.0, 0.0) if _fit_line(points, tolerance + ROUNDING) else None
+            fitted_length = math.hypot(x - x0, y - y0)
+        else:
+            cx = x0 + float(words.get("I", 0))
+            cy = y0 + float(words.get("J", 0))
+            fit = _arc_deviation(points, cx, cy, raw.startswith("G3"))
+            r = math.hypot(x0 - cx, y0 - cy)
+            angle = math.atan2((x0 - cx) * (y - cy) - (y0 - cy) * (x - cx),
+                               (x0 - cx) * (x - cx) + (y0 - cy) * (y - cy))
+            if raw.startswith("G3"):
+                angle %= 2 * math.pi
+            else:
+                angle = -angle % (2 * math.pi)
+            fitted_length = r * angle
+        if fit is None or fit[0] > tolerance + ROUNDING:
+            raise ValueError("line %d of the fitted G-code strays from the "
+                             "moves it replaces: %r" % (number, raw))
+        largest = max(largest, fit[0])
+        if "E" in words:
+            fitted_extrusion = float(words["E"])
+            if not position.relative_e:
+                fitted_extrusion -= position.e - extrusion
+        else:
+            fitted_extrusion = 0.0
+        if abs(fitted_extrusion - extrusion) > 1e-4 or \
+           abs(fitted_length - length) > EXTRUSION_TOLERANCE * length:
+            raise ValueError("line %d of the fitted G-code extrudes %.5f over "
+                             "%.3f mm, the moves it replaces %.5f over %.3f mm"
+                             % (number, fitted_extrusion, fitted_length,
+                                extrusion, length))
+    if next(original, None) is not None:
+        raise ValueError("the fitted G-code is shorter than the original")
+    return largest
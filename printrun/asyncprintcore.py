@@ -0,0 +1,483 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import socket
+import threading
+import traceback
+
+from printrun.printcore import printcore, READ_SIZE, STREAM_CHUNK
+from .utils import decode_utf8
+
+# Seconds to wait for the printer to answer an M105 before sending another
+# one while connecting; as long as printcore's 15 empty reads
+ONLINE_TIMEOUT = 3.75
+
+class EventLoopThread:
+    """An asyncio event loop running on a thread of its own, which any
+    number of asyncprintcore instances can share"""
+
+    def __init__(self, name = "printcore loop"):
+        # A selector loop (epoll, kqueue, ...) on every platform: the
+        # proactor loop of Windows cannot watch file descriptors
+        self.loop = asyncio.SelectorEventLoop()
+        self.thread = threading.Thread(target = self._run, name = name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def on_loop(self):
+        return threading.current_thread() is self.thread
+
+    def call(self, function, *args):
+        """Calls function(*args) on the loop and returns what it returns.
+        Called on the loop thread itself, function is called right away."""
+        if self.on_loop():
+            return function(*args)
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def call_soon(self, function, *args):
+        """Calls function(*args) on the loop without waiting for it"""
+        if self.on_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+_shared_loop = None
+_shared_lock = threading.Lock()
+
+def shared_loop():
+    """Returns the EventLoopThread used by default, starting it if needed"""
+    global _shared_loop
+    with _shared_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
+
+def _expire(future):
+    if not future.done():
+        future.set_result(False)
+
+class asyncprintcore(printcore):
+    """printcore running on an asyncio event loop instead of threads.
+
+    Reading, going online, sending, resends and the print loop are callbacks
+    and coroutines on one event loop, which by default is shared by every
+    instance, so a host driving many printers needs one thread for all of
+    them rather than three per printer. The public methods and the event
+    handlers and callbacks are those of printcore; the methods can be called
+    from any thread. Callbacks are called on the loop thread unless a
+    dispatcher is set, so they should not block.
+
+    Serial ports are read and written through their file descriptor, which
+    needs a POSIX system; TCP connections work everywhere.
+    """
+
+    def __init__(self, port = None, baud = None, dtr = None, loop_thread = None):
+        self.loop_thread = loop_thread if loop_thread is not None else shared_loop()
+        self.loop = self.loop_thread.loop
+        # (predicate, future) of the coroutines waiting for a state change
+        self.waiters = []
+        self.print_task = None
+        # Bumped for every print task, so a task which is left over from
+        # before a pause stops sending once the print is resumed
+        self.print_generation = 0
+        self.online_task = None
+        self.fd = None
+        self.reading = False
+        self.write_buffer = bytearray()
+        # Set when the job has been sent and the oks of the lines still in
+        # the window are to be waited for, see _nextline()
+        self.drain_pending = False
+        self.drained = False
+        super().__init__(port, baud, dtr)
+
+    def _set_clear(self, clear):
+        self._clear = clear
+        if clear:
+            self._wake_waiters()
+    clear = property(printcore._get_clear, _set_clear)
+
+    def _wake_waiters(self):
+        if self.loop_thread.on_loop():
+            self._check_waiters()
+        else:
+            self.loop.call_soon_threadsafe(self._check_waiters)
+
+    def _check_waiters(self):
+        if not self.waiters:
+            return
+        waiting = []
+        for predicate, future in self.waiters:
+            if future.done():
+                continue
+            if predicate():
+                future.set_result(True)
+            else:
+                waiting.append((predicate, future))
+        self.waiters = waiting
+
+    async def _wait_until(self, predicate, timeout = None):
+        """Waits until predicate() is true, which is checked whenever the
+        waiters are woken up. Returns False if timeout ran out first."""
+        if predicate():
+            return True
+        future = self.loop.create_future()
+        self.waiters.append((predicate, future))
+        expiry = None
+        if timeout is not None:
+            expiry = self.loop.call_later(timeout, _expire, future)
+        try:
+            return await future
+        finally:
+            if expiry is not None:
+                expiry.cancel()
+
+    def disconnect(self):
+        """Disconnects from printer and pauses the print
+        """
+        self.loop_thread.call(self._disconnect)
+
+    def _disconnect(self):
+        if self.printer:
+            self._stop_io()
+            self.printing = False
+            try:
+                if self.printer_tcp:
+                    self.printer_tcp.close()
+                self.printer.close()
+            except socket.error:
+                pass
+            except OSError:
+                pass
+        self._notify("disconnect")
+        self.printer = None
+        self.online = False
+        self.printing = False
+        self.fd = None
+        # The print task sees the printer is gone and stops
+        self._check_waiters()
+
+    def _start_io(self):
+        self.loop_thread.call(self._open_io)
+
+    def _open_io(self):
+        if self.printer_tcp:
+            self.printer_tcp.setblocking(False)
+            self.fd = self.printer_tcp.fileno()
+        else:
+            self.fd = getattr(self.printer, "fd", None)
+            if self.fd is None:
+                self.logError(_("Serial ports can only be used by the asyncio engine on POSIX systems."))
+                return
+            os.set_blocking(self.fd, False)
+        del self.write_buffer[:]
+        self.reading = True
+        self.loop.add_reader(self.fd, self._on_readable)
+        self.clear = True
+        if not self.printing:
+            self.online_task = self.loop.create_task(self._go_online_async())
+
+    def _stop_io(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        self.reading = False
+        del self.write_buffer[:]
+        if self.online_task is not None:
+            self.online_task.cancel()
+            self.online_task = None
+
+    def _stop_reading(self):
+        """Stops reading after the connection failed, as printcore's read
+        thread does"""
+        if self.printer_tcp and self.printer:
+            self._connection_lost()
+            return
+        if self.reading:
+            self.loop.remove_reader(self.fd)
+            self.reading = False
+        self.clear = True
+
+    def _connection_lost(self):
+        if self.printing:
+            self.pause()
+        self._disconnect()
+
+    async def _go_online_async(self):
+        while not self.online and self.printer and self.reading:
+            self._send("M105")
+            if self.writefailures >= 4:
+                logging.error(_("Aborting connection attempt after 4 failed writes."))
+                return
+            await self._wait_until(
+                lambda: self.online or not self.printer or not self.reading,
+                ONLINE_TIMEOUT)
+
+    def _on_readable(self):
+        try:
+            if self.printer_tcp:
+                data = self.printer_tcp.recv(READ_SIZE)
+                if not data:
+                    raise OSError(-1, "Read EOF from socket")
+            else:
+                data = os.read(self.fd, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
+            self._stop_reading()
+            return
+        lines = self._received(data)
+        if not self.online:
+            rest = self._go_online(lines)
+            while rest is None:
+                if not lines or lines[-1] is not None:
+                    return
+                # Rubbish while waiting for the printer, as the threads
+                # listening for it see it; the lines after it still count
+                lines = self._received(b"")
+                rest = self._go_online(lines)
+            self._wake_waiters()
+            lines = rest
+        self._handle_lines(lines)
+        if lines and lines[-1] is None:
+            self._stop_reading()
+
+    def _write(self, data):
+        if not self.printer or self.fd is None:
+            return
+        if self.write_buffer:
+            # Keep the order, the rest goes out when the fd is writable
+            self.write_buffer += data
+            return
+        try:
+            if self.printer_tcp:
+                written = self.printer_tcp.send(data)
+            else:
+                written = os.write(self.fd, data)
+        except (BlockingIOError, InterruptedError):
+            written = 0
+        except OSError as e:
+            self.logError(_("Can't write to printer (disconnected?) (OS Error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
+            self.metrics.write_failures += 1
+            return
+        self.writefailures = 0
+        if written < len(data):
+            self.write_buffer += data[written:]
+            self.loop.add_writer(self.fd, self._on_writable)
+
+    def _on_writable(self):
+        try:
+            if self.printer_tcp:
+                written = self.printer_tcp.send(self.write_buffer)
+            else:
+                written = os.write(self.fd, self.write_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.logError(_("Can't write to printer (disconnected?) (OS Error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
+            self.metrics.write_failures += 1
+            del self.write_buffer[:]
+            written = 0
+        del self.write_buffer[:written]
+        if not self.write_buffer:
+            self.loop.remove_writer(self.fd)
+
+    # Commands are sent from the loop: there is no sender thread, and the
+    # print task takes the place of the print thread
+
+    def _start_sender(self):
+        pass
+
+    def _stop_sender(self):
+        pass
+
+    def _start_print_thread(self, resuming):
+        self.print_generation += 1
+        self.print_task = self.loop.create_task(
+            self._print_async(resuming, self.print_task, self.print_generation))
+
+    def _stop_print_thread(self):
+        # The task stops at its next step; what pause() needs is already
+        # known, since lines are analysed when they are prepared
+        self._wake_waiters()
+
+    def _wait_last_oks(self):
+        # Waited for by _sendnext_async() before _nextline() gets here
+        pass
+
+    def startprint(self, gcode, startindex = 0, stream = None):
+        if gcode is not None:
+            # Wait for the start of a background analysis here rather than
+            # on the loop
+            gcode.has_index(startindex)
+        return self.loop_thread.call(super().startprint, gcode, startindex, stream)
+
+    def pause(self):
+        return self.loop_thread.call(super().pause)
+
+    def resume(self):
+        return self.loop_thread.call(super().resume)
+
+    def cancelprint(self):
+        return self.loop_thread.call(super().cancelprint)
+
+    def send(self, command, wait = 0):
+        """Adds a command to the checksummed main command queue if printing, or
+        sends the command immediately if not printing"""
+        if self.online:
+            self.loop_thread.call_soon(self._queue_command, command)
+        else:
+            self.logError(_("Not connected to printer."))
+
+    def send_now(self, command, wait = 0):
+        """Sends a command to the printer ahead of the command queue, without a
+        checksum"""
+        if self.online:
+            self.loop_thread.call_soon(self._send_command, command)
+        else:
+            self.logError(_("Not connected to printer."))
+
+    def _queue_command(self, command):
+        if self.printing:
+            self.mainqueue.append(command)
+            self._check_waiters()
+        else:
+            self._send_command(command)
+
+    def _send_command(self, command):
+        if self.print_task is not None:
+            # Sent by the print task between the lines of the job
+            self.priqueue.put_nowait(command)
+            self._check_waiters()
+        else:
+            self._send(command)
+
+    def _send_queued(self):
+        """Sends the commands left in the queue once the print task stops"""
+        while not self.priqueue.empty():
+            command = self.priqueue.get_nowait()
+            if command is not None:
+                self._send(command)
+
+    def _printing_in(self, generation):
+        return (self.printing and self.printer and self.online
+                and generation == self.print_generation)
+
+    async def _print_async(self, resuming, previous, generation):
+        if previous is not None:
+            # Let the task of the print before the pause finish first
+            await asyncio.wait([previous])
+        try:
+            # callback for printing started
+            self._notify("start", (resuming,), self.startcb,
+                         _("Print start callback failed with:"))
+            while self._printing_in(generation):
+                await self._sendnext_async(generation)
+            await self._flush_held_line_async()
+            self.sentlines.clear()
+            self.replay.clear()
+            self.log.clear()
+            self.sent.clear()
+            # callback for printing done
+            self._notify("end", (), self.endcb,
+                         _("Print end callback failed with:"))
+        except:
+            self.logError(_("Print thread died due to the following error:") +
+                          "\n" + traceback.format_exc())
+        finally:
+            if generation == self.print_generation:
+                self.print_task = None
+                self._send_queued()
+
+    async def _sendnext_async(self, generation):
+        if self.drain_pending:
+            self.drain_pending = False
+            await self._wait_until(self._last_oks_in, 5.0)
+            self.drained = True
+        else:
+            if not self._clear:
+                started = self.metrics.clock()
+                await self._wait_until(
+                    lambda: self._clear or not self._printing_in(generation))
+                self.metrics.waited(self.metrics.clock() - started)
+            self.drained = False
+        gcode = self.mainqueue
+        if gcode is not None and not getattr(gcode, "prepared", True):
+            await self._job_ready(gcode)
+        if generation == self.print_generation:
+            self._send_batch()
+
+    async def _job_ready(self, gcode):
+        """Waits on an executor thread for the next lines of a job which is
+        still being analysed, so the loop is not held up by has_index()"""
+        index = self.queueindex + STREAM_CHUNK
+        if index < gcode.ready_count():
+            return
+        await self.loop.run_in_executor(None, gcode.has_index, index)
+
+    def _analysis_behind(self):
+        """Returns True if has_index() would wait for the analysis of the
+        job to reach the next line, or the one after it"""
+        gcode = self.mainqueue
+        return (gcode is not None and not getattr(gcode, "prepared", True)
+                and self.queueindex + 1 >= gcode.ready_count())
+
+    def _print_done(self):
+        if self._analysis_behind():
+            return False  # More lines may come
+        return super()._print_done()
+
+    def _nextline(self):
+        if self.printing and self._analysis_behind() and self.priqueue.empty() \
+           and not -1 < self.resendfrom < self.lineno:
+            # Ends the batch; _sendnext_async() waits for the analysis off
+            # the loop before the next one
+            return None, None
+        if not self.drained and self.buffer_free is not None and self.inflight \
+           and not self.mainqueue.has_index(self.queueindex) and self._print_done():
+            # Ends the batch; the oks of the last lines are waited for before
+            # the next one, see printcore._wait_last_oks()
+            self.drain_pending = True
+            return None, None
+        return super()._nextline()
+
+    async def _flush_held_line_async(self):
+        if self.held_line is None:
+            return
+        await self._wait_until(lambda: self._clear or not self.printer, 1.0)
+        if self.held_line is None:
+            return
+        data, lineno = self.held_line
+        self.held_line = None
+        self._track(data, lineno)
+        self._write(data)
@@ -0,0 +1,393 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures how fast printcore prints to the virtual printer.
+
+Every combination of engine, job and baud rate is printed to a virtual
+printer served on a pseudo terminal by a process of its own, so the CPU
+time measured is that of printcore alone. For every print the lines and
+bytes per second, the time from an ok coming in to the next write going
+out, the CPU time per line and the resends are reported, and written as
+JSON with --output. Every print is repeated and the best of every metric
+is kept, as other load on the machine only ever makes them worse.
+
+With --baseline, the results are compared with those of an earlier run,
+and the exit status is 1 if any of them got worse by more than its
+threshold, or if a print failed. The virtual printer wakes up about once
+a millisecond at best, which limits the lines per second at the higher
+baud rates; the numbers are for comparing runs on the same machine, not
+for what a real printer would do.
+
+    python -m printrun.benchmark --output before.json
+    python -m printrun.benchmark --baseline before.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from . import gcoder
+from . import responses
+from .asyncprintcore import asyncprintcore
+from .printcore import printcore
+
+ENGINES = {"threads": printcore, "loop": asyncprintcore}
+
+# The baud rates offered by ConnectSerialAction.allBaudRates
+BAUD_RATES = [250000, 230400, 115200, 57600, 38400, 19200, 9600]
+
+# Metrics compared with a baseline: whether higher is better, and how much
+# worse than the baseline they may get by default, as a fraction of it
+THRESHOLDS = {
+    "lines_per_second": (True, 0.20),
+    "bytes_per_second": (True, 0.20),
+    "ok_latency_p50_ms": (False, 0.50),
+    "ok_latency_p90_ms": (False, 1.00),
+    "cpu_us_per_line": (False, 0.40),
+}
+# Latencies closer than this to the baseline are never a regression, as
+# the scheduler alone makes them vary that much
+LATENCY_SLACK_MS = 1.0
+
+OK_KINDS = (responses.OK, responses.OK_TEMPS)
+
+# Jobs
+
+def arcs(count, seed = 0):
+    """Curved perimeters cut into short segments, as sliced models with
+    round walls have"""
+    rand = random.Random(seed)
+    lines = []
+    e = 0.0
+    while len(lines) < count:
+        cx, cy = rand.uniform(50, 150), rand.uniform(50, 150)
+        radius = rand.uniform(1, 20)
+        steps = max(8, int(2 * math.pi * radius / 0.2))
+        for step in range(steps + 1):
+            angle = 2 * math.pi * step / steps
+            e += 2 * math.pi * radius / steps * 0.033
+            lines.append("G1 X%.3f Y%.3f E%.5f" % (cx + radius * math.cos(angle),
+                                                  cy + radius * math.sin(angle),
+                                                  e))
+    return lines[:count]
+
+def infill(count, seed = 0):
+    """Long straight extrusions going back and forth"""
+    rand = random.Random(seed)
+    lines = []
+    e = 0.0
+    y = 50.0
+    while len(lines) < count:
+        lines.append("G1 F%d" % rand.choice((1800, 2400, 3000)))
+        for i in range(20):
+            y += 0.4
+            x = 50.0 if i % 2 else 150.0
+            e += 100 * 0.033
+            lines.append("G1 X%.3f Y%.3f E%.5f" % (x, y, e))
+        if y > 150:
+            y = 50.0
+    return lines[:count]
+
+def travel(count, seed = 0):
+    """Many travel moves with retractions and z hops between short
+    extrusions, as jobs of many small parts have"""
+    rand = random.Random(seed)
+    lines = []
+    e = 0.0
+    while len(lines) < count:
+        lines.append("G1 E%.5f F2400" % (e - 1))
+        lines.append("G1 Z0.6 F600")
+        lines.append("G0 F9000 X%.3f Y%.3f" % (rand.uniform(10, 190),
+                                               rand.uniform(10, 190)))
+        lines.append("G1 Z0.2 F600")
+        lines.append("G1 E%.5f F2400" % e)
+        for i in range(3):
+            e += 0.05
+            lines.append("G1 X%.3f Y%.3f E%.5f F1200" % (
+                rand.uniform(10, 190), rand.uniform(10, 190), e))
+    return lines[:count]
+
+JOBS = {"arcs": arcs, "infill": infill, "travel": travel}
+
+def read_job(path):
+    with open(path) as f:
+        return [line.rstrip("\n") for line in f]
+
+# Measuring
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of values lies"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Recorder:
+    """Records when oks come in and lines go out, by wrapping the methods
+    of a printcore every engine passes the data through"""
+
+    def __init__(self, core):
+        self.latencies = []  # from an ok coming in to the next write
+        self.bytes_written = 0
+        self.resends = 0
+        self.ok_at = None
+        self.received = core._received
+        self.write = core._write
+        core._received = self._received
+        core._write = self._write
+
+    def _received(self, data):
+        now = time.perf_counter()
+        lines = self.received(data)
+        for line in lines:
+            if line is None:
+                continue
+            if line.kind in OK_KINDS and self.ok_at is None:
+                self.ok_at = now
+            elif line.kind == responses.RESEND:
+                self.resends += 1
+        return lines
+
+    def _write(self, data):
+        if self.ok_at is not None:
+            self.latencies.append(time.perf_counter() - self.ok_at)
+            self.ok_at = None
+        self.bytes_written += len(data)
+        return self.write(data)
+
+def start_printer(baud, args):
+    """Starts a virtual printer in a process of its own, returns the
+    process and the path of its pseudo terminal"""
+    command = [sys.executable, "-m", "printrun.virtualprinter", "--pty",
+               "--baud", str(baud), "--move-time", str(args.move_time),
+               "--corrupt", str(args.corrupt), "--seed", str(args.seed)]
+    if args.advanced_ok:
+        command.append("--advanced-ok")
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_parent] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    process = subprocess.Popen(command, stdout = subprocess.PIPE,
+                               stderr = subprocess.DEVNULL,
+                               universal_newlines = True, env = env)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError("The virtual printer did not start")
+    return process, line.rsplit(" ", 1)[-1].strip()
+
+def run(engine, job, lines, baud, args):
+    """Prints lines with engine at baud and returns the measurements"""
+    result = {"engine": engine, "job": job, "baud": baud}
+    process, path = start_printer(baud, args)
+    core = ENGINES[engine]()
+    try:
+        core.connect(path, baud)
+        deadline = time.monotonic() + 10
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not core.online:
+            result["error"] = "the printer did not come online"
+            return result
+        recorder = Recorder(core)
+        gcode = gcoder.LightGCode(lines)
+        # Generous: a print taking longer is stuck rather than slow
+        deadline = time.monotonic() + 10 * args.duration + 10
+        cpu = time.process_time()
+        start = time.perf_counter()
+        core.startprint(gcode)
+        while core.printing and time.monotonic() < deadline:
+            time.sleep(0.005)
+        seconds = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        if core.printing:
+            core.cancelprint()
+            result["error"] = "the print got stuck"
+            return result
+        latencies = [latency * 1000 for latency in recorder.latencies]
+        result.update({
+            "lines": len(lines),
+            "seconds": round(seconds, 4),
+            "lines_per_second": round(len(lines) / seconds, 1),
+            "bytes_per_second": round(recorder.bytes_written / seconds, 1),
+            "ok_latency_p50_ms": round(percentile(latencies, 0.50), 3),
+            "ok_latency_p90_ms": round(percentile(latencies, 0.90), 3),
+            "ok_latency_p99_ms": round(percentile(latencies, 0.99), 3),
+            "ok_latency_max_ms": round(max(latencies), 3),
+            "cpu_us_per_line": round(cpu / len(lines) * 1e6, 1),
+            "resends": recorder.resends,
+        })
+        return result
+    finally:
+        core.disconnect()
+        process.terminate()
+        process.wait()
+
+def best(results):
+    """Combines the results of repeated runs into one with the best value
+    of every metric, or returns the first failed one"""
+    for result in results:
+        if "error" in result:
+            return result
+    combined = dict(results[0])
+    for metric, value in combined.items():
+        if not isinstance(value, (int, float)) or metric in ("baud", "lines"):
+            continue
+        values = [result[metric] for result in results]
+        higher_is_better = THRESHOLDS.get(metric, (False,))[0]
+        combined[metric] = max(values) if higher_is_better else min(values)
+    return combined
+
+def line_count(lines, baud, duration):
+    """Returns how many lines of a job to print for a run of about duration
+    seconds at baud, going by the time the bytes take on the line"""
+    average = sum(len(line) + 1 for line in lines) / len(lines)
+    return max(50, min(len(lines), int(duration * baud / 10 / average)))
+
+def compare(results, baseline, thresholds):
+    """Returns a description of every result which is worse than the
+    matching one of baseline by more than the threshold of the metric"""
+    def key(result):
+        return result["engine"], result["job"], result["baud"]
+    earlier = dict((key(result), result) for result in baseline)
+    failures = []
+    for result in results:
+        name = "%s %s %d" % key(result)
+        if "error" in result:
+            failures.append("%s: %s" % (name, result["error"]))
+            continue
+        before = earlier.get(key(result))
+        if before is None or "error" in before:
+            continue
+        for metric, (higher_is_better, threshold) in thresholds.items():
+            if result.get(metric) is None or before.get(metric) is None:
+                continue
+            old, new = before[metric], result[metric]
+            if higher_is_better:
+                worse = new < old * (1 - threshold)
+            else:
+                worse = new > old * (1 + threshold)
+                if metric.endswith("_ms"):
+                    worse = worse and new - old > LATENCY_SLACK_MS
+            if worse:
+                failures.append("%s: %s went from %s to %s" %
+                                (name, metric, old, new))
+    return failures
+
+def load_thresholds(path):
+    """Returns THRESHOLDS with the thresholds of the JSON object in path,
+    by metric, replacing the default ones"""
+    thresholds = dict(THRESHOLDS)
+    if path:
+        with open(path) as f:
+            for metric, threshold in json.load(f).items():
+                if metric not in THRESHOLDS:
+                    raise ValueError("Unknown metric %s" % metric)
+                thresholds[metric] = (THRESHOLDS[metric][0], float(threshold))
+    return thresholds
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Measures how fast printcore prints to a virtual "
+                      "printer")
+    parser.add_argument("--engine", nargs = "+", choices = sorted(ENGINES),
+                        default = sorted(ENGINES, reverse = True))
+    parser.add_argument("--job", nargs = "+", choices = sorted(JOBS),
+                        default = sorted(JOBS), help = "generated jobs to print")
+    parser.add_argument("--gcode", nargs = "+", default = [],
+                        help = "G-code files to print as well")
+    parser.add_argument("--baud", nargs = "+", type = int,
+                        default = BAUD_RATES)
+    parser.add_argument("--duration", type = float, default = 2.0,
+                        help = "seconds every print takes on the line, "
+                               "about")
+    parser.add_argument("--move-time", type = float, default = 0,
+                        help = "time every move takes, in ms")
+    parser.add_argument("--advanced-ok", action = "store_true",
+                        help = "have the printer report its buffer space")
+    parser.add_argument("--corrupt", type = float, default = 0,
+                        help = "probability of a line getting corrupted")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "times to print every job, keeping the best")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", help = "file to write the results to, "
+                                           "as JSON")
+    parser.add_argument("--baseline", help = "results of an earlier run to "
+                                             "compare with")
+    parser.add_argument("--thresholds",
+                        help = "JSON object with the allowed regression of "
+                               "metrics, as a fraction of the baseline")
+    args = parser.parse_args()
+    thresholds = load_thresholds(args.thresholds)
+    # Corrupted lines and the like are expected, failures are reported below
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    jobs = [(name, JOBS[name](20000, args.seed)) for name in args.job]
+    jobs += [(os.path.basename(path), read_job(path)) for path in args.gcode]
+    results = []
+    print("%-8s %-12s %7s %9s %10s %8s %8s %8s %7s" %
+          ("engine", "job", "baud", "lines/s", "bytes/s", "p50 ms", "p99 ms",
+           "us/line", "resends"))
+    for name, lines in jobs:
+        for baud in args.baud:
+            count = line_count(lines, baud, args.duration)
+            for engine in args.engine:
+                result = best([run(engine, name, lines[:count], baud, args)
+                               for i in range(args.repeat)])
+                results.append(result)
+                if "error" in result:
+                    print("%-8s %-12s %7d %s" % (engine, name, baud,
+                                                 result["error"]))
+                    continue
+                print("%-8s %-12s %7d %9.1f %10.1f %8.3f %8.3f %8.1f %7d" %
+                      (engine, name, baud, result["lines_per_second"],
+                       result["bytes_per_second"],
+                       result["ok_latency_p50_ms"],
+                       result["ok_latency_p99_ms"],
+                       result["cpu_us_per_line"], result["resends"]))
+                sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "settings": {"duration": args.duration,
+                                    "move_time": args.move_time,
+                                    "advanced_ok": args.advanced_ok,
+                                    "corrupt": args.corrupt,
+                                    "repeat": args.repeat,
+                                    "seed": args.seed},
+                       "results": results}, f, indent = 2)
+    failures = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f)["results"], thresholds)
+    else:
+        failures = ["%s %s %d: %s" % (result["engine"], result["job"],
+                                      result["baud"], result["error"])
+                    for result in results if "error" in result]
+    for failure in failures:
+        print("FAILED " + failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the printcore engines printing to many printers at once.
+
+For every engine and number of printers, that many virtual printers are
+served on pseudo terminals by one helper process, on a single event loop,
+and every printer gets an equal share of --lines lines to print at the
+same time. Reported are the lines per second of all printers together and
+of the median printer, how much slower the slowest printer was, the
+context switches and CPU time per line of this process, which runs the
+printers' printcores, and the number of threads it runs. The helper
+measures the latency of the host as the time from writing an ok to the
+next bytes arriving from it.
+
+With --dispatcher, events are delivered by EventDispatchers set up as the
+plugin does: one per printer with threads, one for all printers on the
+shared loop.
+
+    python -m printrun.benchmark_engines --printers 1 8 32
+    python -m printrun.benchmark_engines --printers 1 8 32 --advanced-ok
+    python -m printrun.benchmark_engines --printers 1 4 16 32 64 \\
+        --advanced-ok --dispatcher
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from . import gcoder
+from .benchmark import ENGINES, infill, percentile
+from .eventdispatch import EventDispatcher
+from .virtualprinter import VirtualPrinter
+from .asyncprintcore import EventLoopThread
+
+class TimedPrinter(VirtualPrinter):
+    """Virtual printer which records the time from writing an ok to the
+    next bytes coming in"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ok_at = None
+        self.latencies = []
+
+    def _write(self, transport, data):
+        super()._write(transport, data)
+        if self.ok_at is None and data.startswith(b"ok"):
+            self.ok_at = time.perf_counter()
+
+    def _data_received(self, transport, data):
+        if self.ok_at is not None:
+            self.latencies.append(time.perf_counter() - self.ok_at)
+            self.ok_at = None
+        super()._data_received(transport, data)
+
+def serve(count, advanced_ok):
+    """Serves count virtual printers on one event loop and prints the paths
+    of their pseudo terminals. Prints the stats of the printers and the
+    latencies of the host as JSON when a line comes in on stdin, and
+    exits."""
+    loop_thread = EventLoopThread(name = "virtual printers")
+    printers = []
+    for i in range(count):
+        printer = TimedPrinter(advanced_ok = advanced_ok, seed = i)
+        printer.loop_thread = loop_thread
+        print(printer.serve_pty())
+        printers.append(printer)
+    sys.stdout.flush()
+    sys.stdin.readline()
+
+    def stats():
+        latencies = [latency * 1000 for printer in printers
+                     for latency in printer.latencies]
+        return {"printers": [printer.stats() for printer in printers],
+                "latency_p50_ms": percentile(latencies, 0.50),
+                "latency_p99_ms": percentile(latencies, 0.99)}
+    print(json.dumps(loop_thread.call(stats)))
+    sys.stdout.flush()
+
+def start_printers(count, advanced_ok):
+    """Starts serve() in a process of its own, returns the process and the
+    paths of the pseudo terminals of the printers"""
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_parent] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    command = [sys.executable, "-m", "printrun.benchmark_engines",
+               "--serve", str(count)]
+    if advanced_ok:
+        command.append("--advanced-ok")
+    process = subprocess.Popen(command, stdin = subprocess.PIPE,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.DEVNULL,
+                               universal_newlines = True, env = env)
+    paths = [process.stdout.readline().strip() for i in range(count)]
+    if not all(paths):
+        process.kill()
+        process.wait()
+        raise RuntimeError("The virtual printers did not start")
+    return process, paths
+
+def context_switches():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+def run(engine, count, lines, advanced_ok, dispatcher):
+    """Prints lines split over count printers with engine, returns the
+    measurements"""
+    result = {"engine": engine, "printers": count}
+    process, paths = start_printers(count, advanced_ok)
+    cores = []
+    dispatchers = []
+    try:
+        for path in paths:
+            core = ENGINES[engine]()
+            # As the plugin sets it up
+            core.analyze_print = False
+            if dispatcher:
+                if engine == "threads" or not dispatchers:
+                    dispatchers.append(EventDispatcher())
+                core.dispatcher = dispatchers[-1]
+            core.connect(path, 250000)
+            cores.append(core)
+        deadline = time.monotonic() + 10 + count
+        while not all(core.online for core in cores) \
+              and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not all(core.online for core in cores):
+            result["error"] = "not all printers came online"
+            return result
+        share = len(lines) // count
+        jobs = [gcoder.LightGCode(lines[:share]) for core in cores]
+        switches = context_switches()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for core, job in zip(cores, jobs):
+            core.startprint(job)
+        threads = threading.active_count()
+        finished = [None] * count
+        deadline = time.monotonic() + 120
+        while None in finished and time.monotonic() < deadline:
+            time.sleep(0.005)
+            for i, core in enumerate(cores):
+                if finished[i] is None and not core.printing:
+                    finished[i] = time.perf_counter() - start
+        seconds = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        switches = context_switches() - switches
+        if any(core.printing for core in cores):
+            result["error"] = "a print got stuck"
+            return result
+        sent = share * count
+        per_printer = sorted(share / seconds for seconds in finished)
+        median = percentile(per_printer, 0.50)
+        result.update({
+            "threads": threads,
+            "lines_per_second": sent / seconds,
+            "printer_lines_per_second": median,
+            "slowest_percent": (1 - per_printer[0] / median) * 100,
+            "switches_per_line": switches / sent,
+            "cpu_us_per_line": cpu / sent * 1e6,
+        })
+        process.stdin.write("stats\n")
+        process.stdin.flush()
+        stats = json.loads(process.stdout.readline())
+        result["rejected"] = sum(printer["rejected"]
+                                 for printer in stats["printers"])
+        result["latency_p50_ms"] = stats["latency_p50_ms"]
+        result["latency_p99_ms"] = stats["latency_p99_ms"]
+        return result
+    finally:
+        for core in cores:
+            core.disconnect()
+        for events in dispatchers:
+            events.stop()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Compares the printcore engines printing to many "
+                      "printers at once")
+    parser.add_argument("--engine", nargs = "+", choices = sorted(ENGINES),
+                        default = sorted(ENGINES, reverse = True))
+    parser.add_argument("--printers", nargs = "+", type = int,
+                        default = [1, 8, 32])
+    parser.add_argument("--lines", type = int, default = 40000,
+                        help = "lines to print over all printers together")
+    parser.add_argument("--advanced-ok", action = "store_true",
+                        help = "have the printers report their buffer space")
+    parser.add_argument("--dispatcher", action = "store_true",
+                        help = "deliver events through dispatchers, as the "
+                               "plugin does")
+    parser.add_argument("--serve", type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.advanced_ok)
+        return 0
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    lines = infill(args.lines)
+    print("%-8s %8s %7s %9s %11s %9s %10s %7s %7s %8s %8s" %
+          ("engine", "printers", "threads", "lines/s", "l/s/printer",
+           "slowest %", "switches/l", "us/line", "p50 ms", "p99 ms",
+           "rejected"))
+    failed = False
+    for count in args.printers:
+        for engine in args.engine:
+            result = run(engine, count, lines, args.advanced_ok,
+                         args.dispatcher)
+            if "error" in result:
+                print("%-8s %8d %s" % (engine, count, result["error"]))
+                failed = True
+                continue
+            print("%-8s %8d %7d %9.0f %11.0f %9.1f %10.2f %7.1f %7.2f %8.2f %8d" %
+                  (engine, count, result["threads"],
+                   result["lines_per_second"],
+                   result["printer_lines_per_second"],
+                   result["slowest_percent"], result["switches_per_line"],
+                   result["cpu_us_per_line"], result["latency_p50_ms"],
+                   result["latency_p99_ms"], result["rejected"]))
+            sys.stdout.flush()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
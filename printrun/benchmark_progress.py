@@ -0,0 +1,238 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares publishing the progress of a print for every line sent with
+publishing it from a timer.
+
+A job is printed to a virtual printer served from a process of its own,
+with event dispatchers set up as the plugin does. The progress goes to a
+stand-in for the print job model of Cura, which queues its change
+notifications to a thread standing in for the Qt thread, as signals are
+queued across threads. With --mode line the progress is published from
+the printsend event of every line, as the plugin did before; with --mode
+timer it is published from the Qt thread every --interval seconds, as it
+does now. Reported are the lines per second, the CPU time and context
+switches per line of this process, and the number of model updates. The
+best of --repeat runs is kept.
+
+    python -m printrun.benchmark_progress --lines 20000
+"""
+
+import argparse
+import logging
+import queue
+import sys
+import threading
+import time
+
+from . import gcoder
+from .benchmark import ENGINES, infill
+from .benchmark_engines import context_switches, start_printers
+from .eventdispatch import EventDispatcher
+
+MODES = ("line", "timer")
+
+class QtThread:
+    """Thread which runs posted functions in order, and a timer function
+    every interval seconds, like the Qt event loop with a QTimer"""
+
+    def __init__(self, interval = None, timeout = None):
+        self.interval = interval
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._run, name = "qt")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def post(self, function):
+        self.queue.put(function)
+
+    def stop(self):
+        """Runs the functions posted so far and stops the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        next_tick = None
+        if self.interval is not None:
+            next_tick = time.monotonic() + self.interval
+        while True:
+            wait = None
+            if next_tick is not None:
+                wait = max(0.0, next_tick - time.monotonic())
+            try:
+                function = self.queue.get(timeout = wait)
+            except queue.Empty:
+                next_tick += self.interval
+                self.timeout()
+                continue
+            if function is None:
+                return
+            function()
+
+class PrintJobModel:
+    """Stand-in for PrintJobOutputModel: a change of a value is notified
+    to the Qt thread, directly when it is made there and queued when it is
+    made on another thread"""
+
+    def __init__(self, qt):
+        self.qt = qt
+        self.time_elapsed = 0
+        self.time_total = 0
+        self.updates = 0
+
+    def _changed(self):
+        if threading.current_thread() is self.qt.thread:
+            self._refresh()
+        else:
+            self.qt.post(self._refresh)
+
+    def _refresh(self):
+        # What QML bindings on the value do, on the Qt thread
+        self.updates += 1
+
+    def updateTimeElapsed(self, time_elapsed):
+        if time_elapsed != self.time_elapsed:
+            self.time_elapsed = time_elapsed
+            self._changed()
+
+    def updateTimeTotal(self, time_total):
+        if time_total != self.time_total:
+            self.time_total = time_total
+            self._changed()
+
+class ProgressHandler:
+    """printcore event handler calling progress for every line sent"""
+
+    def __init__(self, progress):
+        self.on_printsend = lambda gline: progress()
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+def run(engine, mode, lines, interval):
+    """Prints lines with engine, publishing the progress the way mode
+    says, and returns the measurements"""
+    result = {"engine": engine, "mode": mode}
+    process, paths = start_printers(1, True)
+    core = ENGINES[engine]()
+    # As the plugin sets it up; with a single printer a dispatcher of its
+    # own is the same as the one loop cores share
+    core.analyze_print = False
+    core.dispatcher = EventDispatcher()
+    count = len(lines)
+    # The slicer estimate, corrected as the print goes on
+    estimated_time = count / 1000
+    start = None
+
+    def progress():
+        # What onPrintProgress did and _onProgressTimer does
+        if not core.printing or start is None:
+            return
+        elapsed = int(time.time() - start)
+        job.updateTimeElapsed(elapsed)
+        done = core.lineno / count
+        total = estimated_time
+        if done > .1:
+            total = estimated_time * (1 - done) + elapsed
+        job.updateTimeTotal(total)
+
+    if mode == "timer":
+        qt = QtThread(interval, progress)
+    else:
+        qt = QtThread()
+        core.addEventHandler(ProgressHandler(progress))
+    job = PrintJobModel(qt)
+    try:
+        core.connect(paths[0], 250000)
+        deadline = time.monotonic() + 10
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not core.online:
+            result["error"] = "the printer did not come online"
+            return result
+        gcode = gcoder.LightGCode(lines)
+        switches = context_switches()
+        cpu = time.process_time()
+        start = time.time()
+        started = time.perf_counter()
+        core.startprint(gcode)
+        deadline = time.monotonic() + 300
+        while core.printing and time.monotonic() < deadline:
+            time.sleep(0.01)
+        seconds = time.perf_counter() - started
+        if core.printing:
+            result["error"] = "the print got stuck"
+            return result
+        # The updates queued while printing are part of the cost
+        core.dispatcher.flush(10)
+        qt.stop()
+        cpu = time.process_time() - cpu
+        switches = context_switches() - switches
+        result.update({
+            "lines_per_second": count / seconds,
+            "cpu_us_per_line": cpu / count * 1e6,
+            "switches_per_line": switches / count,
+            "updates": job.updates,
+        })
+        return result
+    finally:
+        core.disconnect()
+        core.dispatcher.stop()
+        if qt.thread.is_alive():
+            qt.stop()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Compares publishing the progress of a print for every "
+                      "line with publishing it from a timer")
+    parser.add_argument("--engine", nargs = "+", choices = sorted(ENGINES),
+                        default = ["threads"])
+    parser.add_argument("--mode", nargs = "+", choices = MODES,
+                        default = list(MODES))
+    parser.add_argument("--lines", type = int, default = 20000)
+    parser.add_argument("--interval", type = float, default = 0.5,
+                        help = "seconds between updates from the timer")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "times to run every measurement, keeping the "
+                               "one with the least CPU time")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    lines = infill(args.lines)
+    print("%-8s %-6s %9s %8s %10s %8s" %
+          ("engine", "mode", "lines/s", "us/line", "switches/l", "updates"))
+    failed = False
+    for engine in args.engine:
+        for mode in args.mode:
+            results = [run(engine, mode, lines, args.interval)
+                       for i in range(args.repeat)]
+            errors = [result for result in results if "error" in result]
+            if errors:
+                print("%-8s %-6s %s" % (engine, mode, errors[0]["error"]))
+                failed = True
+                continue
+            best = min(results, key = lambda result: result["cpu_us_per_line"])
+            print("%-8s %-6s %9.0f %8.1f %10.2f %8d" %
+                  (engine, mode, best["lines_per_second"],
+                   best["cpu_us_per_line"], best["switches_per_line"],
+                   best["updates"]))
+            sys.stdout.flush()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
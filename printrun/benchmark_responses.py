@@ -0,0 +1,192 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures how long printcore takes to handle the lines a printer sends.
+
+Response streams as Marlin with ADVANCED_OK, RepRapFirmware and Grbl send
+them during a print are generated: mostly oks, with temperature reports,
+busy messages, resend requests and errors mixed in at the rates seen in
+sessions with real printers, after the greeting and the M115 and M503
+reports. For every stream the time per line is measured for classifying
+the lines alone, and for the whole receive path of printcore: splitting
+the data into lines, classifying, logging and acting on them. The best of
+--repeat runs is reported.
+
+    python -m printrun.benchmark_responses --lines 200000
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from .printcore import printcore
+from .responses import ResponseClassifier
+
+# Bytes handed to printcore at once, about what a read returns at 250000
+# baud while printing
+READ_SIZE = 256
+
+MARLIN_GREETING = [
+    "start",
+    "echo:Marlin 2.1.2.1",
+    "echo: Last Updated: 2023-07-13 | Author: (none, default config)",
+    "echo:Compiled: Jul 13 2023",
+    "echo: Free Memory: 2401  PlannerBufferBytes: 1600",
+    "FIRMWARE_NAME:Marlin 2.1.2.1 (Jul 13 2023 16:13:24) "
+    "SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 "
+    "MACHINE_TYPE:Ender-3 EXTRUDER_COUNT:1 "
+    "UUID:cede2a2f-41a2-4748-9b12-c55c62f367ff",
+    "Cap:SERIAL_XON_XOFF:0", "Cap:BINARY_FILE_TRANSFER:0",
+    "Cap:EEPROM:1", "Cap:VOLUMETRIC:1", "Cap:AUTOREPORT_POS:0",
+    "Cap:AUTOREPORT_TEMP:1", "Cap:PROGRESS:0", "Cap:PRINT_JOB:1",
+    "Cap:AUTOLEVEL:0", "Cap:RUNOUT:0", "Cap:Z_PROBE:0",
+    "Cap:LEVELING_DATA:0", "Cap:BUILD_PERCENT:0", "Cap:SOFTWARE_POWER:0",
+    "Cap:TOGGLE_LIGHTS:0", "Cap:CASE_LIGHT_BRIGHTNESS:0",
+    "Cap:EMERGENCY_PARSER:1", "Cap:HOST_ACTION_COMMANDS:0",
+    "Cap:PROMPT_SUPPORT:0", "Cap:SDCARD:1", "Cap:AUTOREPORT_SD_STATUS:0",
+    "Cap:LONG_FILENAME:1", "Cap:EXTENDED_M20:0", "Cap:THERMAL_PROTECTION:1",
+    "Cap:MOTION_MODES:0", "Cap:ARCS:1", "Cap:BABYSTEPPING:0",
+    "Cap:CHAMBER_TEMPERATURE:0", "Cap:COOLER_TEMPERATURE:0",
+    "Cap:MEATPACK:0", "Cap:CONFIG_EXPORT:0",
+    "echo:; Steps per unit:", "echo:  M92 X80.00 Y80.00 Z400.00 E93.00",
+    "echo:; Max feedrates (units/s):", "echo:  M203 X500.00 Y500.00 Z5.00 E25.00",
+    "echo:; Max Acceleration (units/s2):", "echo:  M201 X500.00 Y500.00 Z100.00 E5000.00",
+    "echo:; Acceleration (units/s2) (P<print-accel> R<retract-accel> T<travel-accel>):",
+    "echo:  M204 P500.00 R500.00 T1000.00",
+    "echo:; Advanced (B<min_segment_time_us> S<min_feedrate> T<min_travel_feedrate> J<junc_dev>):",
+    "echo:  M205 B20000.00 S0.00 T0.00 J0.08",
+    "ok",
+]
+
+def marlin(count, seed = 0):
+    """Marlin with ADVANCED_OK and temperature auto-reports"""
+    rand = random.Random(seed)
+    lines = list(MARLIN_GREETING)
+    lineno = 0
+    while len(lines) < count:
+        roll = rand.random()
+        if roll < 0.02:
+            lines.append(" T:%.2f /210.00 B:%.2f /60.00 @:%d B@:%d" % (
+                rand.uniform(208, 212), rand.uniform(59, 61),
+                rand.randint(0, 127), rand.randint(0, 127)))
+        elif roll < 0.025:
+            lines.append("echo:busy: processing")
+        elif roll < 0.0255:
+            lines.append("Error:checksum mismatch, Last Line: %d" % lineno)
+            lines.append("Resend: %d" % (lineno + 1))
+            lines.append("ok N%d P15 B3" % lineno)
+        else:
+            lineno += 1
+            lines.append("ok N%d P%d B%d" % (lineno, rand.randint(0, 15),
+                                            rand.randint(0, 3)))
+    return lines[:count]
+
+def reprapfirmware(count, seed = 0):
+    """RepRapFirmware, polled with M105 about once a second"""
+    rand = random.Random(seed)
+    lines = ["FIRMWARE_NAME: RepRapFirmware for Duet 2 WiFi/Ethernet "
+             "FIRMWARE_VERSION: 3.4.6 ELECTRONICS: Duet WiFi 1.02 or later "
+             "FIRMWARE_DATE: 2023-07-21 14:08:28", "ok"]
+    lineno = 0
+    while len(lines) < count:
+        roll = rand.random()
+        if roll < 0.01:
+            lines.append("ok T:%.1f /210.0 B:%.1f /60.0" % (
+                rand.uniform(208, 212), rand.uniform(59, 61)))
+        elif roll < 0.0105:
+            lines.append("Error: Bad command: G1 X1%d" % lineno)
+            lines.append("Resend: %d" % (lineno + 1))
+            lines.append("ok")
+        elif roll < 0.012:
+            lines.append("Warning: Heater 1 predicted maximum temperature "
+                         "at full power is 298C")
+        else:
+            lineno += 1
+            lines.append("ok")
+    return lines[:count]
+
+def grbl(count, seed = 0):
+    """Grbl 1.1, polled with ? for status reports"""
+    rand = random.Random(seed)
+    lines = ["Grbl 1.1h ['$' for help]", "[MSG:'$H'|'$X' to unlock]", "ok"]
+    while len(lines) < count:
+        roll = rand.random()
+        if roll < 0.05:
+            lines.append("<Run|MPos:%.3f,%.3f,%.3f|FS:%d,0|WCO:0.000,0.000,0.000>" % (
+                rand.uniform(0, 200), rand.uniform(0, 200), rand.uniform(0, 5),
+                rand.choice((1500, 3000, 6000))))
+        elif roll < 0.0505:
+            lines.append("error:%d" % rand.choice((2, 20, 22, 33)))
+        elif roll < 0.051:
+            lines.append("[MSG:Pgm End]")
+        else:
+            lines.append("ok")
+    return lines[:count]
+
+STREAMS = {"marlin": marlin, "reprapfirmware": reprapfirmware, "grbl": grbl}
+
+def time_classify(lines):
+    """Seconds to classify lines with a new classifier"""
+    classify = ResponseClassifier().classify
+    lines = [line + "\n" for line in lines]
+    start = time.perf_counter()
+    for line in lines:
+        classify(line)
+    return time.perf_counter() - start
+
+def time_receive(lines):
+    """Seconds printcore takes to handle lines arriving in reads of
+    READ_SIZE bytes"""
+    core = printcore()
+    # As connected, without a port to write to
+    core.printer_tcp = None
+    core.online = True
+    data = ("\n".join(lines) + "\n").encode("ascii")
+    reads = [data[start:start + READ_SIZE]
+             for start in range(0, len(data), READ_SIZE)]
+    start = time.perf_counter()
+    for chunk in reads:
+        core._handle_lines(core._received(chunk))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Measures how long printcore takes to handle the lines "
+                      "printers send")
+    parser.add_argument("--stream", nargs = "+", choices = sorted(STREAMS),
+                        default = sorted(STREAMS))
+    parser.add_argument("--lines", type = int, default = 200000)
+    parser.add_argument("--repeat", type = int, default = 5,
+                        help = "times to run every measurement, keeping the "
+                               "best")
+    parser.add_argument("--seed", type = int, default = 1)
+    args = parser.parse_args()
+    # Errors in the streams are expected
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    print("%-16s %12s %12s" % ("stream", "classify us", "receive us"))
+    for name in args.stream:
+        lines = STREAMS[name](args.lines, args.seed)
+        classify = min(time_classify(lines) for i in range(args.repeat))
+        receive = min(time_receive(lines) for i in range(args.repeat))
+        print("%-16s %12.2f %12.2f" % (name, classify / len(lines) * 1e6,
+                                       receive / len(lines) * 1e6))
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the send path of printcore: the time from an ok coming in to
+the next line being written, and the CPU used while idle.
+
+Unlike printrun.benchmark, which prints to the virtual printer, the lines
+go to a stand-in that answers every line with an ok as soon as it has
+read it, from a process of its own. The time measured is then that of
+printcore alone: reading the ok, waking the thread or coroutine that
+sends, and writing the next line. The lines are sent in lock-step, one
+line per ok, as without ADVANCED_OK.
+
+    python -m printrun.benchmark_sendpath --lines 5000 --idle 5
+"""
+
+import argparse
+import logging
+import os
+import pty
+import subprocess
+import sys
+import time
+import tty
+
+from . import gcoder
+from .benchmark import ENGINES, Recorder, infill, percentile
+
+def serve_acks():
+    """Answers every line coming in on a new pseudo terminal with an ok,
+    until the process is killed. Prints the path of the terminal first."""
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    print(os.ttyname(slave), flush = True)
+    pending = 0
+    while True:
+        data = os.read(master, 4096)
+        pending += data.count(b"\n")
+        if pending:
+            os.write(master, b"ok\n" * pending)
+            pending = 0
+
+def start_acks():
+    """Starts serve_acks() in a process of its own, returns the process
+    and the path of its pseudo terminal"""
+    env = dict(os.environ)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_parent] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    process = subprocess.Popen([sys.executable, "-m",
+                                "printrun.benchmark_sendpath", "--serve"],
+                               stdout = subprocess.PIPE,
+                               universal_newlines = True, env = env)
+    path = process.stdout.readline().strip()
+    if not path:
+        process.wait()
+        raise RuntimeError("The stand-in printer did not start")
+    return process, path
+
+def run(engine, lines, idle):
+    """Prints lines with engine to the stand-in, then stays connected for
+    idle seconds, and returns the measurements"""
+    result = {"engine": engine}
+    process, path = start_acks()
+    core = ENGINES[engine]()
+    try:
+        core.connect(path, 250000)
+        deadline = time.monotonic() + 10
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not core.online:
+            result["error"] = "the printer did not come online"
+            return result
+        recorder = Recorder(core)
+        gcode = gcoder.LightGCode(lines)
+        cpu = time.process_time()
+        start = time.perf_counter()
+        core.startprint(gcode)
+        deadline = time.monotonic() + 60
+        while core.printing and time.monotonic() < deadline:
+            time.sleep(0.005)
+        seconds = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        if core.printing:
+            core.cancelprint()
+            result["error"] = "the print got stuck"
+            return result
+        latencies = [latency * 1e6 for latency in recorder.latencies]
+        result.update({
+            "lines_per_second": len(lines) / seconds,
+            "ok_latency_p50_us": percentile(latencies, 0.50),
+            "ok_latency_p99_us": percentile(latencies, 0.99),
+            "ok_latency_max_us": max(latencies),
+            "cpu_us_per_line": cpu / len(lines) * 1e6,
+        })
+        # Give the print thread time to finish before measuring idle
+        time.sleep(0.5)
+        cpu = time.process_time()
+        time.sleep(idle)
+        result["idle_cpu_percent"] = (time.process_time() - cpu) / idle * 100
+        return result
+    finally:
+        core.disconnect()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Measures the time from an ok to the next write, and "
+                      "the CPU used while idle")
+    parser.add_argument("--engine", nargs = "+", choices = sorted(ENGINES),
+                        default = sorted(ENGINES, reverse = True))
+    parser.add_argument("--lines", type = int, default = 5000,
+                        help = "lines to print in every run")
+    parser.add_argument("--idle", type = float, default = 5.0,
+                        help = "seconds to stay connected after the print")
+    parser.add_argument("--serve", action = "store_true",
+                        help = argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_acks()
+        return 0
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    lines = infill(args.lines)
+    print("%-8s %9s %9s %9s %9s %8s %7s" %
+          ("engine", "lines/s", "p50 us", "p99 us", "max us", "us/line",
+           "idle %"))
+    failed = False
+    for engine in args.engine:
+        result = run(engine, lines, args.idle)
+        if "error" in result:
+            print("%-8s %s" % (engine, result["error"]))
+            failed = True
+            continue
+        print("%-8s %9.0f %9.0f %9.0f %9.0f %8.1f %7.2f" %
+              (engine, result["lines_per_second"],
+               result["ok_latency_p50_us"], result["ok_latency_p99_us"],
+               result["ok_latency_max_us"], result["cpu_us_per_line"],
+               result["idle_cpu_percent"]))
+        sys.stdout.flush()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
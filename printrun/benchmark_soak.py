@@ -0,0 +1,140 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Soak test of the memory printcore holds while it prints.
+
+A long job is printed to a port which discards what is written, with an
+ok fed back for every line and a resend requested every --resend-every
+lines. The send path is driven directly from this thread, so millions of
+lines go through in a minute or so. The job is prepared before the first
+sample; what the resident memory does after that is what printcore keeps
+per line sent. The exit status is 1 if it
+grew by more than --max-growth MB between the first and the last sample.
+
+    python -m printrun.benchmark_soak --lines 2000000
+"""
+
+import argparse
+import gc
+import logging
+import resource
+import sys
+import time
+
+from .benchmark import infill
+from .gcodefile import GCodeSpool, MappedGCode
+from .printcore import printcore
+from .responses import ResponseClassifier
+
+class NullPort:
+    """Serial port which discards what is written to it"""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+def resident_mb():
+    """Anonymous resident memory of this process in MB, or the peak
+    resident memory where that is not known. Pages of the mapped job are
+    left out, as they are only cached from the file."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+def make_job(count):
+    """Returns a MappedGCode of count lines"""
+    block = infill(10000)
+    spool = GCodeSpool()
+    for start in range(0, count, len(block)):
+        spool.write("\n".join(block[:count - start]) + "\n")
+    gcode = MappedGCode(spool.map())
+    spool.close()
+    return gcode
+
+def soak(count, resend_every, samples):
+    """Prints a job of count lines, returns the samples taken along the
+    way as (lines sent, seconds, resident MB) and the core"""
+    gcode = make_job(count)
+    core = printcore()
+    core.printer = NullPort()
+    core.printer_tcp = None
+    core.online = True
+    # The send path is driven from this thread
+    core._start_print_thread = lambda resuming: None
+    classify = ResponseClassifier().classify
+    ok = classify("ok\n")
+    core.startprint(gcode)
+    core._acknowledge(ok)  # the M110
+    gc.collect()
+    taken = []
+    step = max(1, count // samples)
+    next_sample = 0
+    next_resend = resend_every
+    start = time.perf_counter()
+    sent = 0
+    while core.printing:
+        # The line numbers are reset at the end of the print
+        sent = max(sent, core.lineno)
+        if core.lineno >= next_sample and core.resendfrom < 0:
+            taken.append((core.lineno, time.perf_counter() - start,
+                          resident_mb()))
+            next_sample += step
+        core._send_batch()
+        if core.lineno >= next_resend and core.resendfrom < 0:
+            # The firmware missed a line a few lines back
+            core._process_line(classify("Resend: %d\n" % (core.lineno - 3)))
+            next_resend += resend_every
+        core._acknowledge(ok)
+    gc.collect()
+    taken.append((sent, time.perf_counter() - start, resident_mb()))
+    return taken, core
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Prints a long job to a null port and reports how the "
+                      "memory of printcore develops")
+    parser.add_argument("--lines", type = int, default = 2000000)
+    parser.add_argument("--resend-every", type = int, default = 50000,
+                        help = "lines between resend requests")
+    parser.add_argument("--samples", type = int, default = 10)
+    parser.add_argument("--max-growth", type = float, default = 8.0,
+                        help = "MB the memory may grow during the print")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    taken, core = soak(args.lines, args.resend_every, args.samples)
+    print("%10s %9s %10s" % ("lines", "seconds", "memory MB"))
+    for lines, seconds, memory in taken:
+        print("%10d %9.1f %10.1f" % (lines, seconds, memory))
+    growth = taken[-1][2] - taken[0][2]
+    print("%d lines resent after %d resend requests; holding %d lines for "
+          "resends, %d sent commands" % (core.metrics.lines_resent,
+                                         core.metrics.resends,
+                                         len(core.sentlines),
+                                         len(core.sent)))
+    print("memory grew by %.1f MB" % growth)
+    return 1 if growth > args.max_growth else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
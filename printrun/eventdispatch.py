@@ -0,0 +1,228 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+
+# Overflow policies, for events posted while the queue is full
+DROP = "drop"  # the event is discarded
+COALESCE = "coalesce"  # only the last event of every name (and source) is kept
+BLOCK = "block"  # posting waits until there is room in the queue
+
+# printcore events which are sent for every line. Other events (start, end,
+# error, online, ...) are always queued, whatever the overflow policy. recv
+# is not among them, since a received line can be an error or a reply the
+# host waits for; printcore marks the recv events of plain oks and
+# temperature reports droppable when it posts them.
+DROPPABLE = ("temp", "send", "printsend", "preprintsend", "layerchange")
+
+class EventDispatcher:
+    """Delivers events on a thread of its own, so slow event handlers do not
+    hold up the thread that posts them.
+
+    Posting an event appends it to a deque, which needs no lock, and only
+    wakes the delivery thread up if it is waiting. The delivery thread
+    takes up to batch_size events at a time and calls them in the order
+    they were posted. The queue holds up to maxsize events; when it is full,
+    droppable events are handled according to the overflow policy. Events
+    kept by COALESCE are delivered after the batch that was being delivered
+    when they came in, so they can overtake queued events of other names.
+    One dispatcher can be shared by several printcore instances, which pass
+    themselves as the source of their events so they are coalesced apart.
+
+    BLOCK never waits on the delivery thread itself, which would wait for
+    itself, and gives up waiting when no event has been delivered for
+    block_timeout seconds, as when a handler waits for the thread that is
+    posting (disconnect() joining the read thread, for one). In both cases
+    the event is coalesced instead.
+    """
+
+    def __init__(self, maxsize = 4096, overflow = COALESCE, batch_size = 256,
+                 droppable = DROPPABLE, block_timeout = 1.0):
+        if overflow not in (DROP, COALESCE, BLOCK):
+            raise ValueError("unknown overflow policy %r" % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.droppable = frozenset(droppable)
+        self.block_timeout = block_timeout
+        # Number of events delivered when BLOCK last gave up waiting
+        self.stalled_at = None
+        self.queue = deque()
+        self.coalesced = {}
+        self.overflow_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.drained = threading.Event()
+        self.idle = False
+        self.thread = None
+        self.stopped = False
+        # Statistics, see stats()
+        self.posted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced_count = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target = self._run,
+                                           name = "printcore events")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout = None):
+        """Delivers the queued events and stops the delivery thread"""
+        if self.thread is None:
+            return
+        self.stopped = True
+        self.wakeup.set()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def post(self, name, function, args = (), source = None,
+             droppable = None):
+        """Queues function(*args) to be called for the event name, posted
+        by source. droppable tells whether the event is subject to the
+        overflow policy, by default it is if name is one of the droppable
+        names."""
+        if self.thread is None:
+            self.start()
+        queue = self.queue
+        self.posted += 1
+        if droppable is None:
+            droppable = name in self.droppable
+        if len(queue) >= self.maxsize and droppable:
+            if self.overflow == BLOCK \
+               and threading.current_thread() is not self.thread:
+                with self.overflow_lock:
+                    self.blocked += 1
+                self._wait_for_room()
+            if len(queue) >= self.maxsize and not self.stopped:
+                with self.overflow_lock:
+                    if self.overflow != DROP:
+                        key = (source, name)
+                        if key in self.coalesced:
+                            self.dropped += 1
+                        self.coalesced[key] = (function, args)
+                        self.coalesced_count += 1
+                    else:
+                        self.dropped += 1
+                if self.idle:
+                    self.wakeup.set()
+                return
+        queue.append((function, args))
+        depth = len(queue)
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.idle:
+            self.wakeup.set()
+
+    def _wait_for_room(self):
+        """Waits until the queue is no longer full, or no event has been
+        delivered for block_timeout seconds. Once it gave up, it does not
+        wait again before the next event is delivered."""
+        queue = self.queue
+        delivered = self.delivered
+        if delivered == self.stalled_at:
+            return
+        progress = time.monotonic()
+        while len(queue) >= self.maxsize and not self.stopped:
+            self.drained.wait(0.1)
+            self.drained.clear()
+            now = time.monotonic()
+            if self.delivered != delivered:
+                delivered = self.delivered
+                progress = now
+            elif now - progress >= self.block_timeout:
+                self.stalled_at = delivered
+                return
+
+    @property
+    def depth(self):
+        """Number of events waiting to be delivered"""
+        return len(self.queue) + len(self.coalesced)
+
+    def stats(self):
+        """Returns the current queue depth and event counts as a dict.
+        dropped counts the events which were never delivered, coalesced
+        the events which were held back because the queue was full."""
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "posted": self.posted,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced_count,
+            "blocked": self.blocked,
+        }
+
+    def flush(self, timeout = None):
+        """Waits until every event posted so far has been delivered.
+        Returns False if that did not happen within timeout seconds."""
+        if self.thread is None or threading.current_thread() is self.thread:
+            return not self.depth
+        done = threading.Event()
+        self.queue.append((None, done))
+        self.wakeup.set()
+        return done.wait(timeout)
+
+    def _take(self):
+        """Takes the next batch of events from the queue"""
+        queue = self.queue
+        batch = []
+        popleft = queue.popleft
+        try:
+            for i in range(self.batch_size):
+                batch.append(popleft())
+        except IndexError:
+            pass
+        if self.coalesced:
+            with self.overflow_lock:
+                coalesced = self.coalesced
+                self.coalesced = {}
+            batch.extend(coalesced.values())
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if not batch:
+                if self.stopped:
+                    return
+                self.idle = True
+                # An event posted before idle was set has to be seen here
+                if self.queue or self.coalesced:
+                    self.idle = False
+                    continue
+                self.wakeup.wait()
+                self.idle = False
+                self.wakeup.clear()
+                continue
+            for function, args in batch:
+                if function is None:  # flush() is waiting for this
+                    args.set()
+                    continue
+                try:
+                    function(*args)
+                except:
+                    logging.error(traceback.format_exc())
+                self.delivered += 1
+            self.drained.set()
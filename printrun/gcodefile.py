@@ -0,0 +1,265 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import mmap
+import tempfile
+from array import array
+
+from printrun import gcoder
+try:
+    from printrun import gcoder_vec
+except ImportError as e:
+    logging.warning("Vectorized G-code analysis unavailable: %s" % e)
+    gcoder_vec = None
+
+def map_file(path):
+    """Returns a read-only memory map of the file at path"""
+    with open(path, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:  # empty files can not be mapped
+            return b""
+
+class GCodeSpool:
+    """Write-only text stream for G-code which spools to a temporary file.
+
+    The G-code is kept in memory up to max_size bytes and rolled over to a
+    file on disk after that. It is hashed while it is written, and read
+    back through map() as a whole, so the job is never held as one string.
+    """
+
+    def __init__(self, max_size = 8 * 1024 * 1024):
+        self.max_size = max_size
+        self.file = tempfile.SpooledTemporaryFile(max_size = max_size)
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+        return len(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        """SHA-256 of the G-code written so far"""
+        return self.hash.hexdigest()
+
+    def map(self):
+        """Returns the spooled G-code as a read-only buffer: a memory map of
+        the temporary file if the spool rolled over to disk, bytes otherwise.
+        The buffer stays valid after the spool is closed."""
+        self.file.flush()
+        if self.size > self.max_size:
+            return mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.file.seek(0)
+        return self.file.read()
+
+class MappedLines:
+    """Sequence of the lines of a MappedGCode, decoded when accessed"""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        # Lines appended after preparation, e.g. by printcore.send()
+        self.appended = []
+
+    def __len__(self):
+        return len(self.gcode.line_starts) + len(self.appended)
+
+    def __getitem__(self, i):
+        mapped = len(self.gcode.line_starts)
+        if i < 0:
+            i += len(self)
+        if i >= mapped:
+            return self.appended[i - mapped]
+        return self.gcode.line_class(self.gcode.raw(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, gline):
+        self.appended.append(gline)
+
+class MappedLayer:
+    """A layer of a MappedGCode: a range of line indices into the mapping"""
+
+    __slots__ = ("gcode", "start", "count", "duration", "z")
+
+    def __init__(self, gcode, start, count, z = None):
+        self.gcode = gcode
+        self.start = start
+        self.count = count
+        self.z = z
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("layer line index out of range")
+        return self.gcode.lines[self.start + i]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+class MappedGCode(gcoder.GCode):
+    """G-code container backed by a memory-mapped file or another buffer.
+
+    Instead of one line object per line, only the start offset and length
+    of every non-empty line is stored, along with the layer and line index
+    arrays. Lines are decoded from the mapping when they are accessed, so
+    all_layers[layer][line].raw, has_index() and idxs() work like they do on
+    LightGCode while memory use stays at a few bytes per line.
+    """
+
+    line_class = gcoder.LightLine
+
+    # Analyse with the NumPy engine of gcoder_vec when it is available
+    vectorized = True
+
+    # Analysis results and parser state kept by get_index() besides the
+    # line and layer indices
+    index_attributes = (
+        "imperial", "relative", "relative_e", "current_tool",
+        "home_x", "home_y", "home_z",
+        "current_x", "current_y", "current_z", "current_e", "current_f",
+        "offset_x", "offset_y", "offset_z", "offset_e",
+        "total_e", "max_e", "current_e_multi", "total_e_multi",
+        "max_e_multi", "offset_e_multi",
+        "filament_length", "filament_length_multi", "duration",
+        "xmin", "xmax", "ymin", "ymax", "zmin", "zmax",
+        "width", "depth", "height", "est_layer_height", "all_zs",
+        "motion_limits", "checkpoints")
+
+    buffer = None
+    line_starts = None
+    line_lengths = None
+
+    @classmethod
+    def from_file(cls, path, home_pos = None, layer_callback = None,
+                  background = False, motion_limits = None):
+        return cls(map_file(path), home_pos, layer_callback,
+                   background = background, motion_limits = motion_limits)
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        self.buffer = data if data is not None else b""
+        self.line_starts = array('Q')
+        self.line_lengths = array('I')
+        self._next_layer_start = 0
+        if len(self.buffer):
+            self.home_pos = home_pos
+            self.lines = MappedLines(self)
+            if self.vectorized and gcoder_vec is not None:
+                gcoder_vec.analyse(self, self.buffer, layer_callback)
+            else:
+                self._preprocess(self._scan(), build_layers = True,
+                                 layer_callback = layer_callback)
+        else:
+            super().prepare(None, home_pos, layer_callback)
+            self.lines = MappedLines(self)
+
+    @classmethod
+    def from_index(cls, data, index):
+        """Creates a prepared MappedGCode for data from the result of
+        get_index() on the same data, without analysing it again"""
+        gcode = cls(deferred = True)
+        gcode.buffer = data
+        gcode.line_starts = index["line_starts"]
+        gcode.line_lengths = index["line_lengths"]
+        gcode.layer_idxs = index["layer_idxs"]
+        gcode.line_idxs = index["line_idxs"]
+        gcode.lines = MappedLines(gcode)
+        gcode.all_layers = []
+        for start, count, z, duration in index["layers"]:
+            layer = MappedLayer(gcode, start, count, z)
+            layer.duration = duration
+            gcode.all_layers.append(layer)
+        for name in cls.index_attributes:
+            setattr(gcode, name, index[name])
+        gcode.append_layer_id = len(gcode.all_layers)
+        gcode.append_layer = gcoder.Layer([])
+        gcode.append_layer.duration = 0
+        gcode.all_layers.append(gcode.append_layer)
+        return gcode
+
+    def get_index(self):
+        """Returns everything the analysis of the G-code produced as a dict
+        of plain values and arrays, for from_index()"""
+        self.wait_prepared()
+        if self.append_layer is None:
+            raise ValueError("the analysis of the G-code did not complete")
+        # Lines appended after the analysis are left out
+        count = len(self.line_starts)
+        end = self.append_layer_id
+        index = {
+            "line_starts": self.line_starts[:count],
+            "line_lengths": self.line_lengths[:count],
+            "layer_idxs": self.layer_idxs[:count],
+            "line_idxs": self.line_idxs[:count],
+            "layers": [(layer.start, layer.count, layer.z, layer.duration)
+                       for layer in self.all_layers[:end]],
+        }
+        for name in self.index_attributes:
+            index[name] = getattr(self, name)
+        return index
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def raw(self, i):
+        """Returns the raw text of mapped line i"""
+        start = self.line_starts[i]
+        return self.buffer[start:start + self.line_lengths[i]].decode('utf-8', 'replace')
+
+    def _scan(self):
+        """Indexes the non-empty lines of the buffer, yielding a light line
+        for each of them to be analysed"""
+        buffer = self.buffer
+        find = buffer.find
+        line_starts = self.line_starts
+        line_lengths = self.line_lengths
+        line_class = self.line_class
+        size = len(buffer)
+        pos = 0
+        while pos < size:
+            end = find(b"\n", pos)
+            if end < 0:
+                end = size
+            segment = buffer[pos:end]
+            stripped = segment.strip()
+            if stripped:
+                line_starts.append(pos + len(segment) - len(segment.lstrip()))
+                line_lengths.append(len(stripped))
+                yield line_class(stripped.decode('utf-8', 'replace'))
+            pos = end + 1
+
+    def _build_layer(self, lines, z):
+        # The lines of the layer are dropped, only their index range is kept
+        layer = MappedLayer(self, self._next_layer_start, len(lines), z)
+        self._next_layer_start += len(lines)
+        return layer
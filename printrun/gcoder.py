@@ -19,7 +19,10 @@ import re
 import math
 import datetime
 import logging
+import threading
+import traceback
 from array import array
+from bisect import bisect_left
 
 gcode_parsed_args = ["x", "y", "e", "f", "z", "i", "j"]
 gcode_parsed_nonargs = ["g", "t", "m", "n"]
@@ -30,6 +33,14 @@ m114_exp = re.compile("\([^\(\)]*\)|[/\*].*\n|([XYZ]):?([-+]?[0-9]*\.?[0-9]*)")
 specific_exp = "(?:\([^\(\)]*\))|(?:;.*)|(?:[/\*].*\n)|(%s[-+]?[0-9]*\.?[0-9]*)"
 move_gcodes = ["G0", "G1", "G2", "G3"]
 
+# The parser state is recorded every CHECKPOINT_INTERVAL lines while a job
+# is analysed, see GCode.state_at()
+CHECKPOINT_INTERVAL = 1024
+CHECKPOINT_FIELDS = ("imperial", "relative", "relative_e", "current_tool",
+                     "current_x", "current_y", "current_z", "current_e",
+                     "current_f", "offset_x", "offset_y", "offset_z",
+                     "offset_e")
+
 class PyLine:
 
     __slots__ = ('x', 'y', 'z', 'e', 'f', 'i', 'j',
@@ -64,6 +75,12 @@ except Exception as e:
     Line = PyLine
     LightLine = PyLightLine
 
+try:
+    from . import motionplanner
+except ImportError as e:
+    logging.warning("Motion planner unavailable: %s" % e)
+    motionplanner = None
+
 def find_specific_code(line, code):
     exp = specific_exp % code
     bits = [bit for bit in re.findall(exp, line.raw) if bit]
@@ -117,6 +134,9 @@ class GCode:
     all_layers = None
     layer_idxs = None
     line_idxs = None
+    # Parser state before every CHECKPOINT_INTERVAL-th line, as tuples of
+    # the CHECKPOINT_FIELDS
+    checkpoints = None
     append_layer = None
     append_layer_id = None
 
@@ -173,6 +193,16 @@ class GCode:
 
     est_layer_height = None
 
+    # False while the G-code is being analysed in a background thread, see
+    # prepare_in_background()
+    prepared = True
+    prepare_thread = None
+    _progress = None
+
+    # motionplanner.MachineLimits of the printer; when set, the durations
+    # of the layers are planned with them instead of estimated per move
+    motion_limits = None
+
     # abs_x is the current absolute X in machine current coordinate system
     # (after the various G92 transformations) and can be used to store the
     # absolute position of the head at a given time
@@ -217,18 +247,31 @@ class GCode:
     layers_count = property(_get_layers_count)
 
     def __init__(self, data = None, home_pos = None,
-                 layer_callback = None, deferred = False):
-        if not deferred:
+                 layer_callback = None, deferred = False, background = False,
+                 motion_limits = None):
+        if motion_limits is not None:
+            self.motion_limits = motion_limits
+        if background:
+            self.prepare_in_background(data, home_pos, layer_callback)
+        elif not deferred:
             self.prepare(data, home_pos, layer_callback)
 
     def prepare(self, data = None, home_pos = None, layer_callback = None):
         self.home_pos = home_pos
         if data:
             line_class = self.line_class
-            self.lines = [line_class(l2) for l2 in
-                          (l.strip() for l in data)
-                          if l2]
-            self._preprocess(build_layers = True,
+            lines = self.lines = []
+
+            def read_lines():
+                # Lines are stored as they are analysed, so the first
+                # layers are available before the whole input has been read
+                for l in data:
+                    l = l.strip()
+                    if l:
+                        gline = line_class(l)
+                        lines.append(gline)
+                        yield gline
+            self._preprocess(read_lines(), build_layers = True,
                              layer_callback = layer_callback)
         else:
             self.lines = []
@@ -240,7 +283,67 @@ class GCode:
             self.layer_idxs = array('I', [])
             self.line_idxs = array('I', [])
 
+    def prepare_in_background(self, data = None, home_pos = None,
+                              layer_callback = None):
+        """Runs prepare() in a background thread.
+
+        A line can be accessed as soon as its layer has been built, which
+        has_index() waits for. The bounding box, filament length and
+        duration are only set when the analysis is complete, at which point
+        prepared becomes True."""
+        self.prepared = False
+        self._progress = threading.Condition()
+
+        def on_layer(gcode, layer_idx):
+            with self._progress:
+                self._progress.notify_all()
+            if layer_callback is not None:
+                layer_callback(gcode, layer_idx)
+
+        def run():
+            try:
+                self.prepare(data, home_pos, on_layer)
+            except Exception:
+                logging.error("G-code analysis failed:\n" + traceback.format_exc())
+                # Only keep the lines of the layers which were built
+                count = self.ready_count()
+                if self.layer_idxs is not None:
+                    del self.layer_idxs[count:]
+                    del self.line_idxs[count:]
+            finally:
+                with self._progress:
+                    self.prepared = True
+                    self._progress.notify_all()
+
+        self.prepare_thread = threading.Thread(target = run,
+                                               name = "gcode analysis")
+        self.prepare_thread.daemon = True
+        self.prepare_thread.start()
+
+    def wait_prepared(self, timeout = None):
+        """Waits for a background analysis to complete, returns prepared"""
+        if not self.prepared:
+            with self._progress:
+                self._progress.wait_for(lambda: self.prepared, timeout)
+        return self.prepared
+
+    def ready_count(self):
+        """Number of lines, from the first one, which can be accessed"""
+        layer_idxs = self.layer_idxs
+        all_layers = self.all_layers
+        if layer_idxs is None or all_layers is None:
+            return 0
+        if self.prepared:
+            return len(layer_idxs)
+        # Layer indices only increase while the G-code is analysed, and
+        # the lines of the layer being built come last
+        return bisect_left(layer_idxs, len(all_layers))
+
     def has_index(self, i):
+        if not self.prepared:
+            with self._progress:
+                self._progress.wait_for(
+                    lambda: self.prepared or i < self.ready_count())
         return i < len(self)
     def __len__(self):
         return len(self.line_idxs)
@@ -310,6 +413,8 @@ class GCode:
         command = command.strip()
         if not command:
             return
+        # Appended lines go after the analysed ones
+        self.wait_prepared()
         gline = Line(command)
         self._preprocess([gline])
         if store:
@@ -382,12 +487,17 @@ class GCode:
             # Initialize layers
             all_layers = self.all_layers = []
             all_zs = self.all_zs = set()
-            layer_idxs = self.layer_idxs = []
-            line_idxs = self.line_idxs = []
+            layer_idxs = self.layer_idxs = array('I')
+            line_idxs = self.line_idxs = array('I')
+            checkpoints = self.checkpoints = []
 
             layer_id = 0
             layer_line = 0
 
+            estimator = None
+            if self.motion_limits is not None and motionplanner is not None:
+                estimator = motionplanner.Estimator(self.motion_limits)
+
             last_layer_z = None
             prev_z = None
             prev_base_z = (None, None)
@@ -399,6 +509,11 @@ class GCode:
         else:
             get_line = lambda l: l
         for true_line in lines:
+            if build_layers and not len(layer_idxs) % CHECKPOINT_INTERVAL:
+                checkpoints.append((imperial, relative, relative_e,
+                                    current_tool, current_x, current_y,
+                                    current_z, current_e, self.current_f,
+                                    offset_x, offset_y, offset_z, offset_e))
             # # Parse line
             # Use a heavy copy of the light line to preprocess
             line = get_line(true_line)
@@ -601,6 +716,17 @@ class GCode:
                             moveduration /= 1000.0
                             totalduration += moveduration
 
+                    if estimator is not None:
+                        if line.is_move:
+                            estimator.move(len(layer_idxs), current_x, current_y,
+                                           current_z, current_e, self.current_f / 60.0)
+                        elif line.command == "G4":
+                            estimator.stop(len(layer_idxs), current_x, current_y,
+                                           current_z, current_e, (P(line) or 0) / 1000.0)
+                        elif line.command == "G28":
+                            estimator.stop(len(layer_idxs), current_x, current_y,
+                                           current_z, current_e)
+
                     # FIXME : looks like this needs to be tested with "lift Z on move"
                     if line.z is not None:
                         if line.command == "G92":
@@ -614,24 +740,10 @@ class GCode:
                     # FIXME: the logic behind this code seems to work, but it might be
                     # broken
                     if cur_z != prev_z:
-                        if prev_z is not None and last_layer_z is not None:
-                            offset = self.est_layer_height if self.est_layer_height else 0.01
-                            if abs(prev_z - last_layer_z) < offset:
-                                if self.est_layer_height is None:
-                                    zs = sorted([l.z for l in all_layers if l.z is not None])
-                                    heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
-                                    heights = [height for height in heights if height]
-                                    if len(heights) >= 2: self.est_layer_height = heights[1]
-                                    elif heights: self.est_layer_height = heights[0]
-                                    else: self.est_layer_height = 0.1
-                                base_z = round(prev_z - (prev_z % self.est_layer_height), 2)
-                            else:
-                                base_z = round(prev_z, 2)
-                        else:
-                            base_z = prev_z
+                        base_z = self._layer_base_z(prev_z, last_layer_z)
 
                         if base_z != prev_base_z:
-                            new_layer = Layer(cur_lines, base_z)
+                            new_layer = self._build_layer(cur_lines, base_z)
                             new_layer.duration = totalduration - layerbeginduration
                             layerbeginduration = totalduration
                             all_layers.append(new_layer)
@@ -653,6 +765,8 @@ class GCode:
                 line_idxs.append(layer_line)
                 layer_line += 1
                 prev_z = cur_z
+                if estimator is not None and estimator.full():
+                    estimator.flush(layer_idxs)
             # ## Loop done
 
         # Store current status
@@ -679,51 +793,121 @@ class GCode:
         # Finalize layers
         if build_layers:
             if cur_lines:
-                new_layer = Layer(cur_lines, prev_z)
+                new_layer = self._build_layer(cur_lines, prev_z)
                 new_layer.duration = totalduration - layerbeginduration
                 layerbeginduration = totalduration
                 all_layers.append(new_layer)
                 if cur_layer_has_extrusion and prev_z not in all_zs:
                     all_zs.add(prev_z)
 
-            self.append_layer_id = len(all_layers)
-            self.append_layer = Layer([])
-            self.append_layer.duration = 0
-            all_layers.append(self.append_layer)
-            self.layer_idxs = array('I', layer_idxs)
-            self.line_idxs = array('I', line_idxs)
-
-            # Compute bounding box
-            all_zs = self.all_zs.union({zmin}).difference({None})
-            zmin = min(all_zs)
-            zmax = max(all_zs)
-
-            self.filament_length = self.max_e
-            while len(self.filament_length_multi)<len(self.max_e_multi):
-                    self.filament_length_multi+=[0]
-            for i in enumerate(self.max_e_multi):
-                self.filament_length_multi[i[0]]=i[1]
-
-
-            if self.filament_length > 0:
-                self.xmin = xmin_e if not math.isinf(xmin_e) else 0
-                self.xmax = xmax_e if not math.isinf(xmax_e) else 0
-                self.ymin = ymin_e if not math.isinf(ymin_e) else 0
-                self.ymax = ymax_e if not math.isinf(ymax_e) else 0
+            if estimator is not None:
+                totalduration = self._plan_layers(estimator)
+            self._finish_layers(xmin, xmax, ymin, ymax,
+                                xmin_e, xmax_e, ymin_e, ymax_e,
+                                zmin, totalduration)
+
+    def _layer_base_z(self, prev_z, last_layer_z):
+        """Returns the Z of the layer ending at height prev_z"""
+        if prev_z is not None and last_layer_z is not None:
+            offset = self.est_layer_height if self.est_layer_height else 0.01
+            if abs(prev_z - last_layer_z) < offset:
+                if self.est_layer_height is None:
+                    zs = sorted([l.z for l in self.all_layers if l.z is not None])
+                    heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
+                    heights = [height for height in heights if height]
+                    if len(heights) >= 2: self.est_layer_height = heights[1]
+                    elif heights: self.est_layer_height = heights[0]
+                    else: self.est_layer_height = 0.1
+                return round(prev_z - (prev_z % self.est_layer_height), 2)
             else:
-                self.xmin = xmin if not math.isinf(xmin) else 0
-                self.xmax = xmax if not math.isinf(xmax) else 0
-                self.ymin = ymin if not math.isinf(ymin) else 0
-                self.ymax = ymax if not math.isinf(ymax) else 0
-            self.zmin = zmin if not math.isinf(zmin) else 0
-            self.zmax = zmax if not math.isinf(zmax) else 0
-            self.width = self.xmax - self.xmin
-            self.depth = self.ymax - self.ymin
-            self.height = self.zmax - self.zmin
-
-            # Finalize duration
-            totaltime = datetime.timedelta(seconds = int(totalduration))
-            self.duration = totaltime
+                return round(prev_z, 2)
+        else:
+            return prev_z
+
+    def _plan_layers(self, estimator):
+        """Sets the durations of the layers to those planned by a
+        motionplanner.Estimator and returns the total duration"""
+        durations = estimator.finish(self.layer_idxs, len(self.all_layers))
+        for layer, duration in zip(self.all_layers, durations):
+            layer.duration = duration
+        return sum(durations)
+
+    def _finish_layers(self, xmin, xmax, ymin, ymax,
+                       xmin_e, xmax_e, ymin_e, ymax_e, zmin, totalduration):
+        """Adds the layer for appended lines and computes the bounding box,
+        filament length and duration at the end of the analysis"""
+        all_layers = self.all_layers
+        self.append_layer_id = len(all_layers)
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        all_layers.append(self.append_layer)
+
+        # Compute bounding box
+        all_zs = self.all_zs.union({zmin}).difference({None})
+        zmin = min(all_zs)
+        zmax = max(all_zs)
+
+        self.filament_length = self.max_e
+        while len(self.filament_length_multi)<len(self.max_e_multi):
+                self.filament_length_multi+=[0]
+        for i in enumerate(self.max_e_multi):
+            self.filament_length_multi[i[0]]=i[1]
+
+
+        if self.filament_length > 0:
+            self.xmin = xmin_e if not math.isinf(xmin_e) else 0
+            self.xmax = xmax_e if not math.isinf(xmax_e) else 0
+            self.ymin = ymin_e if not math.isinf(ymin_e) else 0
+            self.ymax = ymax_e if not math.isinf(ymax_e) else 0
+        else:
+            self.xmin = xmin if not math.isinf(xmin) else 0
+            self.xmax = xmax if not math.isinf(xmax) else 0
+            self.ymin = ymin if not math.isinf(ymin) else 0
+            self.ymax = ymax if not math.isinf(ymax) else 0
+        self.zmin = zmin if not math.isinf(zmin) else 0
+        self.zmax = zmax if not math.isinf(zmax) else 0
+        self.width = self.xmax - self.xmin
+        self.depth = self.ymax - self.ymin
+        self.height = self.zmax - self.zmin
+
+        # Finalize duration
+        totaltime = datetime.timedelta(seconds = int(totalduration))
+        self.duration = totaltime
+
+    def _build_layer(self, lines, z):
+        return Layer(lines, z)
+
+    def _checkpoint(self):
+        """Returns the current parser state as a checkpoint"""
+        return tuple(getattr(self, name) for name in CHECKPOINT_FIELDS)
+
+    def state_at(self, i):
+        """Returns a GCode holding the parser state before line i, as
+        analysed from the nearest checkpoint before it. abs_x, abs_y, abs_z,
+        abs_e, current_f and relative of the result are where the machine
+        is after the lines before i have been executed."""
+        state = GCode(deferred = True)
+        state.home_pos = self.home_pos
+        start = 0
+        checkpoints = self.checkpoints
+        if checkpoints:
+            checkpoint = min(i // CHECKPOINT_INTERVAL, len(checkpoints) - 1)
+            for name, value in zip(CHECKPOINT_FIELDS, checkpoints[checkpoint]):
+                setattr(state, name, value)
+            start = checkpoint * CHECKPOINT_INTERVAL
+        # Per tool extrusion is not part of the checkpoints
+        tools = state.current_tool + 1
+        state.current_e_multi = [0] * tools
+        state.offset_e_multi = [0] * tools
+        state.total_e_multi = [0] * tools
+        state.max_e_multi = [0] * tools
+        lines = []
+        for index in range(start, i):
+            layer, line = self.idxs(index)
+            lines.append(Line(self.all_layers[layer][line].raw))
+        if lines:
+            state._preprocess(lines)
+        return state
 
     def idxs(self, i):
         return self.layer_idxs[i], self.line_idxs[i]
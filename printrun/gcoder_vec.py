@@ -0,0 +1,655 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import mmap
+from array import array
+
+import numpy
+
+from printrun import gcoder
+from printrun import motionplanner
+
+# Bytes of G-code tokenized and analysed at once. The columns of a chunk
+# take about 40 times its size, so this bounds the memory of an analysis
+# apart from the line and layer indices.
+CHUNK_SIZE = 1024 * 1024
+
+# Drops pages of a memory map from the process, they are read back from the
+# file when they are accessed again. Not available on all platforms.
+MADV_DONTNEED = getattr(mmap, "MADV_DONTNEED", None)
+
+# Line kinds
+NO_COMMAND = 0  # empty command, e.g. a comment
+OTHER = 1
+G0 = 2
+G1 = 3
+G2 = 4
+G3 = 5
+G4 = 6
+SCALAR = 7  # analysed line by line by gcoder, see Analysis._scalar_line
+
+MOVE_KINDS = {"G0": G0, "G1": G1, "G2": G2, "G3": G3}
+
+# Commands which change the modal state or offsets
+SCALAR_COMMANDS = {"G": (20, 21, 28, 90, 91, 92), "M": (82, 83)}
+
+ACCELERATION = 2000.0  # mm/s^2, as in GCode._preprocess
+
+# Numbers with more digits are parsed by gcoder, below this M / 10 ** k is
+# exactly float("M.k") since both operands are exact doubles
+MAX_DIGITS = 15
+POW10 = numpy.array([float(10 ** k) for k in range(MAX_DIGITS + 1)])
+
+def _table(chars):
+    table = numpy.zeros(256, dtype = bool)
+    for c in chars:
+        table[ord(c)] = True
+    return table
+
+TOKEN_CHARS = _table(gcoder.to_parse + gcoder.to_parse.upper())
+ARG_CHARS = _table("".join(gcoder.gcode_parsed_args))
+DIGITS = _table("0123456789")
+WHITESPACE = _table(" \t\n\r\x0b\x0c")  # as stripped by bytes.strip()
+
+def _firsts(keys):
+    """Mask of the first element of every run of equal sorted keys"""
+    mask = numpy.ones(len(keys), dtype = bool)
+    mask[1:] = keys[1:] != keys[:-1]
+    return mask
+
+def _lasts(keys):
+    """Mask of the last element of every run of equal sorted keys"""
+    mask = numpy.ones(len(keys), dtype = bool)
+    mask[:-1] = keys[1:] != keys[:-1]
+    return mask
+
+def _ffill(mask, values, initial):
+    """For every element, the last value up to it where mask is set, or
+    initial before the first one"""
+    index = numpy.where(mask, numpy.arange(len(mask)), -1)
+    numpy.maximum.accumulate(index, out = index)
+    filled = values[numpy.maximum(index, 0)]
+    filled[index < 0] = numpy.nan if initial is None else initial
+    return filled
+
+def _shift(values, first):
+    """values moved one position up, starting with first"""
+    shifted = numpy.empty(len(values))
+    shifted[0] = first
+    shifted[1:] = values[:-1]
+    return shifted
+
+def _accumulate(first, values):
+    """Running sums of values starting from first, added up one at a time
+    like the per-line analysis does"""
+    return numpy.cumsum(numpy.concatenate(([first], values)))[1:]
+
+def line_spans(data):
+    """Returns the start offsets and lengths of the non-empty lines of a
+    uint8 array, stripped like bytes.strip() does"""
+    size = len(data)
+    newlines = numpy.flatnonzero(data == 10)
+    starts = numpy.concatenate(([0], newlines + 1))
+    ends = numpy.concatenate((newlines, [size]))
+    text = numpy.flatnonzero(~WHITESPACE[data])
+    if not len(text):
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+    first = numpy.searchsorted(text, starts)
+    first_pos = text[numpy.minimum(first, len(text) - 1)]
+    nonempty = (first < len(text)) & (first_pos < ends)
+    last_pos = text[numpy.searchsorted(text, ends[nonempty]) - 1]
+    starts = first_pos[nonempty]
+    return starts, last_pos - starts + 1
+
+def tokenize(data, starts):
+    """Splits the lines of a uint8 array into columns.
+
+    Returns the kind of every line and its X, Y, Z, E and F arguments as
+    arrays, NaN where an argument is missing. Arguments are only set for G
+    commands and are not scaled for imperial units. Lines which do not fit
+    the columns (parenthesized comments, non-ASCII text before a ';'
+    comment, line numbers, tool changes, ...) are of kind SCALAR.
+    """
+    size = len(data)
+    count = len(starts)
+    padded = numpy.zeros(size + 2, numpy.uint8)
+    padded[:size] = data
+    kind = numpy.full(count, OTHER, numpy.int8)
+    scalar = numpy.zeros(count, dtype = bool)
+    args = dict((axis, numpy.full(count, numpy.nan)) for axis in "xyzef")
+
+    def line_of(positions):
+        # Every non-whitespace character lies on a line
+        return numpy.searchsorted(starts, positions, "right") - 1
+
+    # Everything after the first ';' of a line is a comment
+    semicolons = numpy.flatnonzero(data == 59)
+    semicolon_lines = line_of(semicolons)
+    first = _firsts(semicolon_lines)
+    comment_start = numpy.full(count, size, numpy.int64)
+    comment_start[semicolon_lines[first]] = semicolons[first]
+
+    odd = numpy.flatnonzero((data == 40) | (data >= 128))
+    odd_lines = line_of(odd)
+    scalar[odd_lines[odd < comment_start[odd_lines]]] = True
+
+    positions = numpy.flatnonzero(TOKEN_CHARS[data])
+    lines = line_of(positions)
+    keep = positions < comment_start[lines]
+    positions = positions[keep]
+    lines = lines[keep]
+    letters = data[positions] | 0x20
+
+    # Numbers as matched by [-+]?[0-9]*\.?[0-9]*
+    index = numpy.arange(size + 2)
+    next_nondigit = numpy.where(DIGITS[padded], size + 1, index)
+    next_nondigit = numpy.minimum.accumulate(next_nondigit[::-1])[::-1]
+    number_start = positions + 1
+    signs = padded[number_start]
+    signed = (signs == 43) | (signs == 45)
+    digits_start = number_start + signed
+    int_end = next_nondigit[digits_start]
+    dot = padded[int_end] == 46
+    number_end = numpy.where(dot, next_nondigit[numpy.minimum(int_end + 1, size + 1)], int_end)
+    int_digits = int_end - digits_start
+    frac_digits = numpy.where(dot, number_end - int_end - 1, 0)
+    digits = int_digits + frac_digits
+    empty = number_end == number_start
+    unparsed = (~empty & (digits == 0)) | (digits > MAX_DIGITS)
+
+    mantissa = numpy.zeros(len(positions))
+    for k in range(min(int(digits.max()) if len(digits) else 0, MAX_DIGITS)):
+        at = numpy.where(k < int_digits, digits_start + k, digits_start + k + 1)
+        digit = padded[numpy.minimum(at, size + 1)].astype(numpy.float64) - 48
+        mantissa = numpy.where(k < digits, mantissa * 10 + digit, mantissa)
+    values = mantissa / POW10[numpy.minimum(frac_digits, MAX_DIGITS)]
+    values = numpy.where(signed & (signs == 45), -values, values)
+
+    # Lines without tokens are comments, or could not be parsed at all
+    kind[:] = numpy.where(comment_start < size, NO_COMMAND, SCALAR)
+    first = numpy.flatnonzero(_firsts(lines))
+    command_lines = lines[first]
+    command_letters = letters[first]
+    kind[command_lines] = OTHER
+    plain = ~signed[first] & ~dot[first] & ~empty[first] & ~unparsed[first]
+    number = mantissa[first]
+    number_digits = int_digits[first]
+
+    def is_command(letter, value):
+        return (command_letters == ord(letter)) & plain \
+            & (number == value) & (number_digits == len(str(value)))
+
+    for name, line_kind in MOVE_KINDS.items():
+        kind[command_lines[is_command("g", int(name[1:]))]] = line_kind
+    kind[command_lines[is_command("g", 4)]] = G4
+    for letter, numbers in SCALAR_COMMANDS.items():
+        for value in numbers:
+            scalar[command_lines[is_command(letter.lower(), value)]] = True
+    scalar[command_lines[(command_letters == ord("t"))
+                         | (command_letters == ord("n"))
+                         | unparsed[first]]] = True
+
+    # Arguments of G commands, the last one wins like in parse_coordinates
+    g_command = numpy.zeros(count, dtype = bool)
+    g_command[command_lines[command_letters == ord("g")]] = True
+    is_arg = ARG_CHARS[letters] & g_command[lines]
+    scalar[lines[is_arg & unparsed]] = True
+    for axis in "xyzef":
+        selected = is_arg & (letters == ord(axis)) & ~empty
+        axis_lines = lines[selected]
+        last = _lasts(axis_lines)
+        args[axis][axis_lines[last]] = values[selected][last]
+
+    kind[scalar] = SCALAR
+    return kind, args
+
+class _Chunk:
+    """Per-line columns of the lines being analysed"""
+
+    def __init__(self, kind, args):
+        count = len(kind)
+        self.count = count
+        self.kind = kind
+        self.x = args["x"]
+        self.y = args["y"]
+        self.z = args["z"]
+        self.e = args["e"]
+        self.f = args["f"]
+        self.current_x = numpy.empty(count)
+        self.current_y = numpy.empty(count)
+        self.current_z = numpy.empty(count)
+        self.current_e = numpy.empty(count)
+        self.homing = numpy.zeros(count, dtype = bool)
+        self.layer_z = numpy.empty(count)
+        self.extruding = numpy.zeros(count, dtype = bool)
+        self.max_e = numpy.empty(count)
+        self.relative = numpy.zeros(count, dtype = bool)
+        self.relative_e = numpy.zeros(count, dtype = bool)
+        self.dwell = numpy.zeros(count)
+
+class Analysis:
+    """Analysis of a MappedGCode with NumPy, giving the same results as
+    GCode._preprocess(build_layers = True).
+
+    The G-code is fed in chunks of whole lines. Each chunk is tokenized into
+    columns; positions, offsets and extrusion are computed for every run of
+    lines between commands which change the modal state, and durations,
+    bounding box and layer boundaries for the whole chunk. Modal commands
+    and lines which do not fit the columns go through GCode._preprocess one
+    at a time. Layers are built at the end of every chunk, so the G-code
+    can be used while it is being analysed.
+    """
+
+    def __init__(self, gcode, layer_callback = None):
+        self.gcode = gcode
+        self.layer_callback = layer_callback
+        self.count = 0
+
+        gcode.all_layers = []
+        gcode.all_zs = set()
+        gcode.layer_idxs = array('I')
+        gcode.line_idxs = array('I')
+        gcode.checkpoints = []
+
+        self.xmin = self.ymin = float("inf")
+        self.xmax = self.ymax = float("-inf")
+        self.xmin_e = self.ymin_e = float("inf")
+        self.xmax_e = self.ymax_e = float("-inf")
+
+        self.lastx = self.lasty = self.lastz = self.laste = self.lastf = 0.0
+        self.lastdx = 0
+        self.lastdy = 0
+        self.totalduration = 0.0
+        self.layerbeginduration = 0.0
+
+        self.cur_z = None
+        self.prev_z = None
+        self.last_layer_z = None
+        self.prev_base_z = (None, None)
+        self.layer_id = 0
+        self.layer_start = 0
+        self.layer_has_extrusion = False
+
+        self.estimator = None
+        if gcode.motion_limits is not None:
+            self.estimator = motionplanner.Estimator(gcode.motion_limits)
+            self.feedrate = gcode.current_f
+
+    def feed(self, data, offset, size):
+        """Analyses the whole lines in data[offset:offset + size]"""
+        gcode = self.gcode
+        buffer = numpy.frombuffer(data, numpy.uint8, size, offset)
+        starts, lengths = line_spans(buffer)
+        if not len(starts):
+            return
+        # The lines have to be accessible for the scalar path and for the
+        # layers built from this chunk
+        gcode.line_starts.frombytes((starts + offset).astype(numpy.uint64).tobytes())
+        gcode.line_lengths.frombytes(lengths.astype(numpy.uint32).tobytes())
+
+        chunk = _Chunk(*tokenize(buffer, starts))
+        # Runs are also split at the lines the parser state is recorded
+        # before
+        scalar = chunk.kind == SCALAR
+        checkpoints = numpy.arange(-self.count % gcoder.CHECKPOINT_INTERVAL,
+                                   chunk.count, gcoder.CHECKPOINT_INTERVAL)
+        start = 0
+        for i in numpy.union1d(numpy.flatnonzero(scalar), checkpoints).tolist():
+            if i > start:
+                self._run(chunk, start, i)
+            start = i
+            if not (self.count + i) % gcoder.CHECKPOINT_INTERVAL:
+                gcode.checkpoints.append(gcode._checkpoint())
+            if scalar[i]:
+                self._scalar_line(chunk, i)
+                start = i + 1
+        if start < chunk.count:
+            self._run(chunk, start, chunk.count)
+
+        for i in numpy.flatnonzero(chunk.kind == G4):
+            dwell = gcoder.P(gcoder.LightLine(gcode.raw(self.count + i)))
+            if dwell:
+                chunk.dwell[i] = dwell / 1000.0
+
+        self._bounding_box(chunk)
+        durations = self._durations(chunk)
+        self._layers(chunk, durations)
+        if self.estimator is not None:
+            self._plan(chunk)
+        self.count += chunk.count
+
+    def _run(self, chunk, start, end):
+        """Analyses lines between two scalar lines, during which the modal
+        state and the offsets do not change"""
+        gcode = self.gcode
+        lines = slice(start, end)
+        kind = chunk.kind[lines]
+        move = (kind >= G0) & (kind <= G3)
+        if gcode.imperial:
+            for column in (chunk.x, chunk.y, chunk.z, chunk.e, chunk.f):
+                column[lines] *= 25.4
+        chunk.relative[lines] = gcode.relative
+        chunk.relative_e[lines] = gcode.relative_e
+
+        # Positions
+        for axis in "xyz":
+            values = getattr(chunk, axis)[lines]
+            current = getattr(gcode, "current_" + axis)
+            if gcode.relative:
+                steps = values[move]
+                steps[numpy.isnan(steps) | (steps == 0)] = 0.0
+                positions = numpy.empty(len(values))
+                positions[move] = _accumulate(current, steps)
+                positions = _ffill(move, positions, current)
+                moved = move.any()
+            else:
+                offset = getattr(gcode, "offset_" + axis)
+                given = move & ~numpy.isnan(values)
+                positions = _ffill(given, values + offset, current)
+                moved = given.any()
+            if moved:
+                setattr(gcode, "current_" + axis, float(positions[-1]))
+            getattr(chunk, "current_" + axis)[lines] = positions
+        feedrates = chunk.f[lines][move]
+        feedrates = feedrates[~numpy.isnan(feedrates)]
+        if len(feedrates):
+            gcode.current_f = float(feedrates[-1])
+
+        # Extrusion
+        values = chunk.e[lines]
+        extrusion = move & ~numpy.isnan(values)
+        if extrusion.any():
+            tool = gcode.current_tool
+            e = values[extrusion]
+            if gcode.relative_e:
+                extruding = e > 0
+                total = _accumulate(gcode.total_e, e)
+                current = _accumulate(gcode.current_e, e)
+                total_multi = _accumulate(gcode.total_e_multi[tool], e)
+                current_multi = _accumulate(gcode.current_e_multi[tool], e)
+            else:
+                current = e + gcode.offset_e
+                previous = _shift(current, gcode.current_e)
+                extruding = current > previous
+                total = _accumulate(gcode.total_e, current - previous)
+                current_multi = e + gcode.offset_e_multi[tool]
+                previous = _shift(current_multi, gcode.current_e_multi[tool])
+                total_multi = _accumulate(gcode.total_e_multi[tool],
+                                          current_multi - previous)
+            max_e = numpy.maximum.accumulate(numpy.concatenate(([gcode.max_e], total)))[1:]
+            max_e_multi = numpy.maximum.accumulate(
+                numpy.concatenate(([gcode.max_e_multi[tool]], total_multi)))[1:]
+            chunk.extruding[start + numpy.flatnonzero(extrusion)] = extruding
+            running = numpy.empty(len(values))
+            running[extrusion] = max_e
+            chunk.max_e[lines] = _ffill(extrusion, running, gcode.max_e)
+            running[extrusion] = current
+            chunk.current_e[lines] = _ffill(extrusion, running, gcode.current_e)
+            gcode.total_e = float(total[-1])
+            gcode.current_e = float(current[-1])
+            gcode.max_e = float(max_e[-1])
+            gcode.total_e_multi[tool] = float(total_multi[-1])
+            gcode.current_e_multi[tool] = float(current_multi[-1])
+            gcode.max_e_multi[tool] = float(max_e_multi[-1])
+        else:
+            chunk.max_e[lines] = gcode.max_e
+            chunk.current_e[lines] = gcode.current_e
+
+        # Z of the layers, as given by the G-code
+        values = chunk.z[lines]
+        has_z = move & ~numpy.isnan(values)
+        if has_z.any():
+            z = values[has_z]
+            if not gcode.relative:
+                layer_z = z
+            elif self.cur_z is None:
+                layer_z = numpy.cumsum(z)
+            else:
+                layer_z = _accumulate(self.cur_z, z)
+            column = numpy.empty(len(values))
+            column[has_z] = layer_z
+            chunk.layer_z[lines] = _ffill(has_z, column, self.cur_z)
+            self.cur_z = float(layer_z[-1])
+        else:
+            chunk.layer_z[lines] = numpy.nan if self.cur_z is None else self.cur_z
+
+    def _scalar_line(self, chunk, i):
+        """Analyses one line with gcoder"""
+        gcode = self.gcode
+        raw = gcode.raw(self.count + i)
+        line = gcoder.Line(raw)
+        split_raw = gcoder.split(line)
+        command = line.command
+        chunk.kind[i] = NO_COMMAND
+        # Lines which could not be parsed do not change anything
+        if command and not isinstance(split_raw[0], str):
+            chunk.kind[i] = MOVE_KINDS.get(command, G4 if command == "G4" else OTHER)
+            if command[0] == "G":
+                imperial = gcode.imperial
+                if command == "G20":
+                    imperial = True
+                elif command == "G21":
+                    imperial = False
+                gcoder.parse_coordinates(line, split_raw, imperial)
+            current_e = gcode.current_e
+            gcode._preprocess([gcoder.LightLine(raw)])
+            if line.is_move and line.e is not None:
+                if gcode.relative_e:
+                    chunk.extruding[i] = line.e > 0
+                else:
+                    chunk.extruding[i] = gcode.current_e > current_e
+            if line.z is not None:
+                if command == "G92":
+                    self.cur_z = line.z
+                elif line.is_move:
+                    if gcode.relative and self.cur_z is not None:
+                        self.cur_z += line.z
+                    else:
+                        self.cur_z = line.z
+        for axis in "xyzef":
+            value = getattr(line, axis)
+            getattr(chunk, axis)[i] = numpy.nan if value is None else value
+        chunk.current_x[i] = gcode.current_x
+        chunk.current_y[i] = gcode.current_y
+        chunk.current_z[i] = gcode.current_z
+        chunk.current_e[i] = gcode.current_e
+        chunk.homing[i] = command == "G28"
+        chunk.relative[i] = gcode.relative
+        chunk.relative_e[i] = gcode.relative_e
+        chunk.max_e[i] = gcode.max_e
+        chunk.layer_z[i] = numpy.nan if self.cur_z is None else self.cur_z
+
+    def _bounding_box(self, chunk):
+        move = (chunk.kind >= G0) & (chunk.kind <= G3)
+        extruding = move & chunk.extruding
+        if extruding.any():
+            x = chunk.current_x[extruding]
+            y = chunk.current_y[extruding]
+            self.xmin_e = min(self.xmin_e, float(x.min()))
+            self.xmax_e = max(self.xmax_e, float(x.max()))
+            self.ymin_e = min(self.ymin_e, float(y.min()))
+            self.ymax_e = max(self.ymax_e, float(y.max()))
+        # Travel moves only count until the first extrusion
+        before_extrusion = move & (chunk.max_e <= 0)
+        if before_extrusion.any():
+            x = chunk.current_x[before_extrusion]
+            y = chunk.current_y[before_extrusion]
+            self.xmin = min(self.xmin, float(x.min()))
+            self.xmax = max(self.xmax, float(x.max()))
+            self.ymin = min(self.ymin, float(y.min()))
+            self.ymax = max(self.ymax, float(y.max()))
+
+    def _durations(self, chunk):
+        """Returns the total duration up to and including every line"""
+        moves = numpy.flatnonzero((chunk.kind == G0) | (chunk.kind == G1))
+        durations = chunk.dwell.copy()
+        if len(moves):
+            x = _ffill(~numpy.isnan(chunk.x[moves]), chunk.x[moves], self.lastx)
+            y = _ffill(~numpy.isnan(chunk.y[moves]), chunk.y[moves], self.lasty)
+            z = _ffill(~numpy.isnan(chunk.z[moves]), chunk.z[moves], self.lastz)
+            e = _ffill(~numpy.isnan(chunk.e[moves]), chunk.e[moves], self.laste)
+            f = chunk.f[moves] / 60.0
+            f = _ffill(~numpy.isnan(f), f, self.lastf)
+
+            dx = x - _shift(x, self.lastx)
+            dy = y - _shift(y, self.lasty)
+            # Full reacceleration when the direction is reversed
+            reversed_ = dx * _shift(dx, self.lastdx) + dy * _shift(dy, self.lastdy) <= 0
+            lastf = numpy.where(reversed_, 0.0, _shift(f, self.lastf))
+
+            # math.hypot does not give the same results as numpy.hypot
+            travel = numpy.fromiter(map(math.hypot, dx.tolist(), dy.tolist()),
+                                    numpy.float64, len(moves))
+            still = travel == 0
+            line_z = chunk.z[moves]
+            line_e = chunk.e[moves]
+            z_travel = numpy.where(chunk.relative[moves], numpy.abs(line_z),
+                                   numpy.abs(line_z - _shift(z, self.lastz)))
+            e_travel = numpy.where(chunk.relative_e[moves], numpy.abs(line_e),
+                                   numpy.abs(line_e - _shift(e, self.laste)))
+            has_z = ~numpy.isnan(line_z)
+            travel = numpy.where(still & has_z, z_travel,
+                                 numpy.where(still & ~has_z & ~numpy.isnan(line_e),
+                                             e_travel, travel))
+
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                cruise = numpy.where(f != 0, travel / f, 0.0)
+                distance = 2 * numpy.abs(((lastf + f) * (f - lastf) * 0.5) / ACCELERATION)
+                accelerated = 2 * distance / (lastf + f) + (travel - distance) / f
+                ramp = 2 * travel / (lastf + f)
+                full_speed = (distance <= travel) & (lastf + f != 0) & (f != 0)
+                durations[moves] += numpy.where(f == lastf, cruise,
+                                                numpy.where(full_speed, accelerated, ramp))
+
+            self.lastx = float(x[-1])
+            self.lasty = float(y[-1])
+            self.lastz = float(z[-1])
+            self.laste = float(e[-1])
+            self.lastf = float(f[-1])
+            self.lastdx = float(dx[-1])
+            self.lastdy = float(dy[-1])
+        totals = _accumulate(self.totalduration, durations)
+        self.totalduration = float(totals[-1])
+        return totals
+
+    def _layers(self, chunk, durations):
+        gcode = self.gcode
+        layer_z = chunk.layer_z
+        previous = _shift(layer_z, numpy.nan if self.prev_z is None else self.prev_z)
+        changed = ~((layer_z == previous)
+                    | (numpy.isnan(layer_z) & numpy.isnan(previous)))
+        extrusion = numpy.concatenate(([0], numpy.cumsum(chunk.extruding)))
+        extrusion_start = 0
+        first_line = self.layer_start
+        built = []
+        new_layers = []
+        for i in numpy.flatnonzero(changed).tolist():
+            prev_z = None if math.isnan(previous[i]) else float(previous[i])
+            base_z = gcode._layer_base_z(prev_z, self.last_layer_z)
+            if base_z != self.prev_base_z:
+                line = self.count + i
+                layer = gcode._build_layer(range(self.layer_start, line), base_z)
+                total = float(durations[i])
+                layer.duration = total - self.layerbeginduration
+                self.layerbeginduration = total
+                gcode.all_layers.append(layer)
+                # The extrusion of the line which starts the new layer
+                # counts for the previous one
+                if self.layer_has_extrusion \
+                   or extrusion[i + 1] > extrusion[extrusion_start]:
+                    if prev_z not in gcode.all_zs:
+                        gcode.all_zs.add(prev_z)
+                self.layer_has_extrusion = False
+                extrusion_start = i + 1
+                built.append(i)
+                new_layers.append(len(gcode.all_layers) - 1)
+                self.layer_start = line
+                self.last_layer_z = base_z
+            self.prev_base_z = base_z
+        if extrusion[-1] > extrusion[extrusion_start]:
+            self.layer_has_extrusion = True
+        last = layer_z[-1]
+        self.prev_z = None if math.isnan(last) else float(last)
+
+        # Layer and line indices, which are needed before the layers are
+        # announced
+        index = numpy.arange(chunk.count)
+        built = numpy.array(built, dtype = numpy.int64)
+        layer = numpy.searchsorted(built, index, "right")
+        first_line = numpy.concatenate(([first_line - self.count], built))
+        gcode.layer_idxs.frombytes((self.layer_id + layer).astype(numpy.uint32).tobytes())
+        gcode.line_idxs.frombytes((index - first_line[layer]).astype(numpy.uint32).tobytes())
+        self.layer_id += len(built)
+        if self.layer_callback is not None:
+            for layer_idx in new_layers:
+                self.layer_callback(gcode, layer_idx)
+
+    def _plan(self, chunk):
+        """Passes the moves, dwells and homing of a chunk to the motion
+        planner"""
+        kind = chunk.kind
+        move = (kind >= G0) & (kind <= G3)
+        stop = (kind == G4) | chunk.homing
+        rows = numpy.flatnonzero(move | stop)
+        if not len(rows):
+            return
+        feedrate = chunk.f[rows]
+        feedrate = _ffill(move[rows] & ~numpy.isnan(feedrate), feedrate, self.feedrate)
+        self.feedrate = float(feedrate[-1])
+        self.estimator.add(self.gcode.layer_idxs, self.count + rows,
+                           chunk.current_x[rows], chunk.current_y[rows],
+                           chunk.current_z[rows], chunk.current_e[rows],
+                           feedrate / 60.0, stop[rows], chunk.dwell[rows])
+
+    def finish(self):
+        """Builds the last layer and computes the totals"""
+        gcode = self.gcode
+        if self.count > self.layer_start:
+            layer = gcode._build_layer(range(self.layer_start, self.count), self.prev_z)
+            layer.duration = self.totalduration - self.layerbeginduration
+            gcode.all_layers.append(layer)
+            if self.layer_has_extrusion and self.prev_z not in gcode.all_zs:
+                gcode.all_zs.add(self.prev_z)
+        totalduration = self.totalduration
+        if self.estimator is not None:
+            totalduration = gcode._plan_layers(self.estimator)
+        gcode._finish_layers(self.xmin, self.xmax, self.ymin, self.ymax,
+                             self.xmin_e, self.xmax_e, self.ymin_e, self.ymax_e,
+                             0, totalduration)
+
+def analyse(gcode, data, layer_callback = None):
+    """Analyses a MappedGCode backed by data with NumPy"""
+    analysis = Analysis(gcode, layer_callback)
+    size = len(data)
+    start = 0
+    while start < size:
+        end = start + CHUNK_SIZE
+        if end < size:
+            # Chunks end on a line boundary
+            newline = data.rfind(b"\n", start, end)
+            if newline < 0:
+                newline = data.find(b"\n", end)
+            end = newline + 1 if newline >= 0 else size
+        else:
+            end = size
+        analysis.feed(data, start, end - start)
+        if isinstance(data, mmap.mmap) and MADV_DONTNEED is not None:
+            # The analysed part of a mapped file would otherwise stay
+            # resident until the end of the print
+            released = start - start % mmap.PAGESIZE
+            data.madvise(MADV_DONTNEED, released, end - released)
+        start = end
+    analysis.finish()
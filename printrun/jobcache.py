@@ -0,0 +1,244 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import struct
+import tempfile
+import threading
+import logging
+import traceback
+from array import array
+from datetime import timedelta
+
+from printrun.gcodefile import MappedGCode
+from printrun.motionplanner import MachineLimits
+
+# Bumped whenever the analysis or the stored format changes, so entries
+# written by another version are never used
+CACHE_VERSION = 5
+ENTRY_SUFFIX = ".job"
+
+# An entry starts with the magic and the length of its JSON header, which
+# lists the arrays stored raw after it
+ENTRY_MAGIC = b"SCJOB\n"
+HEADER_LENGTH = struct.Struct("<I")
+
+GCODE_ARRAYS = ("line_starts", "line_lengths", "layer_idxs", "line_idxs")
+
+def estimate_size(gcode):
+    """Bytes the arrays of the cache entry of an analysed MappedGCode take,
+    worked out before they are copied for it"""
+    count = len(gcode.line_starts)
+    return count * sum(getattr(gcode, name).itemsize for name in GCODE_ARRAYS)
+
+def _write_entry(f, header, arrays):
+    """Writes a JSON header and the arrays or bytearrays in arrays, a list
+    of (name, value) pairs, to the binary file f"""
+    header = dict(header, version = CACHE_VERSION, byteorder = sys.byteorder,
+                  arrays = [(name, getattr(value, "typecode", None),
+                             getattr(value, "itemsize", 1), len(value))
+                            for name, value in arrays])
+    header = json.dumps(header).encode("utf-8")
+    f.write(ENTRY_MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+    for name, value in arrays:
+        if isinstance(value, array):
+            value.tofile(f)
+        else:
+            f.write(value)
+
+def _read_entry(f):
+    """Reads an entry written by _write_entry(), returns its header and a
+    dict of its arrays, or None if it was written by another version.
+    Raises ValueError or EOFError if the entry is damaged."""
+    if f.read(len(ENTRY_MAGIC)) != ENTRY_MAGIC:
+        raise ValueError("not a job cache entry")
+    length, = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))
+    header = json.loads(f.read(length).decode("utf-8"))
+    if header.get("version") != CACHE_VERSION \
+       or header.get("byteorder") != sys.byteorder:
+        return None
+    arrays = {}
+    for name, typecode, itemsize, count in header["arrays"]:
+        if typecode is None:
+            value = bytearray(count)
+            if f.readinto(value) != count:
+                raise EOFError("job cache entry is truncated")
+        else:
+            value = array(typecode)
+            if value.itemsize != itemsize:
+                return None  # written on another platform
+            value.fromfile(f, count)
+        arrays[name] = value
+    return header, arrays
+
+class JobCache:
+    """On-disk cache of prepared print jobs, keyed by a hash of the G-code.
+
+    An entry holds the line and layer index of a MappedGCode and the
+    analysis results, so printing the same G-code again skips the
+    analysis. The SendStream is not stored, as it is precompiled a chunk
+    at a time while printing. The indices are stored as raw arrays after a
+    JSON header, so reading an entry never runs code from the cache
+    directory. The total size of the
+    entries is kept below max_size by removing the least recently used
+    ones; the modification time of an entry is its last use. Jobs whose
+    entry would not fit on its own are not stored.
+    """
+
+    def __init__(self, directory, max_size = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """Returns the header and the arrays stored for key, or None"""
+        path = self._path(key)
+        try:
+            with self.lock:
+                with open(path, "rb") as f:
+                    entry = _read_entry(f)
+                os.utime(path)
+        except FileNotFoundError:
+            entry = None
+        except Exception:
+            logging.warning("Dropping unreadable job cache entry %s:\n%s"
+                            % (path, traceback.format_exc()))
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, header, arrays):
+        """Stores a header of JSON values and a list of (name, array) pairs
+        for key and evicts old entries if needed"""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok = True)
+            fd, temp_path = tempfile.mkstemp(dir = self.directory,
+                                             suffix = ".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    _write_entry(f, header, arrays)
+                os.replace(temp_path, self._path(key))
+            except:
+                os.unlink(temp_path)
+                raise
+            self._evict(keep = self._path(key))
+
+    def remove(self, key):
+        with self.lock:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for path, size, mtime in self._entries():
+                os.unlink(path)
+
+    def size(self):
+        """Total size of the stored entries in bytes"""
+        with self.lock:
+            return sum(size for path, size, mtime in self._entries())
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self, keep = None):
+        """Removes the least recently used entries until the total size is
+        below max_size, except the entry at path keep"""
+        entries = sorted(self._entries(), key = lambda entry: entry[2])
+        total = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def load_gcode(self, key, data):
+        """Returns a prepared MappedGCode for data from the cache, or None
+        on a miss. key is the hash of data."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        header, arrays = entry
+        index = dict(header["gcode"], layers = header["layers"])
+        index.update((name, arrays[name]) for name in GCODE_ARRAYS)
+        index["all_zs"] = set(index["all_zs"])
+        index["duration"] = timedelta(seconds = index["duration"])
+        index["checkpoints"] = [tuple(checkpoint) for checkpoint in index["checkpoints"]]
+        if index["motion_limits"] is not None:
+            index["motion_limits"] = MachineLimits.from_dict(index["motion_limits"])
+        return MappedGCode.from_index(data, index)
+
+    def store_gcode(self, key, gcode):
+        """Stores gcode once its analysis has completed, which may happen in
+        a background thread."""
+        def store():
+            try:
+                if not gcode.wait_prepared():
+                    return
+                size = estimate_size(gcode)
+                if size > self.max_size:
+                    logging.info("Not storing a job of %d lines in the cache, "
+                                 "its entry would take %d MB"
+                                 % (len(gcode.line_starts), size // 2 ** 20))
+                    return
+                index = gcode.get_index()
+                values = {name: value for name, value in index.items()
+                          if name not in GCODE_ARRAYS and name != "layers"}
+                values["all_zs"] = sorted(values["all_zs"])
+                values["duration"] = values["duration"].total_seconds()
+                if values["motion_limits"] is not None:
+                    values["motion_limits"] = values["motion_limits"].to_dict()
+                header = {"gcode": values, "layers": index["layers"]}
+                arrays = [(name, index[name]) for name in GCODE_ARRAYS]
+                self.put(key, header, arrays)
+            except Exception:
+                logging.warning("Could not store job in the cache:\n"
+                                + traceback.format_exc())
+        thread = threading.Thread(target = store, name = "job cache")
+        thread.daemon = True
+        thread.start()
+        return thread
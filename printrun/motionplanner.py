@@ -0,0 +1,429 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import json
+import hashlib
+
+import numpy
+
+AXES = "xyze"
+
+# Lowest speed at a junction or at a stop, in mm/s, as in Marlin
+MINIMUM_PLANNER_SPEED = 0.05
+
+# Rows buffered by Estimator.move() and stop() before they are planned
+BATCH_SIZE = 4096
+
+report_exp = re.compile(r"^(?:echo:)?\s*(M20[1345])\b(.*)$")
+report_arg_exp = re.compile(r"([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)")
+
+class MachineLimits:
+    """Motion limits of a printer.
+
+    The defaults are those of Marlin; parse() updates them from the lines of
+    the settings report the firmware sends in reply to M503 (M201 maximum
+    acceleration, M203 maximum feedrate, M204 acceleration, M205 jerk or
+    junction deviation). Speeds are in mm/s, accelerations in mm/s^2.
+    """
+
+    def __init__(self):
+        self.max_feedrate = {"x": 300.0, "y": 300.0, "z": 5.0, "e": 25.0}
+        self.max_acceleration = {"x": 3000.0, "y": 3000.0, "z": 100.0, "e": 10000.0}
+        self.acceleration = 3000.0  # moves which extrude
+        self.retract_acceleration = 3000.0  # moves of the extruder only
+        self.travel_acceleration = 3000.0  # moves which do not extrude
+        self.min_feedrate = 0.0
+        self.min_travel_feedrate = 0.0
+        self.max_jerk = {"x": 10.0, "y": 10.0, "z": 0.3, "e": 5.0}
+        # None when the firmware uses classic jerk instead
+        self.junction_deviation = 0.013
+
+    def parse(self, line):
+        """Updates the limits from a line of an M503 report, returns whether
+        the line reported any"""
+        match = report_exp.match(line.strip())
+        if not match:
+            return False
+        args = dict((letter.lower(), float(value))
+                    for letter, value in report_arg_exp.findall(match.group(2)))
+        if not args:
+            return False
+        command = match.group(1)
+        if command in ("M201", "M203"):
+            # Firmware with distinct E factors reports every extruder; the
+            # first one is used
+            if args.get("t", 0) != 0:
+                return True
+            limits = self.max_acceleration if command == "M201" else self.max_feedrate
+            for axis in AXES:
+                if axis in args:
+                    limits[axis] = args[axis]
+        elif command == "M204":
+            if "s" in args:  # older firmware: printing and travel moves
+                self.acceleration = self.travel_acceleration = args["s"]
+            self.acceleration = args.get("p", self.acceleration)
+            self.retract_acceleration = args.get("r", self.retract_acceleration)
+            self.travel_acceleration = args.get("t", self.travel_acceleration)
+        else:
+            self.min_feedrate = args.get("s", self.min_feedrate)
+            self.min_travel_feedrate = args.get("t", self.min_travel_feedrate)
+            for axis in AXES:
+                if axis in args:
+                    self.max_jerk[axis] = args[axis]
+            if "j" in args:
+                self.junction_deviation = args["j"]
+            elif "x" in args or "y" in args:
+                self.junction_deviation = None
+        return True
+
+    def to_dict(self):
+        return {
+            "max_feedrate": dict(self.max_feedrate),
+            "max_acceleration": dict(self.max_acceleration),
+            "acceleration": self.acceleration,
+            "retract_acceleration": self.retract_acceleration,
+            "travel_acceleration": self.travel_acceleration,
+            "min_feedrate": self.min_feedrate,
+            "min_travel_feedrate": self.min_travel_feedrate,
+            "max_jerk": dict(self.max_jerk),
+            "junction_deviation": self.junction_deviation,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        limits = cls()
+        for name, value in values.items():
+            default = getattr(limits, name, None)
+            if isinstance(default, dict):
+                default.update((axis, float(value[axis]))
+                               for axis in AXES if axis in value)
+            elif hasattr(limits, name):
+                setattr(limits, name, None if value is None else float(value))
+        return limits
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys = True)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def copy(self):
+        return self.from_dict(self.to_dict())
+
+    def fingerprint(self):
+        """Short hash of the limits, to tell apart estimates made with
+        different limits"""
+        return hashlib.sha1(self.to_json().encode("ascii")).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, MachineLimits) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return "MachineLimits(%s)" % self.to_json()
+
+class Planner:
+    """Simulation of a lookahead motion planner with trapezoidal velocity
+    profiles, as in Marlin.
+
+    Moves are added in batches of arrays. For every move the nominal speed
+    and acceleration are limited per axis, and the speed at the junction
+    with the previous move by the junction deviation or, with classic jerk,
+    by the largest instant speed change of any axis. The entry speed of a
+    move must also allow reaching the entry speed of the next one within
+    its length, and the other way around. Both passes are closed forms:
+    with S the running sum of 2 * acceleration * length, the backward pass
+    is a reversed running minimum of junction + S and the forward pass a
+    running minimum of entry - S, so a batch is planned without a loop
+    over its moves. The lookahead is unlimited; the last moves of a batch,
+    which could still have to slow down for moves which are not known yet,
+    are kept until the next batch or finish().
+
+    The running sums lose precision as they grow, so the rows are planned
+    in blocks of BATCH_SIZE counted from the first row, however they are
+    split when they are added. Adding the same rows always gives the same
+    durations.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.max_feedrate = numpy.array([limits.max_feedrate[axis] for axis in AXES])
+        self.max_acceleration = numpy.array([limits.max_acceleration[axis] for axis in AXES])
+        self.max_jerk = numpy.array([limits.max_jerk[axis] for axis in AXES])
+        self.position = numpy.zeros(len(AXES))
+        # Direction and nominal speed squared of the last move, None after
+        # a stop
+        self.last_unit = None
+        self.last_speed2 = 0.0
+        self.last_stop2 = MINIMUM_PLANNER_SPEED ** 2
+        # Moves of which the exit speed is not known yet, and the planned
+        # entry speed squared of the first one
+        self.pending = None
+        self.entry2 = None
+        # Rows added which do not fill a block yet
+        self.rows = []
+        self.row_count = 0
+
+    def add(self, lines, x, y, z, e, f, stop = None, dwell = None):
+        """Adds the rows of a batch: a move to the position x, y, z, e at
+        feedrate f in mm/s, or where stop is set a stop of the motion after
+        which the position is x, y, z, e, for dwell seconds. Returns the line
+        indices and durations of the moves and stops of which the duration
+        became known."""
+        count = len(lines)
+        if not count:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0)
+        self.rows.append(numpy.column_stack((
+            numpy.asarray(lines, numpy.float64), x, y, z, e, f,
+            numpy.zeros(count) if stop is None else stop,
+            numpy.zeros(count) if dwell is None else dwell)))
+        self.row_count += count
+        if self.row_count < BATCH_SIZE:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0)
+        rows = numpy.concatenate(self.rows)
+        blocks = len(rows) - len(rows) % BATCH_SIZE
+        self.rows = [rows[blocks:]]
+        self.row_count = len(rows) - blocks
+        done_lines = []
+        done_durations = []
+        for start in range(0, blocks, BATCH_SIZE):
+            lines, durations = self._add(rows[start:start + BATCH_SIZE])
+            done_lines.append(lines)
+            done_durations.append(durations)
+        return self._result(done_lines, done_durations)
+
+    def _add(self, rows):
+        """Plans a block of rows as stacked by add()"""
+        lines = rows[:, 0].astype(numpy.int64)
+        count = len(lines)
+        x, y, z, e, f, stop, dwell = rows[:, 1:].T
+        stop = stop != 0
+        positions = numpy.column_stack([numpy.asarray(column, numpy.float64)
+                                        for column in (x, y, z, e)])
+        previous = numpy.vstack((self.position, positions[:-1]))
+        self.position = positions[-1].copy()
+        delta = positions - previous
+        xyz = numpy.sqrt((delta[:, :3] ** 2).sum(1))
+        length = numpy.where(xyz > 0, xyz, numpy.abs(delta[:, 3]))
+        rows = numpy.flatnonzero(~stop & (length > 0))
+
+        # Stops end the motion of the moves before them
+        stops_before = numpy.cumsum(stop)[rows]
+        after_stop = stops_before != numpy.concatenate(
+            ([0 if self.last_unit is not None else -1], stops_before[:-1]))
+        done_lines = []
+        done_durations = []
+        if stop.any():
+            done_lines.append(lines[stop])
+            done_durations.append(dwell[stop])
+        if not len(rows):
+            if stop.any():
+                self.last_unit = None
+            return self._result(done_lines, done_durations)
+
+        segments = self._segments(lines[rows], delta[rows], xyz[rows],
+                                  length[rows], f[rows], after_stop)
+        if stop[rows[-1] + 1:].any():
+            self.last_unit = None
+        self._plan(segments, False, done_lines, done_durations)
+        return self._result(done_lines, done_durations)
+
+    def finish(self):
+        """Plans the remaining moves to a stop at the end, returns their line
+        indices and durations"""
+        done_lines = []
+        done_durations = []
+        if self.row_count:
+            lines, durations = self._add(numpy.concatenate(self.rows))
+            self.rows = []
+            self.row_count = 0
+            done_lines.append(lines)
+            done_durations.append(durations)
+        if self.pending is not None:
+            self._plan(None, True, done_lines, done_durations)
+        return self._result(done_lines, done_durations)
+
+    def _result(self, lines, durations):
+        if not lines:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0)
+        return numpy.concatenate(lines), numpy.concatenate(durations)
+
+    def _segments(self, lines, delta, xyz, length, feedrate, after_stop):
+        limits = self.limits
+        count = len(lines)
+        extrusion = delta[:, 3] != 0
+        travel = xyz > 0
+        ratio = numpy.abs(delta) / length[:, None]
+        with numpy.errstate(divide = "ignore"):
+            axis_speed = numpy.where(ratio > 0, self.max_feedrate / ratio, numpy.inf)
+            axis_accel = numpy.where(ratio > 0, self.max_acceleration / ratio, numpy.inf)
+        speed = numpy.maximum(feedrate, numpy.where(extrusion, limits.min_feedrate,
+                                                    limits.min_travel_feedrate))
+        speed = numpy.minimum(speed, axis_speed.min(1))
+        accel = numpy.where(~travel, limits.retract_acceleration,
+                            numpy.where(extrusion, limits.acceleration,
+                                        limits.travel_acceleration))
+        accel = numpy.minimum(accel, axis_accel.min(1))
+        speed2 = speed ** 2
+
+        # Moves in X, Y or Z change direction by that, extruder-only moves
+        # by their E direction
+        unit = delta / length[:, None]
+        unit[travel, 3] = 0.0
+        previous_unit = numpy.vstack((numpy.zeros(len(AXES)) if self.last_unit is None
+                                      else self.last_unit, unit[:-1]))
+        previous_speed2 = numpy.concatenate(([self.last_speed2], speed2[:-1]))
+        if limits.junction_deviation is not None:
+            stop2 = numpy.full(count, MINIMUM_PLANNER_SPEED ** 2)
+            cos_theta = -(previous_unit * unit).sum(1)
+            sin_theta_d2 = numpy.sqrt(0.5 * (1.0 - numpy.clip(cos_theta, -1.0, 1.0)))
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                junction2 = accel * limits.junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2)
+            junction2 = numpy.where(cos_theta > 0.999999, stop2,
+                                    numpy.where(cos_theta < -0.999999, numpy.inf, junction2))
+        else:
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                safe = numpy.where(ratio > 0, self.max_jerk / numpy.abs(unit), numpy.inf)
+                jump = numpy.abs(unit - previous_unit)
+                jerk = numpy.where(jump > 0, self.max_jerk / jump, numpy.inf)
+            stop2 = numpy.minimum(speed, safe.min(1)) ** 2
+            junction2 = jerk.min(1) ** 2
+        junction2 = numpy.minimum(junction2, numpy.minimum(speed2, previous_speed2))
+        junction2 = numpy.where(after_stop, stop2, junction2)
+
+        self.last_unit = unit[-1]
+        self.last_speed2 = float(speed2[-1])
+        self.last_stop2 = float(stop2[-1])
+        return {"lines": lines, "length": length, "accel": accel,
+                "speed2": speed2, "junction2": junction2}
+
+    def _plan(self, segments, final, done_lines, done_durations):
+        pending = self.pending
+        if pending is None:
+            columns = segments
+        elif segments is None:
+            columns = pending
+        else:
+            columns = dict((name, numpy.concatenate((pending[name], segments[name])))
+                           for name in pending)
+        length = columns["length"]
+        accel = columns["accel"]
+        junction2 = columns["junction2"]
+        count = len(length)
+
+        # Largest entry speeds squared which still allow slowing down for
+        # the following moves; unknown moves could ask for a stop after the
+        # last one
+        reach = numpy.concatenate(([0.0], numpy.cumsum(2 * accel * length)))
+        if final:
+            junction2 = numpy.concatenate((junction2, [self.last_stop2]))
+            bound = reach
+        else:
+            bound = reach[:-1]
+        suffix = numpy.minimum.accumulate((junction2 + bound)[::-1])[::-1]
+        if final:
+            known = count + 1
+        else:
+            known = int(numpy.searchsorted(suffix, reach[-1], "right"))
+        entry2 = suffix[:known] - reach[:known]
+        if self.entry2 is not None and known:
+            entry2[0] = self.entry2
+        # Entry speeds squared which can be reached from the previous moves
+        entry2 = numpy.minimum.accumulate(entry2 - reach[:known]) + reach[:known]
+
+        planned = max(known - 1, 0)
+        if planned:
+            done_lines.append(columns["lines"][:planned])
+            done_durations.append(self._durations(
+                length[:planned], accel[:planned], columns["speed2"][:planned],
+                entry2[:planned], entry2[1:planned + 1]))
+        if final or planned == count:
+            self.pending = None
+            self.entry2 = None
+        else:
+            self.pending = dict((name, values[planned:]) for name, values in columns.items())
+            if known:
+                self.entry2 = float(entry2[planned])
+
+    @staticmethod
+    def _durations(length, accel, speed2, entry2, exit2):
+        """Durations of trapezoidal moves"""
+        peak2 = numpy.minimum(speed2, (2 * accel * length + entry2 + exit2) / 2)
+        peak2 = numpy.maximum(peak2, numpy.maximum(entry2, exit2))
+        peak = numpy.sqrt(peak2)
+        ramps = (2 * peak - numpy.sqrt(entry2) - numpy.sqrt(exit2)) / accel
+        cruise = numpy.maximum(length - (2 * peak2 - entry2 - exit2) / (2 * accel), 0.0)
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            return ramps + numpy.where(peak > 0, cruise / peak, 0.0)
+
+class Estimator:
+    """Plans the moves of a G-code while it is analysed and adds up the
+    durations of the moves per layer, for GCode._plan_layers()"""
+
+    def __init__(self, limits):
+        self.planner = Planner(limits)
+        self.rows = []
+        self.layer_durations = numpy.zeros(0)
+
+    def move(self, line, x, y, z, e, f):
+        """Buffers a move of line index line to x, y, z, e at f mm/s"""
+        self.rows.append((line, x, y, z, e, f, 0.0, 0.0))
+
+    def stop(self, line, x, y, z, e, dwell = 0.0):
+        """Buffers a stop of the motion, for dwell seconds"""
+        self.rows.append((line, x, y, z, e, 0.0, 1.0, dwell))
+
+    def full(self):
+        return len(self.rows) >= BATCH_SIZE
+
+    def flush(self, layer_idxs):
+        """Plans the buffered rows. layer_idxs is the layer index array of
+        the G-code, which has to cover the lines of the rows."""
+        if not self.rows:
+            return
+        rows = numpy.array(self.rows, numpy.float64)
+        self.rows = []
+        self.add(layer_idxs, rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3],
+                 rows[:, 4], rows[:, 5], rows[:, 6] != 0, rows[:, 7])
+
+    def add(self, layer_idxs, lines, x, y, z, e, f, stop = None, dwell = None):
+        """Plans a batch of rows, see Planner.add()"""
+        lines, durations = self.planner.add(lines, x, y, z, e, f, stop, dwell)
+        self._collect(layer_idxs, lines, durations)
+
+    def finish(self, layer_idxs, layer_count):
+        """Plans the last moves, returns the duration of every layer"""
+        self.flush(layer_idxs)
+        lines, durations = self.planner.finish()
+        self._collect(layer_idxs, lines, durations)
+        totals = numpy.zeros(layer_count)
+        count = min(layer_count, len(self.layer_durations))
+        totals[:count] = self.layer_durations[:count]
+        return totals.tolist()
+
+    def _collect(self, layer_idxs, lines, durations):
+        if not len(lines):
+            return
+        first = int(lines.min())
+        # Only the part of layer_idxs the lines are in is copied
+        layers = numpy.frombuffer(layer_idxs[first:int(lines.max()) + 1],
+                                  numpy.uint32)[lines - first]
+        sums = numpy.bincount(layers, durations)
+        if len(sums) > len(self.layer_durations):
+            sums[:len(self.layer_durations)] += self.layer_durations
+            self.layer_durations = sums
+        else:
+            self.layer_durations[:len(sums)] += sums
@@ -35,6 +35,10 @@ import re
 from functools import wraps, reduce
 from collections import deque
 from printrun import gcoder
+from printrun import sendstream
+from printrun import responses
+from printrun.resendwindow import ResendWindow
+from printrun.printmetrics import PrintMetrics
 from .utils import set_utf8_locale, install_locale, decode_utf8
 try:
     set_utf8_locale()
@@ -43,6 +47,16 @@ except:
 install_locale('pronterface')
 from printrun.plugins import PRINTCORE_HANDLER
 
+# Responses which show the printer is online
+ONLINE_KINDS = frozenset((responses.OK, responses.OK_TEMPS, responses.GREETING))
+
+# Bytes read from a TCP connection at once
+READ_SIZE = 4096
+
+# Lines precompiled at once when the send stream has to be extended while
+# printing, which bounds the lines it holds
+STREAM_CHUNK = 512
+
 def locked(f):
     @wraps(f)
     def inner(*args, **kw):
@@ -73,26 +87,68 @@ class printcore():
         self.dtr = None
         self.port = None
         self.analyzer = gcoder.GCode()
+        # Run the lines of a print through the analyzer as they are sent, for
+        # pause() to know where the print is. When False, pause() works that
+        # out from the checkpoints of the job instead (see GCode.state_at())
+        # and only commands sent outside of the print are analysed.
+        self.analyze_print = True
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
-        # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
-        self.clear = 0
+        # clear to send, enabled after responses. Waiting threads are woken
+        # through the condition as soon as it gets set.
+        self._clear = False
+        self.clear_condition = threading.Condition()
+        # Sliding window flow control: line number, encoded size and time of
+        # writing (from metrics.clock) of every line that has been written but
+        # not yet acknowledged, and their total size. More than one line is
+        # only kept in flight once the firmware reports its free buffer space
+        # through ADVANCED_OK replies, otherwise one line is sent per ok. The
+        # read thread retires the lines while the print thread adds them, so
+        # both are only touched while holding clear_condition.
+        self.inflight = deque()
+        self.inflight_bytes = 0
+        self.planner_free = None  # free planner blocks, as last reported
+        self.buffer_free = None  # free command buffer slots, as last reported
+        self.rx_buffer_size = 128  # size of the firmware serial RX buffer
+        self.buffer_depth = 0  # most command buffer slots ever reported free
+        self.held_line = None  # encoded line waiting for the window to open
+        # Lines kept in flight over TCP while the firmware does not report
+        # its buffer space, counted off by the oks: the size of its command
+        # buffer (BUFSIZE in Marlin). tcp_streaming_mode sends without any
+        # flow control instead, for hosts which do their own.
+        self.tcp_window = 4
         # The printer has responded to the initial command and is active
         self.online = False
         # is a print currently running, true if printing, false if paused
         self.printing = False
         self.mainqueue = None
+        # precompiled form of the lines of mainqueue about to be sent, see
+        # sendstream.SendStream
+        self.sendstream = None
         self.priqueue = Queue(0)
         self.queueindex = 0
         self.lineno = 0
         self.resendfrom = -1
+        self.resend_request = -1
+        self.resend_duplicates = 0
         self.paused = False
-        self.sentlines = {}
+        # Recently sent numbered lines, for resends, and the part of a resent
+        # range that still has to be replayed
+        self.sentlines = ResendWindow()
+        self.replay = deque()
         self.log = deque(maxlen = 10000)
-        self.sent = []
+        # Received data after the last complete line, and lines received but
+        # not handled yet
+        self.read_buffer = bytearray()
+        self.pending_lines = deque()
+        # Data written to a TCP connection which the socket did not take yet
+        self.send_buffer = bytearray()
+        self.send_lock = threading.Lock()
+        self.sent = deque(maxlen = 10000)
         self.writefailures = 0
+        # Health of the running print, see printmetrics.PrintMetrics
+        self.metrics = PrintMetrics()
         self.tempcb = None  # impl (wholeline)
         self.recvcb = None  # impl (wholeline)
         self.sendcb = None  # impl (wholeline)
@@ -105,14 +161,22 @@ class printcore():
         self.onlinecb = None  # impl ()
         self.loud = False  # emit sent and received lines to terminal
         self.tcp_streaming_mode = False
-        self.greetings = ['start', 'Grbl ']
+        self.greetings = responses.GREETINGS
         self.wait = 0  # default wait period for send(), send_now()
         self.read_thread = None
         self.stop_read_thread = False
         self.send_thread = None
         self.stop_send_thread = False
         self.print_thread = None
-        self.event_handler = PRINTCORE_HANDLER
+        # eventdispatch.EventDispatcher to deliver the events to the handlers
+        # and callbacks on a thread of its own, which may be shared with other
+        # instances; they are called inline on the read and print threads
+        # when None. preprintsendcb is always called inline, since it can
+        # replace the line to be sent.
+        self.dispatcher = None
+        # A copy, so handlers added to one instance are not called for the
+        # events of every other one
+        self.event_handler = list(PRINTCORE_HANDLER)
         for handler in self.event_handler:
             try: handler.on_init()
             except: logging.error(traceback.format_exc())
@@ -121,6 +185,40 @@ class printcore():
         self.xy_feedrate = None
         self.z_feedrate = None
 
+    def _get_clear(self):
+        return self._clear
+
+    def _set_clear(self, clear):
+        with self.clear_condition:
+            self._clear = clear
+            if clear:
+                self.clear_condition.notify_all()
+    clear = property(_get_clear, _set_clear)
+
+    def _wait_clear(self):
+        """Blocks until the printer is clear to receive the next command, or
+        until printing stops or the printer goes away"""
+        with self.clear_condition:
+            if self._clear or not (self.printer and self.printing):
+                return
+            started = self.metrics.clock()
+            while self.printer and self.printing and not self._clear:
+                self.clear_condition.wait()
+        self.metrics.waited(self.metrics.clock() - started)
+
+    def _wake_waiters(self):
+        with self.clear_condition:
+            self.clear_condition.notify_all()
+
+    @property
+    def greetings(self):
+        """Starts of the lines the firmware sends when it (re)starts"""
+        return self.classifier.greetings
+
+    @greetings.setter
+    def greetings(self, greetings):
+        self.classifier = responses.ResponseClassifier(greetings)
+
     def addEventHandler(self, handler):
         '''
         Adds an event handler.
@@ -129,7 +227,43 @@ class printcore():
         '''
         self.event_handler.append(handler)
 
+    def _dispatch(self, name, function, *args):
+        """Calls function(*args) for the event name, right away or through
+        the dispatcher"""
+        if self.dispatcher is None:
+            function(*args)
+        else:
+            self.dispatcher.post(name, function, args, self)
+
+    def _notify(self, name, args = (), callback = None, failed = None,
+                droppable = None):
+        """Calls the on_<name> methods of the event handlers and then
+        callback, with args. failed is the message logged before the
+        traceback if the callback raises. droppable is passed on to the
+        dispatcher."""
+        if self.dispatcher is None:
+            self._deliver(name, args, callback, failed)
+        else:
+            self.dispatcher.post(name, self._deliver,
+                                 (name, args, callback, failed), self,
+                                 droppable)
+
+    def _deliver(self, name, args, callback, failed):
+        for handler in self.event_handler:
+            try: getattr(handler, "on_" + name)(*args)
+            except: logging.error(traceback.format_exc())
+        if callback:
+            try: callback(*args)
+            except:
+                if failed:
+                    self.logError(failed + "\n" + traceback.format_exc())
+                else:
+                    self.logError(traceback.format_exc())
+
     def logError(self, error):
+        self._dispatch("error", self._report_error, error)
+
+    def _report_error(self, error):
         for handler in self.event_handler:
             try: handler.on_error(error)
             except: logging.error(traceback.format_exc())
@@ -151,6 +285,7 @@ class printcore():
                 self.read_thread = None
             if self.print_thread:
                 self.printing = False
+                self._wake_waiters()
                 self.print_thread.join()
             self._stop_sender()
             try:
@@ -159,9 +294,7 @@ class printcore():
                 pass
             except OSError:
                 pass
-        for handler in self.event_handler:
-            try: handler.on_disconnect()
-            except: logging.error(traceback.format_exc())
+        self._notify("disconnect")
         self.printer = None
         self.online = False
         self.printing = False
@@ -201,8 +334,10 @@ class printcore():
                 self.printer_tcp.settimeout(1.0)
                 try:
                     self.printer_tcp.connect((hostname, port_number))
+                    # Sends and receives wait for the socket at most this
+                    # long, so the threads can check whether to stop
                     self.printer_tcp.settimeout(self.timeout)
-                    self.printer = self.printer_tcp.makefile()
+                    self.printer = self.printer_tcp
                 except socket.error as e:
                     if(e.strerror is None): e.strerror=""
                     self.logError(_("Could not connect to %s:%s:") % (hostname, port_number) +
@@ -237,13 +372,19 @@ class printcore():
                                   "\n" + _("IO error: %s") % e)
                     self.printer = None
                     return
-            for handler in self.event_handler:
-                try: handler.on_connect()
-                except: logging.error(traceback.format_exc())
-            self.stop_read_thread = False
-            self.read_thread = threading.Thread(target = self._listen)
-            self.read_thread.start()
-            self._start_sender()
+            self._notify("connect")
+            del self.read_buffer[:]
+            del self.send_buffer[:]
+            self.pending_lines.clear()
+            self._start_io()
+
+    def _start_io(self):
+        """Starts reading from and sending to the printer once it has been
+        opened"""
+        self.stop_read_thread = False
+        self.read_thread = threading.Thread(target = self._listen)
+        self.read_thread.start()
+        self._start_sender()
 
     def reset(self):
         """Reset the printer
@@ -253,48 +394,120 @@ class printcore():
             time.sleep(0.2)
             self.printer.setDTR(0)
 
-    def _readline(self):
+    def _read(self):
+        """Waits up to the read timeout for data from the printer and returns
+        everything that is available by then, b"" if nothing arrived"""
+        if self.printer_tcp:
+            data = self.printer_tcp.recv(READ_SIZE)
+            if not data:
+                raise OSError(-1, "Read EOF from socket")
+            return data
+        printer = self.printer
+        # Blocks until the first byte arrives, the rest is read without
+        # waiting
+        data = printer.read(max(1, printer.in_waiting))
+        if data:
+            waiting = printer.in_waiting
+            if waiting:
+                data += printer.read(waiting)
+        return data
+
+    def _readlines(self):
+        """Returns the lines received from the printer as a list of
+        responses.Response, which is empty if nothing was received before
+        the read timed out. None ends the list if the connection failed or
+        rubbish was received. Partial lines are kept until the rest of them
+        arrives."""
+        if self.pending_lines:
+            lines = list(self.pending_lines)
+            self.pending_lines.clear()
+            return lines
+        if b"\n" in self.read_buffer:
+            # Left after rubbish
+            return self._received(b"")
         try:
             try:
-                try:
-                    line = self.printer.readline().decode('ascii')
-                except UnicodeDecodeError:
-                    self.logError(_("Got rubbish reply from %s at baudrate %s:") % (self.port, self.baud) +
-                                  "\n" + _("Maybe a bad baudrate?"))
-                    return None
-                if self.printer_tcp and not line:
-                    raise OSError(-1, "Read EOF from socket")
+                data = self._read()
             except socket.timeout:
-                return ""
-
-            if len(line) > 1:
-                self.log.append(line)
-                for handler in self.event_handler:
-                    try: handler.on_recv(line)
-                    except: logging.error(traceback.format_exc())
-                if self.recvcb:
-                    try: self.recvcb(line)
-                    except: self.logError(traceback.format_exc())
-                if self.loud: logging.info("RECV: %s" % line.rstrip())
-            return line
+                return []
+            except socket.error as e:
+                # select.error is socket.error too, so this is told apart
+                # from serial errors by the connection type
+                if not self.printer_tcp:
+                    raise
+                self.logError(_("Can't read from printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+                return [None]
+            return self._received(data)
+        # SerialException and select.error are both OSError, so the serial
+        # one goes first
+        except SerialException as e:
+            self.logError(_("Can't read from printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
+            return [None]
         except SelectError as e:
             if 'Bad file descriptor' in e.args[1]:
                 self.logError(_("Can't read from printer (disconnected?) (SelectError {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-                return None
+                return [None]
             else:
                 self.logError(_("SelectError ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
                 raise
-        except SerialException as e:
-            self.logError(_("Can't read from printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
-            return None
         except socket.error as e:
             self.logError(_("Can't read from printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-            return None
+            return [None]
         except OSError as e:
             if e.errno == errno.EAGAIN:  # Not a real error, no data was available
-                return ""
+                return []
             self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
-            return None
+            return [None]
+
+    def _received(self, data):
+        """Splits data received from the printer into lines, which are
+        logged, classified and passed to the recv handlers. Returns them as
+        for _readlines()."""
+        buffer = self.read_buffer
+        buffer += data
+        end = buffer.rfind(b"\n") + 1
+        if not end:
+            return []
+        complete = bytes(buffer[:end])
+        del buffer[:end]
+        failed = False
+        try:
+            lines = complete.decode('ascii').split("\n")
+        except UnicodeDecodeError:
+            # Keep the lines before the rubbish; the ones after it are
+            # received next, as when lines were read one by one
+            lines = []
+            raws = complete.split(b"\n")
+            for i, raw in enumerate(raws):
+                try:
+                    lines.append(raw.decode('ascii'))
+                except UnicodeDecodeError:
+                    failed = True
+                    buffer[0:0] = b"\n".join(raws[i + 1:])
+                    break
+            if failed:
+                self.logError(_("Got rubbish reply from %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("Maybe a bad baudrate?"))
+        if not failed:
+            lines.pop()  # after the last newline
+        # Every line is classified once; the Responses are what recv
+        # handlers get, so they do not have to work the kind out again
+        classify = self.classifier.classify
+        received = []
+        for line in lines:
+            line += "\n"
+            response = classify(line)
+            if len(line) > 1:
+                self.log.append(line)
+                # Errors, capabilities, settings reports and the like must
+                # reach the handlers even when the dispatcher is behind
+                self._notify("recv", (response,), self.recvcb,
+                             droppable = response.kind in responses.ROUTINE)
+                if self.loud: logging.info("RECV: %s" % line.rstrip())
+            received.append(response)
+        if failed:
+            received.append(None)
+        return received
 
     def _listen_can_continue(self):
         if self.printer_tcp:
@@ -311,31 +524,41 @@ class printcore():
                 return
             empty_lines = 0
             while self._listen_can_continue():
-                line = self._readline()
-                if line is None: break  # connection problem
+                lines = self._readlines()
                 # workaround cases where M105 was sent before printer Serial
-                # was online an empty line means read timeout was reached,
-                # meaning no data was received thus we count those empty lines,
+                # was online an empty read means read timeout was reached,
+                # meaning no data was received thus we count those empty reads,
                 # and once we have seen 15 in a row, we just break and send a
                 # new M105
                 # 15 was chosen based on the fact that it gives enough time for
                 # Gen7 bootloader to time out, and that the non received M105
                 # issues should be quite rare so we can wait for a long time
                 # before resending
-                if not line:
+                if not lines:
                     empty_lines += 1
                     if empty_lines == 15: break
-                else: empty_lines = 0
-                if line.startswith(tuple(self.greetings)) \
-                   or line.startswith('ok') or "T:" in line:
-                    self.online = True
-                    for handler in self.event_handler:
-                        try: handler.on_online()
-                        except: logging.error(traceback.format_exc())
-                    if self.onlinecb:
-                        try: self.onlinecb()
-                        except: self.logError(traceback.format_exc())
+                    continue
+                empty_lines = 0
+                rest = self._go_online(lines)
+                if rest is not None:
+                    # The lines after it are for _listen()
+                    self.pending_lines.extend(rest)
                     return
+                # Rubbish or a connection problem; try again with a new M105
+                if lines[-1] is None: break
+
+    def _go_online(self, lines):
+        """Sets the printer online if one of the lines shows that it is.
+        Returns the lines after that one, or None if none of them did."""
+        for i, line in enumerate(lines):
+            if line is None:
+                return None
+            if line.kind in ONLINE_KINDS or "T:" in line:
+                self._reset_window()
+                self.online = True
+                self._notify("online", (), self.onlinecb)
+                return lines[i + 1:]
+        return None
 
     def _listen(self):
         """This function acts on messages from the firmware
@@ -344,38 +567,145 @@ class printcore():
         if not self.printing:
             self._listen_until_online()
         while self._listen_can_continue():
-            line = self._readline()
+            lines = self._readlines()
+            self._handle_lines(lines)
+            if lines and lines[-1] is None:
+                break
+        self.clear = True
+        if self.printer_tcp and self.printer and not self.stop_read_thread:
+            self._connection_lost()
+
+    def _connection_lost(self):
+        """Closes a TCP connection after reading from it failed, because the
+        other end closed it or sent rubbish. A print that was running is
+        paused, so it can be resumed once connect() got the printer online
+        again; the disconnect event is sent as for disconnect(). There is no
+        automatic reconnect, since the printer may have reset."""
+        # Without a printer the print and sender threads stop writing
+        printer = self.printer
+        self.printer = None
+        if self.printing:
+            self.pause()
+        self.stop_read_thread = True
+        self.read_thread = None
+        self._stop_sender()
+        try:
+            printer.close()
+        except socket.error:
+            pass
+        self._notify("disconnect")
+        self.online = False
+
+    def _handle_lines(self, lines):
+        """Acts on lines received at once. They are all handled before the
+        sender is woken up, so it can fill the window in one go."""
+        clear = False
+        for line in lines:
             if line is None:
                 break
-            if line.startswith('DEBUG_'):
-                continue
-            if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
-                self.clear = True
-            if line.startswith('ok') and "T:" in line:
-                for handler in self.event_handler:
-                    try: handler.on_temp(line)
-                    except: logging.error(traceback.format_exc())
-            if line.startswith('ok') and "T:" in line and self.tempcb:
+            clear = self._process_line(line) or clear
+        if clear:
+            self.clear = True
+
+    def _process_line(self, response):
+        """Acts on a response from the firmware, returns True if the printer
+        is clear to receive the next command after it"""
+        kind = response.kind
+        if kind == responses.OK or kind == responses.OK_TEMPS:
+            self._acknowledge(response)
+            if kind == responses.OK_TEMPS:
                 # callback for temp, status, whatever
-                try: self.tempcb(line)
-                except: self.logError(traceback.format_exc())
-            elif line.startswith('Error'):
-                self.logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
-                        break
-                    except:
-                        pass
-                self.clear = True
-        self.clear = True
+                self._notify("temp", (response,), self.tempcb)
+            return True
+        if kind == responses.GREETING:
+            self._reset_window()
+            return True
+        if kind == responses.ERROR:
+            if not response.fatal:
+                self.logError(response)
+        elif kind == responses.RESEND:
+            if response.lineno is not None:
+                self._request_resend(response.lineno)
+            # "Resend:" style requests are always followed by an ok, which
+            # is what clears the line. Clearing on both would put two
+            # lines in flight as soon as the sender wakes up on the first.
+            # Teacup's "rs N2 Expected checksum 67" is not.
+            return response.startswith("rs")
+        return False
+
+    def _request_resend(self, lineno):
+        # Every line that was already sent behind the rejected one makes the
+        # firmware ask for the same line again. Those requests are ignored,
+        # so the replay is not restarted over and over.
+        if lineno == self.resend_request and self.resend_duplicates > 0:
+            self.resend_duplicates -= 1
+            return
+        self.resendfrom = lineno
+        self.resend_request = lineno
+        self.resend_duplicates = max(0, self.lineno - lineno - 1)
+        self.metrics.resends += 1
+
+    def _reset_window(self):
+        with self.clear_condition:
+            self.inflight.clear()
+            self.inflight_bytes = 0
+        self.planner_free = None
+        self.buffer_free = None
+
+    def _acknowledge(self, response):
+        """Retires acknowledged lines from the sliding window and stores the
+        buffer state reported by ADVANCED_OK replies"""
+        if response.buffer_free is not None:
+            self.planner_free = response.planner_free
+            self.buffer_free = response.buffer_free
+            if self.buffer_free > self.buffer_depth:
+                self.buffer_depth = self.buffer_free
+                self.sentlines.fit(self.buffer_depth)
+            if response.lineno is not None:
+                self._retire(response.lineno)
+                return
+        with self.clear_condition:
+            if self.inflight:
+                lineno, size, sent_at = self.inflight.popleft()
+                self.inflight_bytes -= size
+                self.metrics.acknowledged(sent_at)
+
+    def _retire(self, acked):
+        """Retires the lines up to the acknowledged line number, which also
+        resyncs the window if an ok was ever lost. An ok for a line which is
+        not in flight (a stale or duplicated one) retires nothing, since the
+        lines that are in flight are still in the buffers of the firmware."""
+        with self.clear_condition:
+            inflight = self.inflight
+            if not any(entry[0] == acked for entry in inflight):
+                return
+            while True:
+                lineno, size, sent_at = inflight.popleft()
+                self.inflight_bytes -= size
+                if lineno == acked:
+                    break
+            self.metrics.acknowledged(sent_at)
+
+    def _track(self, data, lineno = None):
+        with self.clear_condition:
+            self.inflight.append((lineno, len(data), self.metrics.clock()))
+            self.inflight_bytes += len(data)
+
+    def _window_open(self, size = 0):
+        """Returns True if a line of the given size can be sent before the
+        next ok. Without buffer reports from the firmware only a single line
+        is kept in flight, or tcp_window lines over TCP."""
+        if not self.inflight:
+            return True
+        if self.buffer_free is not None:
+            window = self.buffer_free
+        elif self.printer_tcp:
+            window = self.tcp_window
+        else:
+            return False
+        with self.clear_condition:
+            return (len(self.inflight) < window
+                    and self.inflight_bytes + size <= self.rx_buffer_size)
 
     def _start_sender(self):
         self.stop_send_thread = False
@@ -385,52 +715,86 @@ class printcore():
     def _stop_sender(self):
         if self.send_thread:
             self.stop_send_thread = True
+            # Wake the sender thread up from its blocking wait on the queue
+            self.priqueue.put_nowait(None)
             self.send_thread.join()
             self.send_thread = None
 
     def _sender(self):
         while not self.stop_send_thread:
-            try:
-                command = self.priqueue.get(True, 0.1)
-            except QueueEmpty:
+            command = self.priqueue.get()
+            if command is None:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
             self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
 
     def _checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
 
-    def startprint(self, gcode, startindex = 0):
+    def startprint(self, gcode, startindex = 0, stream = None):
         """Start a print, gcode is an array of gcode commands.
         returns True on success, False if already printing.
         The print queue will be replaced with the contents of the data array,
         the next line will be set to 0 and the firmware notified. Printing
         will then start in a parallel thread.
+        stream is the SendStream gcode is precompiled into as it is sent; a
+        new one is made if it is not passed in.
         """
         if self.printing or not self.online or not self.printer:
             return False
+        # gcode may still be analysed in the background, has_index() waits
+        # for its first layer
+        has_lines = gcode is not None and gcode.has_index(0)
+        if stream is None and has_lines:
+            stream = sendstream.SendStream(checksums = not self.printer_tcp)
         self.queueindex = startindex
         self.mainqueue = gcode
+        self.sendstream = stream
         self.printing = True
         self.lineno = 0
         self.resendfrom = -1
+        self.resend_request = -1
+        self.resend_duplicates = 0
+        self.sentlines.clear()
+        self.replay.clear()
+        self.metrics.reset()
+        if has_lines:
+            # Before the M110 goes out, since its ok can come in right away
+            self.clear = False
         self._send("M110", -1, True)
-        if not gcode or not gcode.lines:
+        if not has_lines:
             return True
-        self.clear = False
         resuming = (startindex != 0)
+        self._start_print_thread(resuming)
+        return True
+
+    def _start_print_thread(self, resuming):
         self.print_thread = threading.Thread(target = self._print,
                                              kwargs = {"resuming": resuming})
         self.print_thread.start()
-        return True
+
+    def _stop_print_thread(self):
+        """Waits for the print thread to stop after printing was turned off"""
+        # try joining the print thread: enclose it in try/except because we
+        # might be calling it from the thread itself
+        try:
+            self.print_thread.join()
+        except RuntimeError as e:
+            if e.message == "cannot join current thread":
+                pass
+            else:
+                self.logError(traceback.format_exc())
+        except:
+            self.logError(traceback.format_exc())
+
+        self.print_thread = None
 
     def cancelprint(self):
         self.pause()
         self.paused = False
         self.mainqueue = None
+        self.sendstream = None
         self.clear = True
 
     # run a simple script if it exists, no multithreading
@@ -452,28 +816,22 @@ class printcore():
         if not self.printing: return False
         self.paused = True
         self.printing = False
-
-        # try joining the print thread: enclose it in try/except because we
-        # might be calling it from the thread itself
-        try:
-            self.print_thread.join()
-        except RuntimeError as e:
-            if e.message == "cannot join current thread":
-                pass
-            else:
-                self.logError(traceback.format_exc())
-        except:
-            self.logError(traceback.format_exc())
-
-        self.print_thread = None
+        self._wake_waiters()
+        self._stop_print_thread()
 
         # saves the status
-        self.pauseX = self.analyzer.abs_x
-        self.pauseY = self.analyzer.abs_y
-        self.pauseZ = self.analyzer.abs_z
-        self.pauseE = self.analyzer.abs_e
-        self.pauseF = self.analyzer.current_f
-        self.pauseRelative = self.analyzer.relative
+        if self.analyze_print or self.mainqueue is None:
+            state = self.analyzer
+        else:
+            # Where the print is after the last line of the job that was
+            # sent; lines still in flight are executed by the firmware
+            state = self.mainqueue.state_at(self.queueindex)
+        self.pauseX = state.abs_x
+        self.pauseY = state.abs_y
+        self.pauseZ = state.abs_z
+        self.pauseE = state.abs_e
+        self.pauseF = state.current_f
+        self.pauseRelative = state.relative
 
     def resume(self):
         """Resumes a paused print.
@@ -502,9 +860,8 @@ class printcore():
 
         self.paused = False
         self.printing = True
-        self.print_thread = threading.Thread(target = self._print,
-                                             kwargs = {"resuming": True})
-        self.print_thread.start()
+        self.metrics.resume()
+        self._start_print_thread(True)
 
     def send(self, command, wait = 0):
         """Adds a command to the checksummed main command queue if printing, or
@@ -529,29 +886,19 @@ class printcore():
     def _print(self, resuming = False):
         self._stop_sender()
         try:
-            for handler in self.event_handler:
-                try: handler.on_start(resuming)
-                except: logging.error(traceback.format_exc())
-            if self.startcb:
-                # callback for printing started
-                try: self.startcb(resuming)
-                except:
-                    self.logError(_("Print start callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            # callback for printing started
+            self._notify("start", (resuming,), self.startcb,
+                         _("Print start callback failed with:"))
             while self.printing and self.printer and self.online:
                 self._sendnext()
-            self.sentlines = {}
+            self._flush_held_line()
+            self.sentlines.clear()
+            self.replay.clear()
             self.log.clear()
-            self.sent = []
-            for handler in self.event_handler:
-                try: handler.on_end()
-                except: logging.error(traceback.format_exc())
-            if self.endcb:
-                # callback for printing done
-                try: self.endcb()
-                except:
-                    self.logError(_("Print end callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self.sent.clear()
+            # callback for printing done
+            self._notify("end", (), self.endcb,
+                         _("Print end callback failed with:"))
         except:
             self.logError(_("Print thread died due to the following error:") +
                           "\n" + traceback.format_exc())
@@ -559,6 +906,19 @@ class printcore():
             self.print_thread = None
             self._start_sender()
 
+    def _flush_held_line(self):
+        """Writes out a line that was held back for a full window when the
+        print loop stops"""
+        if self.held_line is None:
+            return
+        with self.clear_condition:
+            self.clear_condition.wait_for(lambda: self._clear or not self.printer,
+                                          timeout = 1.0)
+        data, lineno = self.held_line
+        self.held_line = None
+        self._track(data, lineno)
+        self._write(data)
+
     def process_host_command(self, command):
         """only ;@pause command is implemented as a host command in printcore, but hosts are free to reimplement this method"""
         command = command.lstrip()
@@ -568,41 +928,89 @@ class printcore():
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
+        self._wait_clear()
+        self._send_batch()
+
+    def _send_batch(self):
+        """Writes the next lines out, as many as the window allows"""
         # Only wait for oks when using serial connections or when not using tcp
         # in streaming mode
-        if not self.printer_tcp or not self.tcp_streaming_mode:
+        streaming = self.printer_tcp and self.tcp_streaming_mode
+        if not streaming:
             self.clear = False
         if not (self.printing and self.printer and self.online):
             self.clear = True
             return
+        # Gather as many lines as the window allows and write them at once
+        batch = []
+        batch_size = 0
+        while self.printing and self.printer and self.online:
+            nextline = self.held_line
+            self.held_line = None
+            if nextline is not None and nextline[1] is not None \
+               and -1 < self.resendfrom <= nextline[1]:
+                # A held numbered line will be replayed by the resend
+                nextline = None
+            if nextline is None:
+                if batch and self._print_done():
+                    # Write the batch out before _nextline() waits for the
+                    # oks of the last lines
+                    break
+                nextline = self._nextline()
+            if nextline is None:
+                if batch:
+                    break
+                continue
+            data, lineno = nextline
+            if data is None:
+                break
+            # The first line of a batch goes through the window too: an ok
+            # wakes the sender up as soon as it retires a line, but the next
+            # line may be larger than the room that made. Only without flow
+            # control the first line is always sent.
+            if (batch or not streaming) and not self._window_open(len(data)):
+                self.held_line = (data, lineno)
+                break
+            self._track(data, lineno)
+            batch.append(data)
+            batch_size += len(data)
+            if not self._window_open():
+                break
+        if batch:
+            self._write(b"".join(batch))
+        if streaming:
+            self.clear = True
+        elif self.held_line is None and self._window_open():
+            self.clear = True
+
+    def _print_done(self):
+        """Returns True if all lines of the print have been sent"""
+        return (not -1 < self.resendfrom < self.lineno
+                and self.priqueue.empty()
+                and not self.mainqueue.has_index(self.queueindex))
+
+    def _nextline(self):
+        """Returns the next encoded line to send and its line number, or None
+        if nothing had to be sent for this step of the print"""
         if self.resendfrom < self.lineno and self.resendfrom > -1:
-            self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
-            self.resendfrom += 1
-            return
+            return self._nextresend()
         self.resendfrom = -1
+        self.replay.clear()
         if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
+            command = self.priqueue.get_nowait()
             self.priqueue.task_done()
-            return
+            if command is None:  # wake-up left behind for the sender thread
+                return None
+            return self._prepare_send(command), None
         if self.printing and self.mainqueue.has_index(self.queueindex):
             (layer, line) = self.mainqueue.idxs(self.queueindex)
-            gline = self.mainqueue.all_layers[layer][line]
+            gline = queued_gline = self.mainqueue.all_layers[layer][line]
             if self.queueindex > 0:
                 (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
                 if prev_layer != layer:
-                    for handler in self.event_handler:
-                        try: handler.on_layerchange(layer)
-                        except: logging.error(traceback.format_exc())
-            if self.layerchangecb and self.queueindex > 0:
-                (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
-                if prev_layer != layer:
-                    try: self.layerchangecb(layer)
-                    except: self.logError(traceback.format_exc())
-            for handler in self.event_handler:
-                try: handler.on_preprintsend(gline, self.queueindex, self.mainqueue)
-                except: logging.error(traceback.format_exc())
+                    self._notify("layerchange", (layer,), self.layerchangecb)
+            self._notify("preprintsend",
+                         (gline, self.queueindex, self.mainqueue))
             if self.preprintsendcb:
                 if self.mainqueue.has_index(self.queueindex + 1):
                     (next_layer, next_line) = self.mainqueue.idxs(self.queueindex + 1)
@@ -612,80 +1020,189 @@ class printcore():
                 gline = self.preprintsendcb(gline, next_gline)
             if gline is None:
                 self.queueindex += 1
-                self.clear = True
-                return
-            tline = gline.raw
-            if tline.lstrip().startswith(";@"):  # check for host command
-                self.process_host_command(tline)
+                return None
+            stream = self.sendstream
+            index = self.queueindex
+            if stream is not None and index >= len(stream):
+                # The lines before this one have been sent, resends take
+                # them from sentlines
+                stream.discard(index)
+                stream.update(self.mainqueue, index + STREAM_CHUNK)
+            if stream is not None and gline is queued_gline \
+               and stream.start <= index < len(stream) \
+               and not stream.line_flags(index) & sendstream.UNENCODABLE:
+                # Use the precompiled line
+                tline = None
+                flags = stream.line_flags(index)
+                host_command = flags & sendstream.HOST_COMMAND
+                empty = flags & sendstream.EMPTY
+            else:
+                tline = gline.raw
+                host_command = tline.lstrip().startswith(";@")
+                if not host_command:
+                    # Strip comments
+                    tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
+                empty = not tline
+            if host_command:
+                self.process_host_command(gline.raw)
                 self.queueindex += 1
-                self.clear = True
-                return
+                return None
 
-            # Strip comments
-            tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
-            if tline:
-                self._send(tline, self.lineno, True)
+            data = None
+            if not empty:
+                lineno = self.lineno
+                analyze = self.analyze_print
+                if tline is not None:
+                    data = self._prepare_send(tline, lineno, True, analyze)
+                elif self.printer_tcp:
+                    data = self._prepare_frame(stream.command(index) + b"\n",
+                                               analyze = analyze)
+                else:
+                    data = self._prepare_frame(stream.frame(index, lineno),
+                                               lineno, analyze)
                 self.lineno += 1
-                for handler in self.event_handler:
-                    try: handler.on_printsend(gline)
-                    except: logging.error(traceback.format_exc())
-                if self.printsendcb:
-                    try: self.printsendcb(gline)
-                    except: self.logError(traceback.format_exc())
-            else:
-                self.clear = True
+                self.metrics.line_sent(layer, self.mainqueue.all_layers[layer])
+                self._notify("printsend", (gline,), self.printsendcb)
             self.queueindex += 1
+            if data is not None:
+                return data, lineno
+            return None
         else:
+            if self.buffer_free is not None and self.inflight:
+                self._wait_last_oks()
+                if self.resendfrom > -1:
+                    return None
             self.printing = False
             self.clear = True
             if not self.paused:
                 self.queueindex = 0
                 self.lineno = 0
-                self._send("M110", -1, True)
+                return self._prepare_send("M110", -1, True), -1
+            return None
+
+    def _last_oks_in(self):
+        return (not self.inflight or self.resendfrom > -1
+                or not self.printing or not self.printer)
+
+    def _wait_last_oks(self):
+        """Gives the firmware a chance to ask for resends of the last lines
+        in the window before the line numbers get reset"""
+        with self.clear_condition:
+            self.clear_condition.wait_for(self._last_oks_in, timeout = 5.0)
+
+    def _nextresend(self):
+        """Returns the next line of a resend and its line number. The whole
+        range from the requested line on is taken from the resend window at
+        once, and taken again only if a new resend is requested."""
+        lineno = self.resendfrom
+        if not self.replay or self.replay[0][0] != lineno:
+            frames = self.sentlines.lines(lineno, self.lineno)
+            if frames is None:
+                self.logError(_("Printer asked to resend line %d, which is no longer held (lines %d to %d are); stopping the print.")
+                              % (lineno, self.sentlines.start, self.sentlines.end - 1))
+                self.resendfrom = -1
+                self.replay.clear()
+                self.printing = False
+                return None
+            self.replay = deque(zip(range(lineno, self.lineno), frames))
+            self.metrics.lines_resent += len(self.replay)
+        lineno, data = self.replay.popleft()
+        self.resendfrom = lineno + 1
+        return self._announce(data[:-1].decode('ascii'), data,
+                              self.analyze_print), lineno
 
     def _send(self, command, lineno = 0, calcchecksum = False):
+        data = self._prepare_send(command, lineno, calcchecksum)
+        if data is not None:
+            self._track(data, lineno if calcchecksum else None)
+            self._write(data)
+
+    def _prepare_send(self, command, lineno = 0, calcchecksum = False,
+                      analyze = True):
+        """Adds the line number and checksum to a command if requested, runs
+        it past the analyzer (if analyze is set) and the send handlers and
+        returns it encoded. Returns None if there is no printer to send to."""
         # Only add checksums if over serial (tcp does the flow control itself)
+        data = None
         if calcchecksum and not self.printer_tcp:
             prefix = "N" + str(lineno) + " " + command
             command = prefix + "*" + str(self._checksum(prefix))
             if "M110" not in command:
-                self.sentlines[lineno] = command
-        if self.printer:
-            self.sent.append(command)
-            # run the command through the analyzer
-            gline = None
+                data = (command + "\n").encode('ascii')
+                self.sentlines.add(lineno, data)
+        if data is None:
+            data = (command + "\n").encode('ascii')
+        return self._announce(command, data, analyze)
+
+    def _prepare_frame(self, data, lineno = None, analyze = True):
+        """Like _prepare_send, for a line that has already been encoded and
+        checksummed for the given line number"""
+        if lineno is not None and b"M110" not in data:
+            self.sentlines.add(lineno, data)
+        return self._announce(data[:-1].decode('ascii'), data, analyze)
+
+    def _announce(self, command, data, analyze = True):
+        """Passes a command that is about to be written past the analyzer (if
+        analyze is set) and the send handlers, which get None for its gline
+        otherwise. Returns its encoded form, or None if there is no printer
+        to send to."""
+        if not self.printer:
+            return None
+        self.sent.append(command)
+        # run the command through the analyzer
+        gline = None
+        if analyze:
             try:
                 gline = self.analyzer.append(command, store = False)
             except:
                 logging.warning(_("Could not analyze command %s:") % command +
                                 "\n" + traceback.format_exc())
-            if self.loud:
-                logging.info("SENT: %s" % command)
-
-            for handler in self.event_handler:
-                try: handler.on_send(command, gline)
-                except: logging.error(traceback.format_exc())
-            if self.sendcb:
-                try: self.sendcb(command, gline)
-                except: self.logError(traceback.format_exc())
-            try:
-                self.printer.write((command + "\n").encode('ascii'))
-                if self.printer_tcp:
-                    try:
-                        self.printer.flush()
-                    except socket.timeout:
-                        pass
-                self.writefailures = 0
-            except socket.error as e:
-                if e.errno is None:
-                    self.logError(_("Can't write to printer (disconnected ?):") +
-                                  "\n" + traceback.format_exc())
-                else:
-                    self.logError(_("Can't write to printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-                self.writefailures += 1
-            except SerialException as e:
-                self.logError(_("Can't write to printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
-                self.writefailures += 1
-            except RuntimeError as e:
-                self.logError(_("Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-                self.writefailures += 1
+        if self.loud:
+            logging.info("SENT: %s" % command)
+
+        self._notify("send", (command, gline), self.sendcb)
+        return data
+
+    def _write(self, data):
+        if not self.printer:
+            return
+        try:
+            if self.printer_tcp:
+                self._write_tcp(data)
+            else:
+                self.printer.write(data)
+            self.writefailures = 0
+        except socket.error as e:
+            if self.printer_tcp:
+                with self.send_lock:
+                    del self.send_buffer[:]
+            if e.errno is None:
+                self.logError(_("Can't write to printer (disconnected ?):") +
+                              "\n" + traceback.format_exc())
+            else:
+                self.logError(_("Can't write to printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
+            self.metrics.write_failures += 1
+        except SerialException as e:
+            self.logError(_("Can't write to printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
+            self.writefailures += 1
+            self.metrics.write_failures += 1
+        except RuntimeError as e:
+            self.logError(_("Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
+            self.metrics.write_failures += 1
+
+    def _write_tcp(self, data):
+        """Writes data to the TCP connection in as few sends as the socket
+        allows. What it does not take at once stays in the send buffer, and
+        goes out as soon as there is room, ahead of anything written after
+        it; this waits until then or until the connection is closed."""
+        with self.send_lock:
+            buffer = self.send_buffer
+            buffer += data
+            while buffer and self.printer:
+                try:
+                    sent = self.printer_tcp.send(buffer)
+                except socket.timeout:
+                    continue
+                del buffer[:sent]
@@ -0,0 +1,224 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the buckets of the ok round trip histogram, in seconds.
+# One more bucket holds everything slower.
+RTT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2,
+               0.5, 1.0, 2.0, 5.0)
+# Windows the lines per second are reported over, in seconds
+RATE_WINDOWS = (1, 10, 60)
+# The firmware running out of moves for less than this long is not counted
+# as starving; the durations of single lines are only known on average
+STARVATION_THRESHOLD = 0.05
+
+class PrintMetrics:
+    """Health of a running print, updated by printcore as it sends lines
+    and receives oks.
+
+    Kept are a histogram of the time from writing a line to its ok, the
+    lines sent per second over sliding windows, the time spent waiting for
+    the printer to be clear to send, resends and write failures.
+
+    Planner starvation is detected by adding up the time the firmware needs
+    for the lines sent, taken as the planned duration of their layer spread
+    over its lines. When the next line goes out after the firmware would
+    have run out of moves, the planner starved for that long. A starvation
+    during which printcore mostly waited for oks is blamed on the printer
+    or the connection (waiting_starvations: slow oks, blocking commands
+    like M109), otherwise on the host (host_starvations: lines not ready,
+    a busy machine).
+
+    The counters are updated without locking, at the cost of a clock read
+    and a few additions per line. snapshot() may be called from any thread
+    and returns a consistent enough view for monitoring.
+    """
+
+    def __init__(self, clock = time.monotonic):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """Starts over, for a new print"""
+        self.started = self.clock()
+        self.lines = 0  # print lines sent, resends not included
+        self.rtt_counts = [0] * (len(RTT_BUCKETS) + 1)
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+        self.clear_wait = 0.0  # seconds spent waiting for clear
+        self.resends = 0  # resend requests acted on
+        self.lines_resent = 0
+        self.write_failures = 0
+        # Lines sent per second of the last max(RATE_WINDOWS) seconds
+        self.second = 0  # whole seconds of the clock of the last line
+        self.second_counts = [0] * max(RATE_WINDOWS)
+        # Planner starvation
+        self.layer = None  # the layer the lines sent last are in
+        self.line_time = None  # average duration of its lines
+        self.moves_until = None  # when the firmware runs out of moves
+        self.clear_wait_sent = 0.0  # clear_wait when the last line went out
+        self.starved = 0.0
+        self.host_starvations = 0
+        self.waiting_starvations = 0
+
+    def resume(self):
+        """Forgets when the firmware runs out of moves, so the time paused
+        is not taken for starvation"""
+        self.moves_until = None
+
+    def line_sent(self, layer_index, layer):
+        """Called for every print line sent, with the layer it is in"""
+        now = self.clock()
+        self.lines += 1
+        second = int(now)
+        if second != self.second:
+            counts = self.second_counts
+            # Clear the seconds which went by without any lines
+            for skipped in range(self.second + 1,
+                                 min(second, self.second + len(counts)) + 1):
+                counts[skipped % len(counts)] = 0
+            self.second = second
+        self.second_counts[second % len(self.second_counts)] += 1
+
+        if layer_index != self.layer:
+            self.layer = layer_index
+            duration = getattr(layer, "duration", None)
+            self.line_time = duration / len(layer) if duration else None
+        if self.line_time is None:
+            # Durations are not known until the analysis is done
+            self.moves_until = None
+            return
+        moves_until = self.moves_until
+        if moves_until is None:
+            moves_until = now
+        elif moves_until < now:
+            gap = now - moves_until
+            if gap >= STARVATION_THRESHOLD:
+                self.starved += gap
+                if self.clear_wait - self.clear_wait_sent > gap / 2:
+                    self.waiting_starvations += 1
+                else:
+                    self.host_starvations += 1
+            moves_until = now
+        self.moves_until = moves_until + self.line_time
+        self.clear_wait_sent = self.clear_wait
+
+    def acknowledged(self, sent_at):
+        """Called for a line written at sent_at, as read from the clock,
+        once its ok came in"""
+        rtt = self.clock() - sent_at
+        self.rtt_counts[bisect_left(RTT_BUCKETS, rtt)] += 1
+        self.rtt_total += rtt
+        if rtt > self.rtt_max:
+            self.rtt_max = rtt
+
+    def waited(self, seconds):
+        """Called with the time spent waiting for the printer to be clear"""
+        self.clear_wait += seconds
+
+    def _rtt_percentile(self, counts, fraction):
+        """Returns the upper bound of the bucket the fraction of the round
+        trips is in, in ms, or the maximum if that is lower"""
+        target = fraction * sum(counts)
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= target and count:
+                if bucket < len(RTT_BUCKETS):
+                    return min(RTT_BUCKETS[bucket], self.rtt_max) * 1000
+                break
+        return self.rtt_max * 1000
+
+    def snapshot(self):
+        """Returns the metrics as a dict of plain values, which can be
+        written out as JSON"""
+        now = self.clock()
+        counts = list(self.rtt_counts)
+        acknowledged = sum(counts)
+        # Seconds after the one of the last line have not been cleared yet
+        current = int(now)
+        rates = {}
+        for window in RATE_WINDOWS:
+            lines = 0
+            for second in range(current - window + 1, current + 1):
+                if self.second - len(self.second_counts) < second <= self.second:
+                    lines += self.second_counts[second % len(self.second_counts)]
+            rates[str(window)] = lines / window
+        moves_until = self.moves_until
+        return {
+            "time": time.time(),
+            "seconds": round(now - self.started, 3),
+            "lines": self.lines,
+            "lines_per_second": rates,
+            "ok_rtt": {
+                "count": acknowledged,
+                "buckets_ms": [bound * 1000 for bound in RTT_BUCKETS] + [None],
+                "counts": counts,
+                "mean_ms": self.rtt_total / acknowledged * 1000 if acknowledged else None,
+                "p50_ms": self._rtt_percentile(counts, 0.5) if acknowledged else None,
+                "p99_ms": self._rtt_percentile(counts, 0.99) if acknowledged else None,
+                "max_ms": self.rtt_max * 1000,
+            },
+            "clear_wait_seconds": round(self.clear_wait, 3),
+            "resends": self.resends,
+            "lines_resent": self.lines_resent,
+            "write_failures": self.write_failures,
+            "planner": {
+                # None while the durations of the lines are not known
+                "moves_ahead_seconds": None if moves_until is None else round(max(0.0, moves_until - now), 3),
+                "starved_seconds": round(self.starved, 3),
+                "host_starvations": self.host_starvations,
+                "waiting_starvations": self.waiting_starvations,
+            },
+        }
+
+class MetricsLog:
+    """Appends snapshots of PrintMetrics to a file every interval seconds,
+    one JSON object per line, from a thread of its own"""
+
+    def __init__(self, metrics, path, interval = 10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self._run,
+                                       name = "print metrics log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops logging, after writing a last snapshot"""
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                stopping = self.stopped.wait(self.interval)
+                f.write(json.dumps(self.metrics.snapshot()) + "\n")
+                f.flush()
+                if stopping:
+                    break
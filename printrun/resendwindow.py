@@ -0,0 +1,91 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Lines kept at least, also when the firmware does not report its buffer
+MINIMUM_CAPACITY = 64
+# Lines kept per command buffer slot of the firmware
+SLOTS_PER_BUFFER = 4
+
+class ResendWindow:
+    """Ring buffer of the most recently sent numbered lines.
+
+    Holds the encoded frames of the last capacity line numbers, so lines
+    the firmware asks to be resent can be replayed. The firmware only ever
+    asks for a line it has not accepted yet, which is at most a command
+    buffer's worth of lines behind the last one sent, so memory use stays
+    the same no matter how long a print runs. Line numbers are expected to
+    be stored in sequence; storing any other line number starts over.
+    """
+
+    def __init__(self, capacity = MINIMUM_CAPACITY):
+        self.capacity = capacity
+        self.frames = [None] * capacity
+        self.start = 0  # oldest line number held
+        self.end = 0  # line number after the last one held
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __contains__(self, lineno):
+        return self.start <= lineno < self.end
+
+    def clear(self):
+        self.frames = [None] * self.capacity
+        self.start = self.end = 0
+
+    def add(self, lineno, data):
+        """Stores the encoded frame sent as line lineno"""
+        if lineno != self.end:
+            self.start = lineno
+        self.frames[lineno % self.capacity] = data
+        self.end = lineno + 1
+        if self.end - self.start > self.capacity:
+            self.start = self.end - self.capacity
+
+    def get(self, lineno):
+        """Returns the frame sent as line lineno, or None if it is not held"""
+        if not self.start <= lineno < self.end:
+            return None
+        return self.frames[lineno % self.capacity]
+
+    def lines(self, first, end = None):
+        """Returns the frames of the lines from first up to end (the last
+        line sent if None) as a list, or None if any of them is not held"""
+        if end is None:
+            end = self.end
+        if not (self.start <= first and end <= self.end):
+            return None
+        capacity = self.capacity
+        first_slot = first % capacity
+        count = end - first
+        if first_slot + count <= capacity:
+            return self.frames[first_slot:first_slot + count]
+        return (self.frames[first_slot:]
+                + self.frames[:first_slot + count - capacity])
+
+    def fit(self, buffer_depth):
+        """Grows the window to hold enough lines for a firmware with the
+        given number of command buffer slots"""
+        capacity = max(MINIMUM_CAPACITY, SLOTS_PER_BUFFER * buffer_depth)
+        if capacity <= self.capacity:
+            return
+        start = max(self.start, self.end - capacity)
+        held = self.lines(start)
+        self.capacity = capacity
+        self.frames = [None] * capacity
+        self.start = self.end = start
+        for lineno, data in enumerate(held, start):
+            self.frames[lineno % capacity] = data
+        self.end = start + len(held)
@@ -0,0 +1,205 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+# Kinds of responses
+OK = "ok"
+OK_TEMPS = "ok-with-temps"  # ok to M105, with the temperatures
+TEMPERATURE = "temperature"  # temperatures reported without an ok
+RESEND = "resend"
+ERROR = "error"
+BUSY = "busy"
+ECHO = "echo"
+FIRMWARE_INFO = "firmware-info"
+CAPABILITY = "capability"
+GREETING = "greeting"
+DEBUG = "debug"
+OTHER = "other"
+
+# Kinds of lines which are sent over and over and only matter until the next
+# one arrives; recv events for them may be coalesced by an EventDispatcher
+ROUTINE = (OK, OK_TEMPS, TEMPERATURE)
+
+# Lines the firmware sends when it (re)starts
+GREETINGS = ("start", "Grbl ")
+
+# Distinct lines without fields of their own ("ok", "echo:busy: processing",
+# ...) which are kept, so the responses to them can be handed out again
+KNOWN_LINES = 64
+
+# Every part of the line which is looked at is matched by one expression, so
+# the kind of a line and its fields come out of a single match. The order of
+# the alternatives decides which kind a line gets.
+prefix_pattern = (
+    # ok, with the buffer state of Marlin's ADVANCED_OK: "ok N<line> P<planner> B<buffer>"
+    r"(?P<ok>ok)(?:(?: N(?P<ok_lineno>-?\d+))? P(?P<planner>\d+) B(?P<buffer>\d+))?"
+    # "Resend: 12", "RESEND 12" or Teacup's "rs N12 Expected checksum 67"
+    r"|(?P<resend>(?:[Rr]esend|RESEND|rs\b)[\s:N]*(?P<resend_lineno>\d+)?)"
+    r"|(?P<error>Error)|(?P<fatal>!!)"
+    r"|(?P<busy>echo:\s*busy)"
+    r"|(?P<echo>echo:)"
+    # The name ends at a semicolon or at the next "KEY:" of the M115 report
+    r"|(?P<firmware>FIRMWARE_NAME:)(?:\s*(?P<firmware_name>[^;]*?)\s*(?:;|\s[A-Z_]+:|$))?"
+    r"|(?P<capability>Cap:)(?:(?P<capability_name>[^:]*):(?P<enabled>[01]))?"
+    r"|(?P<debug>DEBUG_)"
+    r"|(?P<greeting>%s)"
+)
+# "T:210.0 /210.0", "T1:25.3 /0.0" and "B:60.0 /60.0", but not "B@:127"
+temperature_exp = re.compile(r"(?<![\w@])(T(\d*)|B): ?(-?\d+\.?\d*)\s*/?(-?\d+\.?\d*)?")
+
+_kinds = {
+    "ok": OK,
+    "resend": RESEND,
+    "error": ERROR,
+    "fatal": ERROR,
+    "busy": BUSY,
+    "echo": ECHO,
+    "firmware": FIRMWARE_INFO,
+    "capability": CAPABILITY,
+    "debug": DEBUG,
+    "greeting": GREETING,
+}
+
+class Response(str):
+    """A line received from the firmware, tagged with its kind and the
+    fields of that kind.
+
+    Responses are the lines themselves, so they can be passed on wherever
+    a received line is expected. lineno is the line the firmware asks to be
+    resent, or the line an ADVANCED_OK reply acknowledges. hotends maps
+    extruder numbers to (current, target) temperatures and bed is a
+    (current, target) tuple; targets are None when not reported. Fields
+    which do not apply to the line are None. The same Response may be
+    returned for every time a line is received, so they are not to be
+    changed.
+    """
+
+    kind = OTHER
+    lineno = None
+    planner_free = None
+    buffer_free = None
+    hotends = None
+    bed = None
+    firmware_name = None
+    capability = None
+    enabled = None
+    fatal = False
+
+    def __repr__(self):
+        fields = "".join(", %s=%r" % item for item in sorted(vars(self).items())
+                         if item[0] != "kind")
+        return "<Response %s %s%s>" % (self.kind, str.__repr__(self), fields)
+
+def _response(kind, line):
+    response = str.__new__(Response, line)
+    response.kind = kind
+    return response
+
+class ResponseClassifier:
+    """Tags lines received from the firmware with their kind.
+
+    Lines are classified by what they start with, except for temperature
+    reports, which may come on a line of their own (Marlin's M155
+    autoreport) and are found anywhere in lines which are not otherwise
+    recognised. The responses to plain oks and busy messages, which make up
+    most of what the firmware sends, are looked up instead of matched once
+    they have been seen.
+    """
+
+    def __init__(self, greetings = GREETINGS):
+        self.greetings = tuple(greetings)
+        alternatives = "|".join(re.escape(greeting) for greeting in self.greetings)
+        self.prefix_exp = re.compile(prefix_pattern % (alternatives or "(?!)"))
+        self.known = {}
+
+    def classify(self, line):
+        """Returns the Response for a line received from the firmware"""
+        response = self.known.get(line)
+        if response is not None:
+            return response
+        match = self.prefix_exp.match(line)
+        if match is None:
+            if "T:" in line or "B:" in line:
+                response = _response(TEMPERATURE, line)
+                if _parse_temperatures(response, line):
+                    return response
+            return _response(OTHER, line)
+        group = match.lastgroup
+        # lastgroup is the last group which took part in the match: the
+        # fields of firmware and capability lines come after their prefix
+        if group == "buffer":
+            response = _response(OK, line)
+            ok_lineno, planner, buffer = match.group("ok_lineno", "planner", "buffer")
+            if ok_lineno is not None:
+                response.lineno = int(ok_lineno)
+            response.planner_free = int(planner)
+            response.buffer_free = int(buffer)
+        elif group == "ok":
+            response = _response(OK, line)
+            if "T:" not in line and "B:" not in line:
+                return self._remember(response)
+        elif group == "resend":
+            response = _response(RESEND, line)
+            lineno = match.group("resend_lineno")
+            if lineno is not None:
+                response.lineno = int(lineno)
+            return response
+        elif group == "firmware_name":
+            response = _response(FIRMWARE_INFO, line)
+            response.firmware_name = match.group(group)
+            return response
+        elif group == "enabled":
+            response = _response(CAPABILITY, line)
+            response.capability = match.group("capability_name")
+            response.enabled = match.group(group) == "1"
+            return response
+        elif group == "busy":
+            return self._remember(_response(BUSY, line))
+        else:
+            response = _response(_kinds[group], line)
+            if group == "fatal":
+                response.fatal = True
+            return response
+        if ("T:" in line or "B:" in line) and _parse_temperatures(response, line):
+            response.kind = OK_TEMPS
+        return response
+
+    def _remember(self, response):
+        if len(self.known) < KNOWN_LINES:
+            self.known[str(response)] = response
+        return response
+
+def _parse_temperatures(response, line):
+    """Stores the temperatures reported in line in the response, returns
+    whether there were any. The first report of every heater is kept."""
+    hotends = {}
+    bed = None
+    for name, extruder, current, target in temperature_exp.findall(line):
+        target = float(target) if target else None
+        if name == "B":
+            if bed is None:
+                bed = (float(current), target)
+        else:
+            extruder = int(extruder) if extruder else 0
+            if extruder not in hotends:
+                hotends[extruder] = (float(current), target)
+    if not hotends and bed is None:
+        return False
+    response.hotends = hotends
+    response.bed = bed
+    return True
+
+classify = ResponseClassifier().classify
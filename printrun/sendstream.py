@@ -0,0 +1,187 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from functools import reduce
+from operator import xor
+
+from printrun import gcoder
+
+# Line flags
+HOST_COMMAND = 1  # ;@ command to be handled by the host
+EMPTY = 2  # nothing left to send after stripping comments
+UNENCODABLE = 4  # not plain ASCII, left to the regular send path
+
+def checksum(data):
+    """XOR checksum of an encoded command, as expected after the '*'"""
+    return reduce(xor, data, 0)
+
+def strip_command(raw):
+    """Strips comments and whitespace from a raw G-code line"""
+    if ";" in raw or "(" in raw:
+        raw = gcoder.gcode_strip_comment_exp.sub("", raw)
+    return raw.strip()
+
+class SendStream:
+    """Precompiled form of a print job, built while the job is printed.
+
+    For every line of the job (by queue index) this holds the line as it
+    goes over the wire: stripped, encoded and, unless the stream is built
+    for a connection without checksums, prefixed with the line number it
+    is expected to be sent with and suffixed with its checksum. The print
+    loop only has to index into it and write. When the actual line number
+    differs from the planned one (after a pause with host commands, or
+    commands appended to the job), the frame is renumbered from the stored
+    checksum of the bare command.
+
+    Lines are precompiled a chunk at a time, just ahead of the line being
+    sent, and the frames of lines which have been sent are discarded: a
+    line the firmware asks to be resent is taken from the resend window of
+    printcore, not from the stream. So the stream holds a bounded window of
+    the job, from start to len(self), whatever the size of the job. The
+    frames of the window are kept back to back in one buffer, with the
+    offset of every frame in an array, like MappedGCode keeps the lines of
+    a job; lines without a frame take no room.
+    """
+
+    def __init__(self, checksums = True):
+        self.checksums = checksums
+        # Queue index of the first line held
+        self.start = 0
+        # Position in the precompiled job of the first byte of data
+        self.data_start = 0
+        self.data = bytearray()
+        # offsets[i] is where the frame of line start + i starts, counted
+        # like data_start; the last entry is the end of the data
+        self.offsets = array('Q', [0])
+        self.flags = bytearray()
+        self.linenos = array('l')
+        # Checksum of the stripped command alone, without the N prefix
+        self.command_checksums = bytearray()
+        # Line number planned for the next line appended
+        self.planned_lineno = 0
+
+    def __len__(self):
+        """Queue index after the last line precompiled so far"""
+        return self.start + len(self.flags)
+
+    def extend(self, raw_lines, first_lineno = None):
+        """Precompiles raw lines and appends them to the stream"""
+        if first_lineno is None:
+            first_lineno = self.planned_lineno
+        lineno = first_lineno
+        data = self.data
+        data_start = self.data_start
+        offsets = self.offsets
+        flags = self.flags
+        linenos = self.linenos
+        command_checksums = self.command_checksums
+        checksums = self.checksums
+        for raw in raw_lines:
+            if raw.lstrip().startswith(";@"):
+                offsets.append(data_start + len(data))
+                flags.append(HOST_COMMAND)
+                linenos.append(-1)
+                command_checksums.append(0)
+                continue
+            try:
+                command = strip_command(raw).encode('ascii')
+            except UnicodeEncodeError:
+                offsets.append(data_start + len(data))
+                flags.append(UNENCODABLE)
+                linenos.append(lineno)
+                command_checksums.append(0)
+                lineno += 1
+                continue
+            if not command:
+                offsets.append(data_start + len(data))
+                flags.append(EMPTY)
+                linenos.append(-1)
+                command_checksums.append(0)
+                continue
+            command_checksum = checksum(command)
+            if checksums:
+                prefix = b"N%d " % lineno
+                data += b"%s%s*%d\n" % (prefix, command,
+                                        checksum(prefix) ^ command_checksum)
+            else:
+                data += command + b"\n"
+            offsets.append(data_start + len(data))
+            flags.append(0)
+            linenos.append(lineno)
+            command_checksums.append(command_checksum)
+            lineno += 1
+        self.planned_lineno = lineno
+
+    def update(self, gcode, count = None, first_lineno = None):
+        """Precompiles the lines of gcode which are not in the stream yet,
+        as far as gcode has been analysed and up to count lines in total"""
+        start = len(self)
+        end = gcode.ready_count()
+        if count is not None:
+            end = min(end, count)
+        if end <= start:
+            return
+        all_layers = gcode.all_layers
+        self.extend((all_layers[layer][line].raw
+                     for layer, line in zip(gcode.layer_idxs[start:end],
+                                            gcode.line_idxs[start:end])),
+                    first_lineno)
+
+    def discard(self, index):
+        """Drops the frames of the lines before index. When index lies
+        past the lines precompiled so far, the stream continues from
+        index."""
+        if index <= self.start:
+            return
+        # Lines skipped past the end take no planned line numbers; frames
+        # which end up with other ones are renumbered when sent
+        held = min(index, len(self)) - self.start
+        data_end = self.offsets[held]
+        del self.data[:data_end - self.data_start]
+        self.data_start = data_end
+        del self.offsets[:held]
+        del self.flags[:held]
+        del self.linenos[:held]
+        del self.command_checksums[:held]
+        self.start = index
+
+    def line_flags(self, index):
+        """Returns the flags of a line"""
+        return self.flags[index - self.start]
+
+    def stored_frame(self, index):
+        """Returns the frame of a line as it was precompiled"""
+        i = index - self.start
+        data_start = self.data_start
+        return bytes(self.data[self.offsets[i] - data_start:
+                               self.offsets[i + 1] - data_start])
+
+    def command(self, index):
+        """Returns the stripped, encoded command without line number and
+        checksum"""
+        frame = self.stored_frame(index)
+        if not self.checksums:
+            return frame[:-1]
+        return frame[frame.index(b" ") + 1:frame.rindex(b"*")]
+
+    def frame(self, index, lineno):
+        """Returns the encoded line for the given index, numbered with lineno"""
+        if self.checksums and self.linenos[index - self.start] == lineno:
+            return self.stored_frame(index)
+        command = self.command(index)
+        prefix = b"N%d " % lineno
+        return b"%s%s*%d\n" % (prefix, command,
+                               checksum(prefix) ^ self.command_checksums[index - self.start])
@@ -0,0 +1,169 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from array import array
+
+# Resolutions the samples are kept at, as (seconds per sample, samples
+# kept). 0 keeps the samples as they come in: an hour of a 1 Hz report. The
+# others keep the mean of the samples in every interval, for a day and for a
+# week.
+RESOLUTIONS = ((0, 3600), (10, 8640), (60, 10080))
+
+NAN = float("nan")
+
+class _Ring:
+    """Fixed size ring buffer of rows of floats, with a timestamp per row"""
+
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.times = array("d", [NAN]) * capacity
+        self.values = array("d", [NAN]) * (capacity * width)
+        self.count = 0  # rows stored since the ring was created
+
+    def append(self, timestamp, values):
+        slot = self.count % self.capacity
+        self.times[slot] = timestamp
+        start = slot * self.width
+        self.values[start:start + self.width] = values
+        self.count += 1
+
+    def oldest(self):
+        """Returns the time of the oldest row held, None if it is empty"""
+        if not self.count:
+            return None
+        return self.times[self.count % self.capacity if self.count > self.capacity else 0]
+
+    def rows(self, since):
+        """Returns the times of the rows from since onwards and their values
+        as one list per column"""
+        held = min(self.count, self.capacity)
+        first = self.count - held
+        times = self.times
+        capacity = self.capacity
+        # The times only go up, so the first row to return can be bisected
+        low, high = first, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if times[middle % capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        # The rows are contiguous, or wrap around the end of the arrays once
+        segments = [(low % capacity, min(capacity, low % capacity + self.count - low))]
+        if segments[0][1] - segments[0][0] < self.count - low:
+            segments.append((0, self.count % capacity))
+        width = self.width
+        values = self.values
+        row_times = []
+        columns = [[] for column in range(width)]
+        for start, end in segments:
+            row_times.extend(times[start:end])
+            for column in range(width):
+                columns[column].extend(values[start * width + column:end * width:width])
+        return row_times, columns
+
+class _Bucket:
+    """Running means of the rows added in one interval"""
+
+    def __init__(self, width, interval):
+        self.interval = interval
+        self.index = None  # number of the interval since the epoch
+        self.sums = array("d", [0.0]) * width
+        self.counts = array("l", [0]) * width
+
+    def add(self, values):
+        sums = self.sums
+        counts = self.counts
+        for column, value in enumerate(values):
+            if value == value:  # NaN is not reported, so not averaged
+                sums[column] += value
+                counts[column] += 1
+
+    def means(self):
+        means = array("d", (total / count if count else NAN
+                            for total, count in zip(self.sums, self.counts)))
+        for column in range(len(self.sums)):
+            self.sums[column] = 0.0
+            self.counts[column] = 0
+        return means
+
+class TimeSeries:
+    """Compact history of a set of readings, such as the temperatures of a
+    printer, kept at several resolutions.
+
+    Every sample is a timestamp and one float per column; NaN stands for a
+    value which was not reported. Samples are stored in preallocated arrays
+    rather than as objects, so a history takes the same memory no matter
+    how long it has been recording. Samples can be added from one thread
+    while they are read from another.
+    """
+
+    def __init__(self, columns, resolutions = RESOLUTIONS):
+        self.columns = tuple(columns)
+        width = len(self.columns)
+        self.resolutions = tuple(interval for interval, capacity in resolutions)
+        self.rings = [_Ring(width, capacity) for interval, capacity in resolutions]
+        self.buckets = [_Bucket(width, interval) if interval else None
+                        for interval, capacity in resolutions]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Number of samples added"""
+        return self.rings[0].count if self.rings else 0
+
+    def add(self, timestamp, values):
+        """Adds a sample with a value for every column"""
+        if len(values) != len(self.columns):
+            raise ValueError("expected %d values, got %d" % (len(self.columns), len(values)))
+        values = array("d", values)
+        with self.lock:
+            for ring, bucket in zip(self.rings, self.buckets):
+                if bucket is None:
+                    ring.append(timestamp, values)
+                    continue
+                index = int(timestamp // bucket.interval)
+                if index != bucket.index:
+                    if bucket.index is not None:
+                        ring.append(bucket.index * bucket.interval, bucket.means())
+                    bucket.index = index
+                bucket.add(values)
+
+    def samples(self, since = None, resolution = None):
+        """Returns (times, columns) for the samples from since onwards: the
+        times as a list and the values as a list per column. Unless a
+        resolution (seconds per sample) is asked for, the finest one which
+        still holds samples from since is used. Samples which are still
+        being averaged are not returned."""
+        with self.lock:
+            if resolution is not None:
+                ring = self.rings[self.resolutions.index(resolution)]
+            else:
+                ring = self.rings[-1]
+                for candidate in self.rings:
+                    # A ring which has not filled up yet holds every sample
+                    if candidate.count <= candidate.capacity \
+                       or (since is not None and candidate.oldest() <= since):
+                        ring = candidate
+                        break
+            return ring.rows(since if since is not None else float("-inf"))
+
+    def clear(self):
+        with self.lock:
+            width = len(self.columns)
+            self.rings = [_Ring(width, ring.capacity) for ring in self.rings]
+            self.buckets = [_Bucket(width, bucket.interval) if bucket else None
+                            for bucket in self.buckets]
@@ -0,0 +1,630 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from functools import reduce
+
+from .asyncprintcore import EventLoopThread
+
+# Temperature the heaters cool down to when they are off
+AMBIENT = 20.0
+# How often blocking commands check whether they are done, in seconds
+TICK = 0.02
+
+lineno_exp = re.compile(r"^N(-?\d+)\s*")
+param_exp = re.compile(r"([A-Z])(-?[\d.]+)")
+
+MOVES = ("G0", "G1", "G2", "G3", "G5")
+
+def checksum(command):
+    return reduce(lambda x, y: x ^ y, map(ord, command), 0)
+
+def params(command):
+    """Returns the numeric parameters of command by their letter"""
+    result = {}
+    for letter, value in param_exp.findall(command.partition(" ")[2]):
+        try:
+            result[letter] = float(value)
+        except ValueError:
+            pass
+    return result
+
+class VirtualPrinter:
+    """Stand-in for Marlin-like firmware, to try out and benchmark printcore
+    and the plugin without a printer.
+
+    Bytes coming in go into a receive buffer of rx_size bytes, like the
+    serial buffer of the firmware; what does not fit is dropped and counted
+    in overflowed. Lines are taken from it into a command buffer of bufsize
+    commands as long as that has room. Line numbers and checksums are
+    checked like Marlin does, answering Error: and Resend: and flushing the
+    receive buffer on a bad line.
+
+    Commands are answered with ok as they are taken from the command
+    buffer, with the number of the line acknowledged and the free planner
+    and command buffer space added when advanced_ok is set. Moves go into a planner of
+    planner_size moves, which carries out one move every move_time seconds;
+    while it is full, the command buffer waits. G4, G28, M400, M109 and M190
+    block until they are done, sending busy: processing every
+    busy_interval seconds meanwhile. Heaters change heat_rate degrees per
+    second. M105, M115 and M155 are answered as by Marlin; the capabilities
+    reported by M115 can be changed in the capabilities dict.
+
+    Faults are injected with the probabilities drop_ok, for an ok that is
+    never sent, and corrupt, for a byte of a line with a checksum that gets
+    flipped on its way in. disconnect_after closes the connection once that
+    many commands have been accepted. With the same seed, the same lines
+    get the same faults.
+
+    The printer is served on a pseudo terminal with serve_pty(), or over TCP
+    with serve_tcp(). Every byte is delayed by half of latency plus a random
+    part of jitter in each direction, so latency is the round trip time of
+    the link; bytes are never reordered. With a baudrate, bytes also take
+    the time they would take on a serial line, ten bits per byte, and a line
+    only arrives once all of it has been sent. The printer runs on an event
+    loop thread of its own.
+    """
+
+    def __init__(self, bufsize = 4, rx_size = 128, planner_size = 16,
+                 move_time = 0.0, advanced_ok = False, heat_rate = 50.0,
+                 busy_interval = 2.0, latency = 0.0, jitter = 0.0,
+                 baudrate = None, greeting = "start", drop_ok = 0.0,
+                 corrupt = 0.0, disconnect_after = None, seed = None):
+        self.bufsize = bufsize
+        self.rx_size = rx_size
+        self.planner_size = planner_size
+        self.move_time = move_time
+        self.advanced_ok = advanced_ok
+        self.heat_rate = heat_rate
+        self.busy_interval = busy_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.baudrate = baudrate
+        self.greeting = greeting
+        self.drop_ok = drop_ok
+        self.corrupt = corrupt
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        # Faults are drawn apart from the link delays, so they do not
+        # depend on how the bytes happened to arrive
+        self.fault_random = random.Random(seed)
+        self.capabilities = {"EEPROM": 0, "AUTOREPORT_TEMP": 1, "ARCS": 1,
+                             "ADVANCED_OK": int(advanced_ok)}
+        self.log = logging.getLogger(__name__)
+
+        self.loop_thread = None
+        self.server = None
+        self.pty_slave = None  # kept open while serving on a pty
+        self.transport = None
+        self.incoming = None
+        self.outgoing = None
+        self.rx = bytearray()
+        self.queue = deque()  # commands and the line numbers they came in as
+        self.planned = 0  # moves in the planner
+        self.waiting = None  # returns True once the blocking command is done
+        self.busy_at = 0  # loop time the next busy: processing is due at
+        self.tick = None  # timer handle of the next check of waiting
+        self.last_lineno = 0
+        # [current, target] of the hotend and of the bed
+        self.heaters = {"T": [AMBIENT, 0.0], "B": [AMBIENT, 0.0]}
+        self.heated_at = None  # loop time the heaters were last updated
+        self.autoreport = None  # timer handle of M155
+
+        self.lines = 0  # commands accepted
+        self.rejected = 0  # lines answered with a resend request
+        self.overflowed = 0  # bytes dropped by a full receive buffer
+        self.max_rx = 0  # most bytes ever waiting in the receive buffer
+        self.busy = 0  # busy: processing messages sent
+        self.dropped_oks = 0
+        self.corrupted = 0  # lines with a byte flipped
+        self.disconnects = 0  # connections closed by disconnect_after
+
+    def stats(self):
+        return {"lines": self.lines, "rejected": self.rejected,
+                "overflowed": self.overflowed, "max_rx": self.max_rx,
+                "busy": self.busy, "dropped_oks": self.dropped_oks,
+                "corrupted": self.corrupted, "disconnects": self.disconnects}
+
+    # Serving
+
+    def _start_loop(self):
+        if self.loop_thread is None:
+            self.loop_thread = EventLoopThread(name = "virtual printer")
+        return self.loop_thread.loop
+
+    def serve_pty(self):
+        """Creates a pseudo terminal to talk to the printer through, and
+        returns the path of the device to open as its serial port. Linux
+        and other Unix systems only. The printer sends its greeting right
+        away. The baud rate the port is opened with and DTR resets are
+        ignored; the link is paced by baudrate instead."""
+        import tty
+        loop = self._start_loop()
+        master, slave = os.openpty()
+        # No echo or line editing, as on a real serial port. The slave end
+        # is kept open, so the master does not fail while no one has it
+        # open.
+        tty.setraw(slave)
+        self.pty_slave = slave
+        path = os.ttyname(slave)
+        self.loop_thread.call(self._connected,
+                              _PtyTransport(self, loop, master))
+        return path
+
+    def serve_tcp(self, host = "127.0.0.1", port = 0):
+        """Starts accepting a connection on host:port, on a port picked by
+        the system when port is 0. Returns the address listened on. Every
+        new connection replaces the one before, like a network bridge in
+        front of a serial port; the firmware itself keeps its state."""
+        loop = self._start_loop()
+        self.server = asyncio.run_coroutine_threadsafe(loop.create_server(
+            lambda: _LinkProtocol(self), host, port), loop).result()
+        return self.server.sockets[0].getsockname()[:2]
+
+    def stop(self):
+        """Stops serving and closes the connection, if any"""
+        if self.loop_thread is None:
+            return
+        self.loop_thread.call(self._stop)
+        self.loop_thread.loop.call_soon_threadsafe(self.loop_thread.loop.stop)
+        self.loop_thread.thread.join()
+        self.loop_thread.loop.close()
+        self.loop_thread = None
+
+    def _stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        self._stop_transport()
+        if self.pty_slave is not None:
+            os.close(self.pty_slave)
+            self.pty_slave = None
+        for handle in (self.tick, self.autoreport):
+            if handle is not None:
+                handle.cancel()
+        self.tick = self.autoreport = None
+
+    def drop_connection(self):
+        """Closes the connection, as when the network goes away or the
+        printer is unplugged. A pseudo terminal goes away for good."""
+        if self.loop_thread is not None:
+            self.loop_thread.call(self._stop_transport)
+
+    def _stop_transport(self):
+        if self.transport is not None:
+            self.transport.abort()
+            self.transport = None
+
+    # The link
+
+    def _connected(self, transport):
+        if self.transport is not None:
+            self.transport.abort()
+        self.transport = transport
+        # Whatever was still underway belonged to the old connection
+        self.incoming = _DelayLine(self)
+        self.outgoing = _DelayLine(self)
+        if self.greeting:
+            self._output(self.greeting)
+
+    def _disconnected(self, transport):
+        if transport is self.transport:
+            self.transport = None
+
+    def _data_received(self, transport, data):
+        if transport is not self.transport:
+            return
+        if self.baudrate:
+            # Line by line, so every line arrives once it has been sent
+            start = 0
+            while start < len(data):
+                end = data.find(b"\n", start) + 1 or len(data)
+                self.incoming.send(self._receive, transport, data[start:end])
+                start = end
+        else:
+            self.incoming.send(self._receive, transport, data)
+
+    def _receive(self, transport, data):
+        if transport is self.transport:
+            self.receive(data)
+
+    def _output(self, line):
+        if self.transport is not None:
+            self.outgoing.send(self._write, self.transport,
+                               (line + "\n").encode())
+
+    def _write(self, transport, data):
+        if transport is self.transport and not transport.is_closing():
+            transport.write(data)
+
+    # The firmware
+
+    def receive(self, data):
+        """Takes bytes that came in over the link"""
+        free = self.rx_size - len(self.rx)
+        if len(data) > free:
+            self.overflowed += len(data) - free
+            data = data[:free]
+        self.rx += data
+        self.max_rx = max(self.max_rx, len(self.rx))
+        self._process()
+
+    def _take_lines(self):
+        while len(self.queue) < self.bufsize:
+            end = self.rx.find(b"\n")
+            if end < 0:
+                break
+            line = self.rx[:end].decode("ascii", "replace").strip()
+            del self.rx[:end + 1]
+            if self.corrupt and "*" in line \
+               and self.fault_random.random() < self.corrupt:
+                self.corrupted += 1
+                index = self.fault_random.randrange(len(line))
+                line = line[:index] + chr(ord(line[index]) ^ 0x04) + \
+                    line[index + 1:]
+            command = self._check(line)
+            if command:
+                # Marlin acknowledges a command with the number of the
+                # last numbered line received up to it
+                self.queue.append((command, self.last_lineno))
+                self.lines += 1
+                if self.lines == self.disconnect_after:
+                    self.disconnects += 1
+                    self.loop_thread.loop.call_soon(self._stop_transport)
+
+    def _check(self, line):
+        """Checks the line number and checksum of line like Marlin does.
+        Returns the command, or None when there is none or it is rejected."""
+        match = lineno_exp.match(line)
+        if not match:
+            command = line.split(";")[0].strip()
+            if command.startswith("M110"):
+                self.last_lineno = int(params(command).get("N", 0))
+            return command
+        lineno = int(match.group(1))
+        if "*" not in line:
+            return self._resend("No Checksum with line number")
+        command, _, received = line.rpartition("*")
+        if not received.strip().isdigit() or \
+           checksum(command) != int(received):
+            return self._resend("checksum mismatch")
+        command = command[match.end():].split(";")[0].strip()
+        if command.startswith("M110"):
+            self.last_lineno = int(params(command).get("N", lineno))
+        elif lineno != self.last_lineno + 1:
+            return self._resend("Line Number is not Last Line Number+1")
+        else:
+            self.last_lineno = lineno
+        return command
+
+    def _resend(self, error):
+        self.rejected += 1
+        # Marlin throws away whatever is waiting and asks for the line again
+        del self.rx[:]
+        self._output("Error:%s, Last Line: %d" % (error, self.last_lineno))
+        self._output("Resend: %d" % (self.last_lineno + 1))
+        self._output("ok")
+        return None
+
+    def _process(self):
+        """Carries out the commands in the command buffer for as long as
+        none of them has to wait"""
+        loop = self.loop_thread.loop
+        while True:
+            self._take_lines()
+            if not self.queue:
+                return
+            if self.waiting is not None:
+                if not self.waiting():
+                    if loop.time() >= self.busy_at:
+                        self.busy += 1
+                        self._output("echo:busy: processing")
+                        self.busy_at = loop.time() + self.busy_interval
+                    if self.tick is None:
+                        self.tick = loop.call_later(TICK, self._on_tick)
+                    return
+                self.waiting = None
+                self._ok(*self.queue.popleft())
+                continue
+            command = self.queue[0][0]
+            code = command.split(" ", 1)[0]
+            if code in MOVES:
+                if self.move_time:
+                    if self.planned >= self.planner_size:
+                        # _move_done() goes on once there is room
+                        return
+                    self.planned += 1
+                    if self.planned == 1:
+                        loop.call_later(self.move_time, self._move_done)
+            else:
+                self.waiting = self._execute(code, command)
+                if self.waiting is not None:
+                    self.busy_at = loop.time() + self.busy_interval
+                    continue
+            self._ok(*self.queue.popleft())
+
+    def _on_tick(self):
+        self.tick = None
+        self._process()
+
+    def _move_done(self):
+        self.planned -= 1
+        if self.planned:
+            self.loop_thread.loop.call_later(self.move_time, self._move_done)
+        self._process()
+
+    def _execute(self, code, command):
+        """Carries out a command other than a move. Returns a function that
+        returns whether it is done when it blocks, None otherwise."""
+        loop = self.loop_thread.loop
+        values = params(command)
+        if code in ("M104", "M109", "M140", "M190") and "S" in values:
+            self._update_heaters()
+            heater = self.heaters["B" if code in ("M140", "M190") else "T"]
+            heater[1] = values["S"]
+        if code == "M109" or code == "M190":
+            heater = self.heaters["B" if code == "M190" else "T"]
+
+            def heated():
+                self._update_heaters()
+                return heater[1] <= AMBIENT or abs(heater[0] - heater[1]) < 1
+            return heated
+        if code == "G4":
+            seconds = values.get("S", values.get("P", 0) / 1000)
+            end = []
+
+            def dwelled():
+                # The dwell starts once the moves before it are done
+                if self.planned:
+                    return False
+                if not end:
+                    end.append(loop.time() + seconds)
+                return loop.time() >= end[0]
+            return dwelled
+        if code == "G28" or code == "M400":
+            return lambda: not self.planned
+        if code == "M155":
+            if self.autoreport is not None:
+                self.autoreport.cancel()
+                self.autoreport = None
+            if values.get("S", 0) > 0:
+                self._autoreport(values["S"])
+        return None
+
+    def _ok(self, command, lineno):
+        """Answers a command that has been carried out, which came in as line
+        lineno"""
+        code = command.split(" ", 1)[0]
+        if code == "M115":
+            self._output("FIRMWARE_NAME:Marlin virtual SOURCE_CODE_URL:"
+                         "https://github.com/MarlinFirmware/Marlin "
+                         "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Virtual "
+                         "EXTRUDER_COUNT:1")
+            for name, value in sorted(self.capabilities.items()):
+                self._output("Cap:%s:%d" % (name, value))
+        ok = "ok"
+        if code == "M105":
+            ok += " " + self._temperatures()
+        if self.advanced_ok:
+            ok += " N%d P%d B%d" % (lineno,
+                                   self.planner_size - self.planned,
+                                   self.bufsize - len(self.queue))
+        if self.drop_ok and self.fault_random.random() < self.drop_ok:
+            self.dropped_oks += 1
+            return
+        self._output(ok)
+
+    def _update_heaters(self):
+        now = self.loop_thread.loop.time()
+        if self.heated_at is not None:
+            change = (now - self.heated_at) * self.heat_rate
+            for heater in self.heaters.values():
+                goal = max(heater[1], AMBIENT)
+                if heater[0] < goal:
+                    heater[0] = min(goal, heater[0] + change)
+                else:
+                    heater[0] = max(goal, heater[0] - change)
+        self.heated_at = now
+
+    def _temperatures(self):
+        self._update_heaters()
+        hotend, bed = self.heaters["T"], self.heaters["B"]
+        return "T:%.2f /%.2f B:%.2f /%.2f @:0 B@:0" % \
+            (hotend[0], hotend[1], bed[0], bed[1])
+
+    def _autoreport(self, interval):
+        self._output(self._temperatures())
+        self.autoreport = self.loop_thread.loop.call_later(
+            interval, self._autoreport, interval)
+
+class _DelayLine:
+    """One direction of the link, which delivers what is sent through it
+    after the delay of the printer, in the order it was sent"""
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.loop = printer.loop_thread.loop
+        self.underway = deque()  # (arrival time, function, args)
+        self.arrival = 0  # arrival time of the last thing sent
+
+    def send(self, function, *args):
+        printer = self.printer
+        if not printer.latency and not printer.jitter and not printer.baudrate:
+            function(*args)
+            return
+        delay = printer.latency / 2 + printer.random.uniform(0, printer.jitter)
+        self.arrival = max(self.arrival, self.loop.time() + delay)
+        if printer.baudrate:
+            # The bytes (the last argument) follow those sent before
+            self.arrival += len(args[-1]) * 10 / printer.baudrate
+        self.underway.append((self.arrival, function, args))
+        if len(self.underway) == 1:
+            self.loop.call_at(self.arrival, self._deliver)
+
+    def _deliver(self):
+        # Timers due at the same time may run in any order, so one timer at
+        # a time delivers everything that has arrived
+        now = self.loop.time()
+        while self.underway and self.underway[0][0] <= now:
+            arrival, function, args = self.underway.popleft()
+            function(*args)
+        if self.underway:
+            self.loop.call_at(self.underway[0][0], self._deliver)
+
+class _LinkProtocol(asyncio.Protocol):
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.printer._connected(transport)
+
+    def data_received(self, data):
+        self.printer._data_received(self.transport, data)
+
+    def connection_lost(self, exc):
+        self.printer._disconnected(self.transport)
+
+class _PtyTransport:
+    """The master end of a pseudo terminal, with the parts of the asyncio
+    transport interface the printer uses"""
+
+    def __init__(self, printer, loop, fd):
+        self.printer = printer
+        self.loop = loop
+        self.fd = fd
+        self.buffer = bytearray()
+        self.closing = False
+        os.set_blocking(fd, False)
+        loop.add_reader(fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.abort()
+            return
+        if data:
+            self.printer._data_received(self, data)
+
+    def write(self, data):
+        if self.closing:
+            return
+        if not self.buffer:
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                pass
+            if not data:
+                return
+            self.loop.add_writer(self.fd, self._on_writable)
+        self.buffer += data
+
+    def _on_writable(self):
+        try:
+            del self.buffer[:os.write(self.fd, self.buffer)]
+        except BlockingIOError:
+            return
+        if not self.buffer:
+            self.loop.remove_writer(self.fd)
+
+    def is_closing(self):
+        return self.closing
+
+    def abort(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.fd)
+        if self.buffer:
+            self.loop.remove_writer(self.fd)
+        os.close(self.fd)
+        self.printer._disconnected(self)
+
+    close = abort
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "Serves a simulated printer on a pseudo terminal or "
+                      "over TCP")
+    parser.add_argument("--pty", action = "store_true",
+                        help = "serve on a pseudo terminal instead of TCP")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8023)
+    parser.add_argument("--latency", type = float, default = 0,
+                        help = "round trip time of the link, in ms")
+    parser.add_argument("--jitter", type = float, default = 0,
+                        help = "most random extra delay each way, in ms")
+    parser.add_argument("--baud", type = int, default = None,
+                        help = "send bytes no faster than at this baud rate")
+    parser.add_argument("--bufsize", type = int, default = 4,
+                        help = "commands held by the command buffer")
+    parser.add_argument("--rx-size", type = int, default = 128,
+                        help = "bytes held by the receive buffer")
+    parser.add_argument("--planner-size", type = int, default = 16,
+                        help = "moves held by the planner")
+    parser.add_argument("--move-time", type = float, default = 0,
+                        help = "time every move takes, in ms")
+    parser.add_argument("--advanced-ok", action = "store_true",
+                        help = "report the free buffer space in every ok")
+    parser.add_argument("--drop-ok", type = float, default = 0,
+                        help = "probability of an ok getting lost")
+    parser.add_argument("--corrupt", type = float, default = 0,
+                        help = "probability of a line getting corrupted")
+    parser.add_argument("--disconnect-after", type = int, default = None,
+                        help = "close the connection after this many "
+                               "commands")
+    parser.add_argument("--seed", type = int, default = None,
+                        help = "seed of the random delays and faults")
+    args = parser.parse_args()
+
+    printer = VirtualPrinter(bufsize = args.bufsize, rx_size = args.rx_size,
+                             planner_size = args.planner_size,
+                             move_time = args.move_time / 1000,
+                             advanced_ok = args.advanced_ok,
+                             latency = args.latency / 1000,
+                             jitter = args.jitter / 1000,
+                             baudrate = args.baud,
+                             drop_ok = args.drop_ok, corrupt = args.corrupt,
+                             disconnect_after = args.disconnect_after,
+                             seed = args.seed)
+    if args.pty:
+        print("Serving a virtual printer on %s" % printer.serve_pty(),
+              flush = True)
+    else:
+        host, port = printer.serve_tcp(args.host, args.port)
+        print("Serving a virtual printer on %s:%d" % (host, port),
+              flush = True)
+    try:
+        while True:
+            time.sleep(10)
+            print(printer.stats())
+    except KeyboardInterrupt:
+        pass
+    printer.stop()
+
+if __name__ == '__main__':
+    main()
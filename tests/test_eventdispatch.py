@@ -0,0 +1,44 @@
+import threading
+
+from printrun.eventdispatch import BLOCK, EventDispatcher
+
+def test_a_handler_posting_to_its_full_dispatcher_does_not_block():
+    events = EventDispatcher(maxsize = 4, overflow = BLOCK)
+    delivered = []
+
+    def handler():
+        # As a handler calling something which raises events
+        for i in range(20):
+            events.post("temp", delivered.append, (i,))
+    events.post("temp", handler)
+    try:
+        assert events.flush(5)
+        assert events.flush(5)
+        assert delivered[-1] == 19
+        assert events.stats()["blocked"] == 0
+    finally:
+        events.stop(5)
+
+def test_a_handler_waiting_for_a_blocked_poster_does_not_deadlock():
+    events = EventDispatcher(maxsize = 4, overflow = BLOCK, block_timeout = 0.2)
+    delivered = []
+
+    def post_many():
+        for i in range(20):
+            events.post("temp", delivered.append, (i,))
+
+    poster = threading.Thread(target = post_many)
+
+    def handler():
+        # As disconnect() joining the read thread, which posts events
+        poster.start()
+        poster.join()
+    events.post("end", handler)
+    try:
+        assert events.flush(10)
+        assert not poster.is_alive()
+        assert events.flush(5)
+        assert delivered[-1] == 19
+        assert events.stats()["blocked"] > 0
+    finally:
+        events.stop(5)
@@ -0,0 +1,99 @@
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from printrun import gcoder_vec
+from printrun.gcodefile import MappedGCode
+from printrun.motionplanner import MachineLimits
+from printrun.sendstream import checksum
+
+class PythonGCode(MappedGCode):
+    vectorized = False
+
+def number(rand, low, high):
+    """A coordinate in one of the formats slicers and people write"""
+    value = rand.uniform(low, high)
+    return rand.choice(("%.3f", "%.5f", "%d", "%.1f", "%g", "%.0f.",
+                        "%.17f")) % value
+
+def fuzzed_gcode(seed, count = 3000):
+    """Random G-code with every kind of line the engines treat apart"""
+    rand = random.Random(seed)
+    lines = []
+    z = 0.0
+    e = 0.0
+    for i in range(count):
+        roll = rand.random()
+        if roll < 0.55:
+            e += rand.uniform(0, 0.5)
+            line = "G1 X%s Y%s E%.5f" % (number(rand, -5, 205),
+                                         number(rand, -5, 205), e)
+            if rand.random() < 0.2:
+                line += " F%d" % rand.choice((600, 1800, 3000, 9000))
+        elif roll < 0.65:
+            line = "G0 X%s Y%s" % (number(rand, 0, 200), number(rand, 0, 200))
+        elif roll < 0.68:
+            z += rand.choice((0.1, 0.2, 0.3, -0.2))
+            line = "G1 Z%.2f F600" % z
+        elif roll < 0.70:
+            line = "G%d X%s Y%s I%s J%s E%.4f" % (
+                rand.choice((2, 3)), number(rand, 0, 200),
+                number(rand, 0, 200), number(rand, -10, 10),
+                number(rand, -10, 10), e)
+        elif roll < 0.72:
+            line = rand.choice(("G4 P%d", "G4 S%d")) % rand.randint(0, 500)
+        elif roll < 0.74:
+            line = rand.choice(("G90", "G91", "M82", "M83", "G20", "G21"))
+        elif roll < 0.76:
+            line = rand.choice(("G92 E0", "G92 X10 Y10", "G92 Z%.1f" % z,
+                                "G28", "G28 X", "G28 X0 Y0"))
+        elif roll < 0.78:
+            line = "T%d" % rand.randint(0, 2)
+        elif roll < 0.82:
+            line = rand.choice(("; comment", "", "G1 X5 ; move",
+                                "(paren comment) G1 Y5", "M104 S200",
+                                "M106 S255", ";LAYER:%d" % i))
+        elif roll < 0.84:
+            command = "G1 X%s Y%s" % (number(rand, 0, 200),
+                                      number(rand, 0, 200))
+            line = "N%d %s" % (i, command)
+            line += "*%d" % checksum(line.encode("ascii"))
+        elif roll < 0.85:
+            line = "G1 X%s ; départ" % number(rand, 0, 200)
+        else:
+            e += rand.uniform(0, 0.2)
+            line = "G1 X%s E%.5f" % (number(rand, 0, 200), e)
+        lines.append(line)
+    newline = "\r\n" if seed % 3 == 0 else "\n"
+    return (newline.join(lines) + newline).encode("utf-8")
+
+def analysis(cls, data, motion_limits):
+    """Everything an engine produces for data, or the error it raised"""
+    try:
+        gcode = cls(data, motion_limits = motion_limits)
+    except Exception as e:
+        return ("error", type(e), str(e))
+    result = {name: getattr(gcode, name)
+              for name in ("xmin", "xmax", "ymin", "ymax", "zmin", "zmax",
+                           "filament_length", "filament_length_multi",
+                           "duration", "layers_count", "all_zs",
+                           "checkpoints")}
+    result["layers"] = [(layer.start, layer.count, layer.z, layer.duration)
+                        for layer in gcode.all_layers[:gcode.append_layer_id]]
+    result["layer_idxs"] = list(gcode.layer_idxs)
+    result["line_idxs"] = list(gcode.line_idxs)
+    result["state"] = gcode._checkpoint()
+    return result
+
+@pytest.mark.parametrize("chunk_size", [gcoder_vec.CHUNK_SIZE, 997])
+@pytest.mark.parametrize("motion_limits", [None, MachineLimits()],
+                         ids = ["constant", "planned"])
+@pytest.mark.parametrize("seed", range(12))
+def test_vectorized_analysis_matches_gcoder(monkeypatch, seed, motion_limits,
+                                            chunk_size):
+    data = fuzzed_gcode(seed)
+    expected = analysis(PythonGCode, data, motion_limits)
+    monkeypatch.setattr(gcoder_vec, "CHUNK_SIZE", chunk_size)
+    assert analysis(MappedGCode, data, motion_limits) == expected
@@ -0,0 +1,47 @@
+import os
+from array import array
+
+from printrun import jobcache
+from printrun.gcodefile import MappedGCode
+from printrun.jobcache import JobCache
+
+def job(count):
+    lines = ["G1 X%d Y%d E%.3f ; move %d" % (i % 200, i % 7, i * 0.01, i)
+             for i in range(count)]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+def entry_size(cache, key):
+    return os.path.getsize(cache._path(key))
+
+def test_a_stored_job_is_loaded_again(tmp_path):
+    cache = JobCache(str(tmp_path))
+    data = job(500)
+    gcode = MappedGCode(data)
+    cache.store_gcode("job", gcode).join()
+    assert entry_size(cache, "job") > jobcache.estimate_size(gcode)
+    loaded = cache.load_gcode("job", data)
+    assert len(loaded) == 500
+    assert loaded.all_layers[0][42].raw == gcode.all_layers[0][42].raw
+    assert loaded.duration == gcode.duration
+
+def test_a_job_too_large_for_the_cache_is_not_stored(tmp_path, monkeypatch):
+    def get_index():
+        raise AssertionError("no index is copied for a job which does not fit")
+    gcode = MappedGCode(job(2000))
+    monkeypatch.setattr(gcode, "get_index", get_index)
+    cache = JobCache(str(tmp_path), max_size = 10000)
+    cache.store_gcode("large", gcode).join()
+    assert cache.size() == 0
+    assert cache.load_gcode("large", job(2000)) is None
+
+def test_eviction_keeps_the_newest_entry(tmp_path):
+    cache = JobCache(str(tmp_path), max_size = 1000)
+    cache.put("old", {}, [("data", bytearray(400))])
+    os.utime(cache._path("old"), (0, 0))
+    cache.put("older", {}, [("data", bytearray(400))])
+    os.utime(cache._path("older"), (0, 0))
+    # Larger than the cache on its own
+    cache.put("new", {}, [("data", array('Q', range(200)))])
+    assert cache.get("old") is None and cache.get("older") is None
+    header, arrays = cache.get("new")
+    assert list(arrays["data"]) == list(range(200))
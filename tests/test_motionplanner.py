@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from printrun import motionplanner
+from printrun.motionplanner import MachineLimits, Planner
+
+def random_rows(count, seed = 0):
+    rand = random.Random(seed)
+    rows = []
+    x = y = z = e = 0.0
+    for line in range(count):
+        if rand.random() < 0.05:
+            rows.append((line, x, y, z, e, 0.0, 1.0, rand.choice((0.0, 0.5))))
+            continue
+        x += rand.uniform(-50, 50)
+        y += rand.uniform(-50, 50)
+        if rand.random() < 0.02:
+            z += 0.2
+        e += rand.choice((0.0, rand.uniform(0, 5), -1e5))
+        rows.append((line, x, y, z, e, rand.choice((20.0, 60.0, 150.0)),
+                     0.0, 0.0))
+    return numpy.array(rows)
+
+def plan(rows, splits):
+    planner = Planner(MachineLimits())
+    durations = {}
+    for start, end in zip([0] + splits, splits + [len(rows)]):
+        block = rows[start:end]
+        lines, planned = planner.add(block[:, 0], *block[:, 1:6].T,
+                                     stop = block[:, 6] != 0,
+                                     dwell = block[:, 7])
+        durations.update(zip(lines.tolist(), planned.tolist()))
+    lines, planned = planner.finish()
+    durations.update(zip(lines.tolist(), planned.tolist()))
+    return durations
+
+def test_durations_do_not_depend_on_how_rows_are_added(monkeypatch):
+    monkeypatch.setattr(motionplanner, "BATCH_SIZE", 64)
+    rows = random_rows(1000)
+    expected = plan(rows, [])
+    rand = random.Random(1)
+    for i in range(5):
+        splits = sorted(rand.sample(range(1, len(rows)), rand.randint(1, 40)))
+        assert plan(rows, splits) == expected
@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+import time
+import tty
+
+import pytest
+
+from printrun import asyncprintcore as asyncprintcore_module, gcoder
+from printrun.asyncprintcore import asyncprintcore
+from printrun.printcore import printcore
+from printrun.responses import ResponseClassifier
+
+classify = ResponseClassifier().classify
+
+def window_core(lines):
+    core = printcore()
+    for lineno in lines:
+        core._track(b"N%d G1 X1*0\n" % lineno, lineno)
+    return core
+
+def inflight(core):
+    return [entry[0] for entry in core.inflight]
+
+def test_advanced_ok_retires_up_to_its_line():
+    core = window_core([1, 2, 3, 4])
+    core._acknowledge(classify("ok N2 P15 B3"))
+    assert inflight(core) == [3, 4]
+    assert core.inflight_bytes == sum(entry[1] for entry in core.inflight)
+
+def test_advanced_ok_for_a_line_not_in_flight_retires_nothing():
+    core = window_core([5, 6, 7])
+    core._acknowledge(classify("ok N4 P15 B3"))
+    assert inflight(core) == [5, 6, 7]
+    core._acknowledge(classify("ok N5 P15 B3"))
+    core._acknowledge(classify("ok N5 P15 B3"))
+    assert inflight(core) == [6, 7]
+
+def test_plain_ok_retires_the_oldest_line():
+    core = window_core([1, 2])
+    core._acknowledge(classify("ok"))
+    assert inflight(core) == [2]
+    core._acknowledge(classify("ok"))
+    core._acknowledge(classify("ok"))
+    assert inflight(core) == [] and core.inflight_bytes == 0
+
+def test_window_counts_the_bytes_in_flight():
+    core = window_core([1, 2])
+    core._acknowledge(classify("ok N0 P15 B8"))
+    core.rx_buffer_size = 2 * len(b"N1 G1 X1*0\n") + 4
+    assert core._window_open(4)
+    assert not core._window_open(5)
+
+class RubbishFirst:
+    """Printer on a pseudo terminal which answers the first command it gets
+    with an undecodable line, as at a baudrate which has not settled yet,
+    and every command after that with ok. With together, the ok of the
+    first command follows the rubbish right away."""
+
+    def __init__(self, together):
+        self.together = together
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.thread = threading.Thread(target = self._serve, daemon = True)
+        self.thread.start()
+
+    def _serve(self):
+        buffer = b""
+        answered = 0
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if not answered:
+                    reply = b"\xff\xfe\x80garbage\n"
+                    if self.together:
+                        reply += b"ok\n"
+                else:
+                    reply = b"ok\n"
+                answered += 1
+                os.write(self.master, reply)
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason = "needs a pseudo terminal")
+@pytest.mark.parametrize("engine", [printcore, asyncprintcore])
+@pytest.mark.parametrize("together", [True, False],
+                         ids = ["rubbish-then-ok", "rubbish-alone"])
+def test_rubbish_while_going_online_is_skipped(monkeypatch, engine, together):
+    monkeypatch.setattr(asyncprintcore_module, "ONLINE_TIMEOUT", 0.5)
+    printer = RubbishFirst(together)
+    core = engine()
+    core.errorcb = lambda error: None
+    try:
+        core.connect(printer.path, 250000)
+        deadline = time.monotonic() + 10
+        while not core.online and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert core.online
+    finally:
+        core.disconnect()
+        printer.close()
+
+class AnalysedUpTo(gcoder.LightGCode):
+    """Job whose background analysis has only reached its first lines"""
+
+    prepared = False
+    ready = 5
+
+    def ready_count(self):
+        return self.ready
+
+    def has_index(self, i):
+        assert i < self.ready, "has_index() would wait for the analysis"
+        return i < len(self)
+
+def test_loop_engine_does_not_wait_for_the_analysis():
+    core = asyncprintcore()
+    # As connected, to a port which is never written to here
+    core.printer = object()
+    core.printer_tcp = None
+    core.online = True
+    core.printing = True
+    core.mainqueue = AnalysedUpTo(["G1 X%d" % i for i in range(20)])
+    core.queueindex = 4
+    assert core._nextline() == (None, None)
+    assert not core._print_done()
+    core.priqueue.put_nowait("M105")
+    assert core._nextline()[0] == b"M105\n"
+    core.mainqueue.ready = 20
+    assert core._nextline()[0].startswith(b"N0 G1 X4*")
@@ -0,0 +1,55 @@
+from printrun import gcoder
+from printrun.sendstream import EMPTY, HOST_COMMAND, SendStream
+
+def job(count):
+    lines = []
+    for i in range(count):
+        if i % 50 == 0:
+            lines.append("; layer %d" % i)
+        elif i % 77 == 0:
+            lines.append(";@pause")
+        else:
+            lines.append("G1 X%d Y%d ; move" % (i % 200, i % 7))
+    return gcoder.LightGCode(lines)
+
+def compiled(gcode, chunk, discard):
+    """The frames of gcode as the print loop gets them, precompiling chunk
+    lines at a time"""
+    stream = SendStream()
+    frames = []
+    held = 0
+    lineno = 0
+    for index in range(len(gcode)):
+        if index >= len(stream):
+            if discard:
+                stream.discard(index)
+            stream.update(gcode, index + chunk)
+        held = max(held, len(stream.flags))
+        flags = stream.line_flags(index)
+        if flags & (EMPTY | HOST_COMMAND):
+            frames.append(flags)
+            continue
+        frames.append(stream.frame(index, lineno))
+        lineno += 1
+    return frames, held
+
+def test_discarding_sent_lines_keeps_the_frames():
+    gcode = job(3000)
+    expected, held = compiled(gcode, len(gcode), False)
+    assert held == len(gcode)
+    for chunk in (1, 7, 512):
+        frames, held = compiled(gcode, chunk, True)
+        assert frames == expected
+        assert held == chunk
+
+def test_frames_are_renumbered_after_skipped_lines():
+    gcode = job(100)
+    stream = SendStream()
+    stream.update(gcode, 10)
+    stream.discard(40)
+    assert stream.start == len(stream) == 40 and not stream.data
+    stream.update(gcode, 60)
+    assert stream.frame(41, 7).startswith(b"N7 G1 X41 Y6*")
+    stream.discard(45)
+    assert stream.start == 45 and len(stream) == 60
+    assert stream.command(45) == b"G1 X45 Y3"
@@ -0,0 +1,102 @@
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+
+import pytest
+
+from printrun import responses
+from printrun.printcore import printcore
+
+MALFORMED = [b"FIRMWARE_NAME:\n", b"FIRMWARE_NAME:   \n", b"Cap:\n",
+             b"Cap:EEPROM\n", b"Cap:EEPROM:2\n"]
+
+def receive(core, data):
+    # As connected, without a port to write to
+    core.printer_tcp = None
+    core.online = True
+    core._handle_lines(core._received(data))
+
+def test_malformed_firmware_lines_are_received_without_their_fields():
+    received = []
+    core = printcore()
+    core.recvcb = received.append
+    receive(core, b"".join(MALFORMED))
+    assert [str(response).strip() for response in received] == \
+        [line.decode().strip() for line in MALFORMED]
+    assert not any(response.firmware_name for response in received)
+    assert all(response.capability is None for response in received
+               if response.kind == responses.CAPABILITY)
+
+def load_device_module():
+    """Imports SerialOutputDevice as part of the plugin package"""
+    pytest.importorskip("UM")
+    pytest.importorskip("cura")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        "SerialConnection", os.path.join(root, "__init__.py"),
+        submodule_search_locations = [root])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["SerialConnection"] = package
+    spec.loader.exec_module(package)
+    return importlib.import_module("SerialConnection.SerialOutputDevice")
+
+@pytest.mark.parametrize("line", MALFORMED)
+def test_malformed_firmware_lines_reach_the_device(caplog, line):
+    module = load_device_module()
+    device_class = module.SerialOutputDevice
+
+    class Device:
+        onLineReceived = device_class.onLineReceived
+        _setFirmwareName = device_class._setFirmwareName
+        _registerFirmwareCapability = device_class._registerFirmwareCapability
+
+        def __init__(self):
+            self._firmware_name = ""
+            self._firmware_capabilities = {}
+
+    device = Device()
+    core = printcore()
+    core.addEventHandler(module._PrintCoreEventHandler(device))
+    with caplog.at_level(logging.ERROR):
+        receive(core, line)
+    assert not caplog.records
+    if line.startswith(b"FIRMWARE_NAME:"):
+        assert device._firmware_name == "Unknown"
+    else:
+        assert device._firmware_capabilities == {}
+
+def test_a_job_which_cannot_be_prepared_ends_the_print(monkeypatch):
+    module = load_device_module()
+    device_class = module.SerialOutputDevice
+
+    class Application:
+        @staticmethod
+        def getInstance():
+            return Application
+
+        @staticmethod
+        def callLater(function, *args):
+            function(*args)
+
+    class Device:
+        _prepareJob = device_class._prepareJob
+        _onPrepareFailed = device_class._onPrepareFailed
+
+        def __init__(self):
+            self._preparing_job = None
+            self._is_printing = True
+            self.errors = []
+            self.writeError = type("Signal", (), {"emit": self.errors.append})()
+
+        def _prepareGCode(self, gcode_data, gcode_hash, motion_limits):
+            raise OSError("the g-code spool is gone")
+
+    monkeypatch.setattr(module, "CuraApplication", Application)
+    device = Device()
+    job = device._preparing_job = object()
+    device._prepareJob(job, b"G1 X1\n", None, "job", None, None, None)
+    assert device._preparing_job is None
+    assert not device._is_printing
+    assert device.errors == [device]
@@ -0,0 +1,126 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("the watcher uses inotify", allow_module_level = True)
+
+# The plugin's modules import each other relatively as the plugin package;
+# this one imports nothing of it, so it is loaded on its own
+_spec = importlib.util.spec_from_file_location(
+    "SerialPortWatcher", os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "SerialPortWatcher.py"))
+SerialPortWatcher = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(SerialPortWatcher)
+
+@pytest.fixture
+def dev():
+    with tempfile.TemporaryDirectory() as path:
+        yield path
+
+def by_id(dev):
+    return os.path.join(dev, "serial", "by-id")
+
+def touch(path):
+    open(path, "w").close()
+
+def plug(dev, node, link):
+    """Creates the node of a device, then its link as udev does"""
+    touch(os.path.join(dev, node))
+    os.makedirs(by_id(dev), exist_ok = True)
+    os.symlink(os.path.join(dev, node), os.path.join(by_id(dev), link))
+
+@pytest.fixture
+def watcher(dev):
+    watcher = SerialPortWatcher.SerialPortWatcher(dev_path = dev,
+                                                  by_id_path = by_id(dev))
+    yield watcher
+    watcher.close()
+
+def test_stable_paths(dev):
+    assert SerialPortWatcher.stablePaths(by_id(dev)) == {}
+    plug(dev, "ttyACM0", "usb-Prusa_MK3-if00")
+    plug(dev, "ttyUSB0", "usb-FTDI_B-if00")
+    os.symlink(os.path.join(dev, "ttyUSB0"),
+               os.path.join(by_id(dev), "usb-FTDI_A-if00"))
+    touch(os.path.join(by_id(dev), "not-a-link"))
+    assert SerialPortWatcher.stablePaths(by_id(dev)) == {
+        os.path.join(dev, "ttyACM0"): os.path.join(by_id(dev), "usb-Prusa_MK3-if00"),
+        os.path.join(dev, "ttyUSB0"): os.path.join(by_id(dev), "usb-FTDI_A-if00"),
+    }
+
+def test_a_new_node_is_reported(dev, watcher):
+    touch(os.path.join(dev, "ttyUSB0"))
+    assert watcher.wait(5)
+    assert not watcher.wait(0.3)
+
+def test_other_nodes_are_ignored(dev, watcher):
+    touch(os.path.join(dev, "sda1"))
+    assert not watcher.wait(0.5)
+
+def test_links_in_a_new_directory_are_reported(dev, watcher):
+    plug(dev, "ttyUSB0", "usb-FTDI-if00")
+    assert watcher.wait(5)
+    # The by-id directory is watched now that it exists
+    os.symlink(os.path.join(dev, "ttyUSB0"),
+               os.path.join(by_id(dev), "usb-FTDI-if00-port0"))
+    assert watcher.wait(5)
+    os.unlink(os.path.join(by_id(dev), "usb-FTDI-if00"))
+    assert watcher.wait(5)
+
+def test_node_and_link_are_reported_at_once(dev, watcher):
+    def add_link():
+        os.makedirs(by_id(dev))
+        os.symlink(os.path.join(dev, "ttyACM0"),
+                   os.path.join(by_id(dev), "usb-Prusa_MK3-if00"))
+    touch(os.path.join(dev, "ttyACM0"))
+    link = threading.Timer(SerialPortWatcher.DEBOUNCE_DELAY / 2, add_link)
+    link.start()
+    try:
+        assert watcher.wait(5)
+        assert SerialPortWatcher.stablePaths(by_id(dev))
+        assert not watcher.wait(0.5)
+    finally:
+        link.join()
+
+def test_changes_coming_in_all_the_time_are_reported(dev, watcher, monkeypatch):
+    monkeypatch.setattr(SerialPortWatcher, "DEBOUNCE_DELAY", 0.2)
+    monkeypatch.setattr(SerialPortWatcher, "DEBOUNCE_LIMIT", 0.4)
+    stop = threading.Event()
+
+    def churn():
+        for i in range(100):
+            if stop.wait(0.05):
+                break
+            touch(os.path.join(dev, "ttyS%d" % i))
+    thread = threading.Thread(target = churn)
+    thread.start()
+    try:
+        start = time.monotonic()
+        assert watcher.wait(10)
+        assert time.monotonic() - start < 2
+    finally:
+        stop.set()
+        thread.join()
+
+def test_interrupt_ends_a_wait(watcher):
+    timer = threading.Timer(0.1, watcher.interrupt)
+    timer.start()
+    start = time.monotonic()
+    assert not watcher.wait(10)
+    assert time.monotonic() - start < 5
+    timer.join()
+
+def test_interrupt_after_close_is_ignored(watcher):
+    watcher.close()
+    watcher.interrupt()
+
+def test_a_missing_device_directory_is_an_error(dev):
+    with pytest.raises(OSError):
+        SerialPortWatcher.SerialPortWatcher(
+            dev_path = os.path.join(dev, "missing"), by_id_path = by_id(dev))
@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+from printrun import gcoder
+from printrun.asyncprintcore import asyncprintcore
+from printrun.printcore import printcore
+from printrun.virtualprinter import VirtualPrinter
+
+def wait_for(condition, timeout = 30):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@pytest.mark.parametrize("engine", [printcore, asyncprintcore])
+@pytest.mark.parametrize("bufsize", [4, 16])
+def test_advanced_ok_print_on_a_clean_link(engine, bufsize):
+    printer = VirtualPrinter(bufsize = bufsize, advanced_ok = True, seed = 1)
+    core = engine()
+    try:
+        core.connect(printer.serve_pty(), 250000)
+        assert wait_for(lambda: core.online)
+        lines = ["G1 X%d Y%d" % (i % 100, i % 7) for i in range(5000)]
+        core.startprint(gcoder.LightGCode(lines))
+        assert wait_for(lambda: not core.printing)
+    finally:
+        core.disconnect()
+        printer.stop()
+    stats = printer.stats()
+    # The oks report the lines they acknowledge, so the host never sends
+    # more than the buffers of the printer take
+    assert stats["lines"] >= len(lines)
+    assert stats["rejected"] == 0
+    assert stats["overflowed"] == 0